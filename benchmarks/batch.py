@@ -0,0 +1,71 @@
+#! /usr/bin/python3
+
+"""
+Compares deleting and trashing the files of a tree one by one, like before the batch methods of Source,
+with delete_many() and rename_many(), which only remove the empty folders once at the end.
+
+    python3 benchmarks/batch.py --files 50000
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def legacy_delete(root, path):
+    if os.path.exists(os.path.join(root, path)):
+        os.remove(os.path.join(root, path))
+    try:
+        os.removedirs(os.path.dirname(os.path.join(root, path)))
+    except OSError:
+        pass
+
+def legacy_rename(root, from_, to):
+    dest = os.path.join(root, to)
+    if not os.path.exists(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(os.path.join(root, from_), dest)
+    try:
+        os.removedirs(os.path.dirname(os.path.join(root, from_)))
+    except OSError:
+        pass
+
+def measure(name, function, nbr_files):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print("%s: %.3fs (%.0f files/s)" % (name, elapsed, nbr_files / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched deletes and renames.")
+    parser.add_argument("--files", type=int, default=50000)
+    args = parser.parse_args()
+
+    workloads = [
+        ("delete, one by one", lambda root, paths: [legacy_delete(root, x) for x in paths]),
+        ("delete, delete_many", lambda root, paths: bisync_lib.FileSystemSource(root).delete_many(paths)),
+        ("trash, one by one", lambda root, paths: [legacy_rename(root, x,
+            os.path.join(bisync_lib.BISYNC_TRASH, x)) for x in paths]),
+        ("trash, rename_many", lambda root, paths: bisync_lib.FileSystemSource(root).rename_many(
+            [(x, os.path.join(bisync_lib.BISYNC_TRASH, x)) for x in paths])),
+    ]
+    for name, function in workloads:
+        root = tempfile.mkdtemp()
+        try:
+            # the folder of the root is kept by both implementations
+            os.makedirs(os.path.join(root, bisync_lib.BISYNC_FOLDER))
+            paths = generators.generate_tree(root, args.files)
+            measure(name, lambda: function(root, paths), args.files)
+        finally:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
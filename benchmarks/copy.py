@@ -0,0 +1,67 @@
+#! /usr/bin/python3
+
+"""
+Compares FileSystemSource.copy_to with the previous shutil.copy + os.stat + os.utime implementation,
+for many small files and for a few large ones.
+
+    python3 benchmarks/copy.py --small 2000 --large-size 1024
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def legacy_copy_to(root, local_file, dest_file):
+    dest = os.path.join(root, dest_file)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copy(local_file, dest)
+    stat = os.stat(local_file)
+    os.utime(dest, (stat.st_atime, stat.st_mtime))
+
+def generate_files(folder, count, size):
+    return [os.path.join(folder, x) for x in generators.generate_tree(folder, count, size)]
+
+def measure(name, copy, files, dest):
+    start = time.perf_counter()
+    for i, file_ in enumerate(files):
+        copy(file_, os.path.join("copy", "file%d" % i))
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(x) for x in files)
+    print("%s: %d files, %.1f MB in %.3fs (%.1f MB/s, %.0f files/s)" % (name, len(files), size / 1e6,
+        elapsed, size / 1e6 / elapsed, len(files) / elapsed))
+    shutil.rmtree(os.path.join(dest, "copy"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the file copy.")
+    parser.add_argument("--small", type=int, default=2000, help="Number of small files")
+    parser.add_argument("--small-size", type=int, default=4, help="Size of the small files in kB")
+    parser.add_argument("--large", type=int, default=2, help="Number of large files")
+    parser.add_argument("--large-size", type=int, default=512, help="Size of the large files in MB")
+    parser.add_argument("--dest", help="Destination folder, to copy to another filesystem")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    dest = args.dest or root
+    try:
+        workloads = [
+            ("small", generate_files(os.path.join(root, "small"), args.small, args.small_size * 1000)),
+            ("large", generate_files(os.path.join(root, "large"), args.large, args.large_size * 1000000)),
+        ]
+        source = bisync_lib.FileSystemSource(dest)
+        for name, files in workloads:
+            measure("%s, shutil.copy" % name, lambda x, y: legacy_copy_to(dest, x, y), files, dest)
+            measure("%s, copy_to" % name, source.copy_to, files, dest)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
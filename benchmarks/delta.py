@@ -0,0 +1,82 @@
+#! /usr/bin/python3
+
+"""
+Measures the bytes sent to a remote folder and the time needed to synchronize a large modified file,
+with and without delta transfers. The remote folder is served by an agent started through a pipe.
+
+    python3 benchmarks/delta.py --size 200
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import bisync_lib
+
+class CountingWriter(object):
+    """ Counts the bytes written to the agent. """
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def modify(content, kind):
+    if kind == "append":
+        return content + os.urandom(100000)
+    elif kind == "overwrite":
+        middle = len(content) // 2
+        return content[:middle] + os.urandom(4096) + content[middle + 4096:]
+    else: # insert
+        return content[:1000] + b"new tag" + content[1000:]
+
+def run(root, size, kind, delta):
+    folders = [os.path.join(root, "f1"), os.path.join(root, "f2")]
+    content = os.urandom(size * 1000000)
+    for folder in folders:
+        os.makedirs(folder)
+        with open(os.path.join(folder, "file"), "wb") as file_:
+            file_.write(content)
+    sync = bisync_lib.Synchronizer(delta=delta)
+    sync.synchronize_all([bisync_lib.FileSystemSource(x) for x in folders])
+    with open(os.path.join(folders[0], "file"), "wb") as file_:
+        file_.write(modify(content, kind))
+    os.utime(os.path.join(folders[0], "file"), (10 ** 9, 10 ** 9))
+
+    remote = bisync_lib.RemoteSource([sys.executable, os.path.join(ROOT, "bisync"), "--agent", folders[1]])
+    writer = remote._process.stdin = CountingWriter(remote._process.stdin)
+    start = time.perf_counter()
+    try:
+        sync.synchronize_all([bisync_lib.FileSystemSource(folders[0]), remote])
+    finally:
+        remote.close()
+    print("%s, %s: %.1f MB sent in %.3fs" % (kind, "delta" if delta else "copy", writer.written / 1e6,
+        time.perf_counter() - start))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the delta transfers.")
+    parser.add_argument("--size", type=int, default=200, help="Size of the file in MB")
+    args = parser.parse_args()
+
+    for kind in ["append", "overwrite", "insert"]:
+        for delta in [False, True]:
+            root = tempfile.mkdtemp()
+            try:
+                run(root, args.size, kind, delta)
+            finally:
+                shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
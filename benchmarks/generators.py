@@ -0,0 +1,116 @@
+"""
+Generators of synthetic folders and indexes for the benchmarks. All of them are deterministic for a given
+seed, so results can be compared across commits.
+"""
+
+import os
+import os.path
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+
+BASE_TIME = 10 ** 9
+
+def file_path(i):
+    """ Path of the file i of a synthetic collection, 10 files per album and 100 albums per artist. """
+    return os.path.join("artist%d" % (i // 1000), "album%d" % (i // 10), "track%d.mp3" % i)
+
+def folder_path(i, folders_per_folder=10):
+    """ Path of the folder i of a balanced tree. """
+    parts = []
+    while True:
+        parts.append("d%d" % (i % folders_per_folder))
+        i //= folders_per_folder
+        if i == 0:
+            return os.path.join(*reversed(parts))
+
+def generate_tree(root, nbr_files, size=0, files_per_folder=100, folders_per_folder=10, seed=0):
+    """ Creates nbr_files files in a balanced tree of folders and returns their relative paths. Files of
+    size 0 get a few bytes, other files get size bytes of random data, rotated so their contents differ. """
+    random_ = random.Random(seed)
+    block = bytes(random_.getrandbits(8) for _ in range(min(size, 64 * 1024)))
+    paths = []
+    for i in range(nbr_files):
+        folder = folder_path(i // files_per_folder, folders_per_folder)
+        if i % files_per_folder == 0:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+        path = os.path.join(folder, "f%d" % i)
+        with open(os.path.join(root, path), "wb") as file_:
+            if size == 0:
+                file_.write(b"x" * (i % 7))
+            else:
+                rotated = block[i % len(block):] + block[:i % len(block)]
+                for _ in range(size // len(block)):
+                    file_.write(rotated)
+                file_.write(rotated[:size % len(block)])
+        os.utime(os.path.join(root, path), (BASE_TIME + i, BASE_TIME + i))
+        paths.append(path)
+    # incremental walks do not trust recently modified folders
+    for folder in os.walk(root):
+        os.utime(folder[0], (BASE_TIME, BASE_TIME))
+    return paths
+
+def random_history(random_):
+    """ Returns a random history in the JSON format, most files having a single version. """
+    versions = [[True, random_.randint(0, 10 ** 8), random_.randint(BASE_TIME, 2 * BASE_TIME)]]
+    if random_.random() < 0.2:
+        versions.append([True, random_.randint(0, 10 ** 8), random_.randint(BASE_TIME, 2 * BASE_TIME)])
+    if random_.random() < 0.1:
+        versions.append([False])
+    return versions
+
+def generate_histories(nbr_files, seed=0):
+    """ Returns a list of random histories in the JSON format. """
+    random_ = random.Random(seed)
+    return [random_history(random_) for _ in range(nbr_files)]
+
+def generate_index(nbr_files, seed=0):
+    """ Returns an index in the JSON format: a dictionary mapping paths to histories. """
+    return dict(zip((file_path(i) for i in range(nbr_files)), generate_histories(nbr_files, seed)))
+
+def generate_replicas(nbr_replicas, nbr_files, seed=0, modified=0.05, deleted=0.01, added=0.01):
+    """ Returns the indexes (paths mapped to History objects) of replicas which were synchronized, then
+    modified independently: each replica modifies, deletes and adds a fraction of the files. Files
+    modified in several replicas are conflicts. """
+    base = dict((path, bisync_lib.History.from_list(versions))
+        for path, versions in generate_index(nbr_files, seed).items())
+    paths = sorted(base.keys())
+    replicas = []
+    for k in range(nbr_replicas):
+        random_ = random.Random("%d-%d" % (seed, k))
+        index = dict(base)
+        for path in paths:
+            draw = random_.random()
+            if draw < modified:
+                index[path] = index[path].append(bisync_lib.make_version(random_.randint(0, 10 ** 8),
+                    2 * BASE_TIME + random_.randint(0, 10 ** 6)))
+            elif draw < modified + deleted and index[path][-1][0] == True:
+                index[path] = index[path].append(bisync_lib.make_deleted_version(2 * BASE_TIME))
+        for i in range(int(nbr_files * added)):
+            index[os.path.join("replica%d" % k, file_path(i))] = bisync_lib.History(
+                bisync_lib.make_version(random_.randint(0, 10 ** 8), 2 * BASE_TIME + i))
+        replicas.append(index)
+    return replicas
+
+class MemorySource(bisync_lib.Source):
+    """ Source whose files only exist in its index, the operations on files do nothing. """
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+    def get_name(self):
+        return self.name
+
+    def walk(self):
+        for path, versions in self.index.items():
+            last = versions[-1]
+            if last[0] == True:
+                yield [path, last[1], last[2]]
+
+    def exists(self, path):
+        return False
+
+    def get_local_name(self, path):
+        return path
@@ -0,0 +1,74 @@
+#! /usr/bin/python3
+
+"""
+Measures the bytes copied to synchronize folders where every file was touched without being modified,
+with and without the comparison of hashes, and the hashing throughput with one and several processes.
+
+    python3 benchmarks/hashing.py --files 1000 --size 1000
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+class CountingSource(bisync_lib.FileSystemSource):
+    def __init__(self, path):
+        super(CountingSource, self).__init__(path)
+        self.copied = 0
+
+    def copy_to(self, local_file, dest_file):
+        self.copied += os.path.getsize(local_file)
+        super(CountingSource, self).copy_to(local_file, dest_file)
+
+def touch_everything(root, nbr_files, size, hash_contents):
+    folders = [os.path.join(root, "f1"), os.path.join(root, "f2")]
+    paths = generators.generate_tree(folders[0], nbr_files, size * 1000)
+    os.makedirs(folders[1])
+    sync = bisync_lib.Synchronizer(no_trash=True, hash_contents=hash_contents)
+    sync.synchronize_all([bisync_lib.FileSystemSource(x) for x in folders])
+    for path in paths:
+        os.utime(os.path.join(folders[0], path), (2 * 10 ** 9, 2 * 10 ** 9))
+    sources = [CountingSource(x) for x in folders]
+    start = time.perf_counter()
+    sync.synchronize_all(sources)
+    print("touch everything, %s: %.1f MB copied in %.3fs" % ("hashes" if hash_contents else "no hashes",
+        sources[1].copied / 1e6, time.perf_counter() - start))
+
+def throughput(root, nbr_files, size, workers):
+    folder = os.path.join(root, "f1")
+    paths = generators.generate_tree(folder, nbr_files, size * 1000)
+    source = bisync_lib.FileSystemSource(folder, hash_workers=workers)
+    start = time.perf_counter()
+    source.hash_files(paths, {})
+    elapsed = time.perf_counter() - start
+    total = nbr_files * size / 1000.
+    print("hashing, %d process(es): %.0f MB/s, %.0f MB/s per process" % (workers, total / elapsed,
+        total / elapsed / workers))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the comparison of hashes.")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=1000, help="Size of the files in kB")
+    args = parser.parse_args()
+
+    runs = [(touch_everything, False), (touch_everything, True), (throughput, 1)]
+    if os.cpu_count() > 1:
+        runs.append((throughput, os.cpu_count()))
+    for function, arg in runs:
+        root = tempfile.mkdtemp()
+        try:
+            function(root, args.files, args.size, arg)
+        finally:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#! /usr/bin/python3
+
+"""
+Compares the memory used by file histories stored as nested lists, like in the JSON index, and as
+History objects, and the time needed to compare their last versions.
+
+    python3 benchmarks/history.py --files 1000000
+
+"""
+
+import argparse
+import os
+import os.path
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def measure_memory(function, *args):
+    tracemalloc.start()
+    result = function(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the history representation.")
+    parser.add_argument("--files", type=int, default=1000000)
+    args = parser.parse_args()
+
+    lists, lists_size = measure_memory(generators.generate_histories, args.files)
+    histories, histories_size = measure_memory(lambda: [bisync_lib.History.from_list(x) for x in lists])
+    print("Nested lists: %.1f MB (%.0f bytes per file)" % (lists_size / 1e6, lists_size / args.files))
+    print("History: %.1f MB (%.0f bytes per file)" % (histories_size / 1e6, histories_size / args.files))
+    print("Ratio: %.1fx" % (lists_size / histories_size))
+
+    # the check done by Synchronizer.plan_path for each file, most histories being identical after a sync
+    for name, others in [("identical", generators.generate_histories(args.files)),
+            ("different", generators.generate_histories(args.files, 1))]:
+        start = time.perf_counter()
+        for versions1, versions2 in zip(lists, others):
+            versions1[-1] == versions2[-1]
+        print("Nested lists, %s histories: %.3fs" % (name, time.perf_counter() - start))
+        others = [bisync_lib.History.from_list(x) for x in others]
+        getitem = bytes.__getitem__
+        last = slice(-bisync_lib.VERSION.size, None)
+        start = time.perf_counter()
+        for versions1, versions2 in zip(histories, others):
+            # the comparison of Synchronizer.plan_path()
+            versions1 == versions2 or versions1.endswith(getitem(versions2, last)) or \
+                (getitem(versions1, -9) & getitem(versions2, -9) & 0x80 and
+                    versions1.key(-1) == versions2.key(-1))
+        print("History, %s histories: %.3fs" % (name, time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
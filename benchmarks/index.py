@@ -0,0 +1,85 @@
+#! /usr/bin/python3
+
+"""
+Compares the time and peak memory needed to save and load an index in the legacy JSON format and in
+the current format.
+
+    python3 benchmarks/index.py --files 1000000
+
+"""
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def legacy_save(source, index):
+    source.write_memory(bisync_lib.BISYNC_INDEX, json.dumps(index).encode("utf8"))
+
+def legacy_load(source):
+    return json.loads(source.read_memory(bisync_lib.BISYNC_INDEX).decode("utf8"))
+
+def measure(function, *args):
+    """ Returns the elapsed time of a call and the peak memory allocated during a second call, memory
+    tracing being too slow to measure both at the same time. """
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the index formats.")
+    parser.add_argument("--files", type=int, default=1000000)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        index = generators.generate_index(args.files)
+        source = bisync_lib.FileSystemSource(root)
+        source.index = dict((k, bisync_lib.History.from_list(v)) for k, v in index.items())
+        sync = bisync_lib.Synchronizer()
+
+        elapsed, peak = measure(legacy_save, source, index)
+        size = os.path.getsize(os.path.join(root, bisync_lib.BISYNC_INDEX))
+        print("JSON save: %.3fs, peak %.1f MB, %.1f MB on disk" % (elapsed, peak / 1e6, size / 1e6))
+        elapsed, peak = measure(legacy_load, source)
+        print("JSON load: %.3fs, peak %.1f MB" % (elapsed, peak / 1e6))
+
+        def save_all():
+            source.index = bisync_lib.Index()
+            source.index.update(histories)
+            sync.save_index(source)
+        histories = dict(source.index)
+        elapsed, peak = measure(save_all)
+        size = bisync_lib.index_size(root)
+        print("Index save: %.3fs, peak %.1f MB, %.1f MB on disk in %d shards" % (elapsed, peak / 1e6,
+            size / 1e6, source.index.shards))
+        elapsed, peak = measure(sync.load_index, source)
+        print("Index load: %.3fs, peak %.1f MB" % (elapsed, peak / 1e6))
+
+        # a synchronization modifying a few files only rewrites their shards
+        def save_modified():
+            for path in paths:
+                source.index[path] = source.index[path].append(bisync_lib.make_version(1, 1))
+            sync.save_index(source)
+        paths = list(histories.keys())[:10]
+        elapsed, peak = measure(save_modified)
+        print("Index save, %d files modified: %.3fs, peak %.1f MB" % (len(paths), elapsed, peak / 1e6))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
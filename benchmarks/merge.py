@@ -0,0 +1,78 @@
+#! /usr/bin/python3
+
+"""
+Compares the linear common version search and history merge with the quadratic implementations they
+replaced, on two long histories diverging after a common part.
+
+    python3 benchmarks/merge.py --versions 10000
+
+"""
+
+import argparse
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+
+def quadratic_last_common_version(versions1, versions2):
+    i = len(versions1) - 1
+    j = len(versions2) - 1
+    while j >= 0:
+        if versions1[i] == versions2[j]:
+            break
+        i -= 1
+        if i == -1:
+            i = len(versions1) - 1
+            j -= 1
+    return i, j
+
+def quadratic_merge_histories(versions1, versions2):
+    last_common_i = -1
+    last_common_j = -1
+    i = 0
+    j = 0
+    n_versions = []
+    while i < len(versions1) and j < len(versions2):
+        if versions1[i] == versions2[j]:
+            n_versions += versions2[last_common_j + 1:j]
+            n_versions += versions1[last_common_i + 1:i]
+            n_versions.append(versions1[i])
+            last_common_i = i
+            last_common_j = j
+            i += 1
+            j += 1
+            continue
+        i += 1
+        if i == len(versions1):
+            i = last_common_i + 1
+            j += 1
+    n_versions += versions2[last_common_j + 1:]
+    n_versions += versions1[last_common_i + 1:]
+    return n_versions
+
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the history algorithms.")
+    parser.add_argument("--versions", type=int, default=10000)
+    args = parser.parse_args()
+
+    # both histories share their first half and then diverge, like after a conflict
+    half = args.versions // 2
+    versions1 = [[True, 1, x] for x in range(args.versions)]
+    versions2 = versions1[:half] + [[True, 2, x] for x in range(half, args.versions)]
+    histories = bisync_lib.History.from_list(versions1), bisync_lib.History.from_list(versions2)
+
+    print("Common version, quadratic: %.3fs" % measure(quadratic_last_common_version, versions1, versions2))
+    print("Common version, linear: %.3fs" % measure(bisync_lib.last_common_version, *histories))
+    print("Merge, quadratic: %.3fs" % measure(quadratic_merge_histories, versions1, versions2))
+    print("Merge, linear: %.3fs" % measure(bisync_lib.merge_histories, *histories))
+
+if __name__ == "__main__":
+    main()
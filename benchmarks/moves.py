@@ -0,0 +1,69 @@
+#! /usr/bin/python3
+
+"""
+Measures the bytes transferred to synchronize a reorganization of a folder, where all the files are
+moved to other subfolders, with and without the detection of moved files.
+
+    python3 benchmarks/moves.py --files 1000 --size 1000
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+
+class CountingSource(bisync_lib.FileSystemSource):
+    def __init__(self, path):
+        super(CountingSource, self).__init__(path)
+        self.copied = 0
+
+    def copy_to(self, local_file, dest_file):
+        self.copied += os.path.getsize(local_file)
+        super(CountingSource, self).copy_to(local_file, dest_file)
+
+def run(root, nbr_files, size, detect_moves):
+    folders = [os.path.join(root, "f1"), os.path.join(root, "f2")]
+    content = os.urandom(size * 1000)
+    for i in range(nbr_files):
+        path = os.path.join(folders[0], "album%d" % (i // 10), "track%d" % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file_:
+            file_.write(content)
+    os.makedirs(folders[1])
+    sync = bisync_lib.Synchronizer(no_trash=True, detect_moves=detect_moves)
+    sync.synchronize_all([bisync_lib.FileSystemSource(x) for x in folders])
+
+    # every album is moved in a folder named after its artist
+    for i in range(nbr_files // 10 + 1):
+        album = os.path.join(folders[0], "album%d" % i)
+        if os.path.exists(album):
+            os.renames(album, os.path.join(folders[0], "artist%d" % (i // 10), "album%d" % i))
+    sources = [CountingSource(x) for x in folders]
+    start = time.perf_counter()
+    sync.synchronize_all(sources)
+    elapsed = time.perf_counter() - start
+    print("%s: %.1f MB copied, synchronized in %.3fs" % ("with move detection" if detect_moves else
+        "without move detection", sources[1].copied / 1e6, elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the synchronization of moved files.")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=1000, help="Size of the files in kB")
+    args = parser.parse_args()
+
+    for detect_moves in [False, True]:
+        root = tempfile.mkdtemp()
+        try:
+            run(root, args.files, args.size, detect_moves)
+        finally:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#! /usr/bin/python3
+
+"""
+Compares the single pass synchronization of several folders with the previous loop synchronizing every
+pair of folders, when each folder has a newer version of the files than the previous one.
+
+    python3 benchmarks/nway.py --folders 5 --files 1000 --size 100
+
+"""
+
+import argparse
+import itertools
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+
+class CountingSource(bisync_lib.FileSystemSource):
+    def __init__(self, path):
+        super(CountingSource, self).__init__(path)
+        self.copied = 0
+
+    def copy_to(self, local_file, dest_file):
+        self.copied += os.path.getsize(local_file)
+        super(CountingSource, self).copy_to(local_file, dest_file)
+
+def generate(root, nbr_folders, nbr_files, size):
+    """ The folder k has the version k of every file, which follows the versions of the previous
+    folders. """
+    folders = [os.path.join(root, "f%d" % k) for k in range(nbr_folders)]
+    content = os.urandom(size * 1000)
+    sync = bisync_lib.Synchronizer()
+    for k, folder in enumerate(folders):
+        source = bisync_lib.FileSystemSource(folder)
+        source.index = {}
+        for i in range(nbr_files):
+            path = os.path.join("folder%d" % (i // 100), "file%d" % i)
+            os.makedirs(os.path.join(folder, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(folder, path), "wb") as file_:
+                file_.write(content)
+            os.utime(os.path.join(folder, path), (10 ** 9 + k, 10 ** 9 + k))
+            source.index[path] = bisync_lib.History.from_list([[True, len(content), 10 ** 9 + x]
+                for x in range(k + 1)])
+        os.makedirs(os.path.join(folder, bisync_lib.BISYNC_FOLDER))
+        sync.save_index(source)
+    return folders
+
+def pairwise(sync, sources):
+    for x in sources:
+        sync.build_index(x)
+    for i, j in itertools.combinations_with_replacement(range(len(sources)), 2):
+        sync.sync(sources[i], sources[j])
+    for x in sources:
+        sync.save_index(x)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the synchronization of several folders.")
+    parser.add_argument("--folders", type=int, default=5)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=100, help="Size of the files in kB")
+    args = parser.parse_args()
+
+    sync = bisync_lib.Synchronizer(no_trash=True)
+    for name, function in [("pairwise", lambda x: pairwise(sync, x)), ("single pass", sync.synchronize_all)]:
+        root = tempfile.mkdtemp()
+        try:
+            folders = generate(root, args.folders, args.files, args.size)
+            sources = [CountingSource(x) for x in folders]
+            start = time.perf_counter()
+            cpu = time.process_time()
+            function(sources)
+            print("%s: %.1f MB copied in %.3fs (%.3fs CPU)" % (name, sum(x.copied for x in sources) / 1e6,
+                time.perf_counter() - start, time.process_time() - cpu))
+        finally:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
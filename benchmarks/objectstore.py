@@ -0,0 +1,92 @@
+#! /usr/bin/python3
+
+"""
+Measures the listing and the upload throughput of ObjectStoreSource: the walk of a bucket, and the upload
+of a large file with a single worker and with parallel multipart uploads. The object store is a real one
+with --endpoint-url (a local moto or MinIO server for instance, the bucket must exist), or else the
+in-process fake of the tests, with a simulated latency and bandwidth per request.
+
+    python3 benchmarks/objectstore.py --objects 10000 --size 64
+    python3 benchmarks/objectstore.py --endpoint-url http://localhost:5000 --bucket bench
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import bisync_test
+
+class SlowClient(bisync_test.FakeS3Client):
+    """ Fake client whose requests take latency seconds, plus the time to send their body at bandwidth
+    bytes per second, like a connection to a remote object store. """
+    def __init__(self, latency, bandwidth):
+        super(SlowClient, self).__init__()
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def _call(self, name):
+        super(SlowClient, self)._call(name)
+        time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        time.sleep(len(Body) / self.bandwidth)
+        return super(SlowClient, self).put_object(Bucket, Key, Body, Metadata)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        time.sleep(len(Body) / self.bandwidth)
+        return super(SlowClient, self).upload_part(Bucket, Key, UploadId, PartNumber, Body)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the object store source.")
+    parser.add_argument("--objects", type=int, default=10000, help="Number of objects listed")
+    parser.add_argument("--size", type=int, default=64, help="Size of the uploaded file in MB")
+    parser.add_argument("--endpoint-url", help="URL of an object store compatible with S3")
+    parser.add_argument("--bucket", default="bench")
+    parser.add_argument("--latency", type=float, default=20, help="Simulated latency of a request in ms")
+    parser.add_argument("--bandwidth", type=float, default=20,
+        help="Simulated bandwidth of a request in MB/s")
+    args = parser.parse_args()
+
+    if args.endpoint_url is not None:
+        if bisync_lib.boto3 is None:
+            parser.error("boto3 is required with --endpoint-url")
+        client = bisync_lib.boto3.client("s3", endpoint_url=args.endpoint_url)
+    else:
+        client = SlowClient(args.latency / 1000., args.bandwidth * 1e6)
+    prefix = "bisync-benchmark-%d/" % os.getpid()
+    root = tempfile.mkdtemp()
+    source = bisync_lib.ObjectStoreSource(args.bucket, prefix, client=client)
+    try:
+        for i in range(args.objects):
+            if args.endpoint_url is not None:
+                client.put_object(Bucket=args.bucket, Key=prefix + "listing/file%d" % i, Body=b"x")
+            else: # without the simulated latency
+                client._store(prefix + "listing/file%d" % i, b"x", None)
+        start = time.perf_counter()
+        count = sum(1 for _ in source.walk())
+        elapsed = time.perf_counter() - start
+        print("walk: %d objects in %.3fs (%.0f objects/s)" % (count, elapsed, count / elapsed))
+
+        local_file = os.path.join(root, "large")
+        with open(local_file, "wb") as file_:
+            file_.write(os.urandom(args.size * 1000000))
+        for workers in [1, bisync_lib.OBJECT_STORE_WORKERS]:
+            source.workers = workers
+            start = time.perf_counter()
+            source.copy_to(local_file, "large%d" % workers)
+            elapsed = time.perf_counter() - start
+            print("upload, %d worker(s): %d MB in %.3fs (%.1f MB/s)" % (workers, args.size, elapsed,
+                args.size / elapsed))
+    finally:
+        source.delete_many([x[0] for x in source.walk()])
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
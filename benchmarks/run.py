@@ -0,0 +1,166 @@
+#! /usr/bin/python3
+
+"""
+Runs the benchmark suite on synthetic data and writes the results as JSON, to compare them across commits.
+
+    python3 benchmarks/run.py --sizes 10000 100000 1000000 --output results.json
+    python3 benchmarks/run.py --benchmarks plan merge --compare results.json
+
+The benchmarks are:
+- scan: listing of a generated tree of small files, full and incremental
+- index: save and load of an index
+- merge: merge of the histories of two replicas
+- plan: single pass planning of the synchronization of several replicas, without executing it
+- transfer: synchronization of a folder of files to an empty folder
+"""
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def bench_scan(nbr_files, args):
+    root = tempfile.mkdtemp()
+    try:
+        generators.generate_tree(root, nbr_files)
+        sync = bisync_lib.Synchronizer()
+        source = bisync_lib.FileSystemSource(root, walk_workers=args.walk_workers)
+        elapsed, index = measure(sync.build_current_index, source, {})
+        yield "scan", elapsed, {"files_per_second": len(index) / elapsed}
+        sync.incremental = True
+        source.index = {}
+        sync.build_index(source) # saves the state of the folders
+        elapsed, index = measure(sync.build_current_index, source, source.index)
+        yield "scan_incremental", elapsed, {"files_per_second": len(index) / elapsed}
+    finally:
+        shutil.rmtree(root)
+
+def bench_index(nbr_files, args):
+    root = tempfile.mkdtemp()
+    try:
+        source = bisync_lib.FileSystemSource(root)
+        source.index = generators.generate_replicas(1, nbr_files)[0]
+        sync = bisync_lib.Synchronizer()
+        elapsed, _ = measure(sync.save_index, source)
+        yield "index_save", elapsed, {"bytes": bisync_lib.index_size(root)}
+        elapsed, index = measure(sync.load_index, source)
+        yield "index_load", elapsed, {}
+        # a synchronization modifying a few files only rewrites their shards
+        source.index = index
+        for path in list(index.keys())[:10]:
+            index[path] = index[path].append(bisync_lib.make_version(1, 1))
+        elapsed, _ = measure(sync.save_index, source)
+        yield "index_save_modified", elapsed, {"shards": index.shards}
+    finally:
+        shutil.rmtree(root)
+
+def bench_merge(nbr_files, args):
+    replicas = generators.generate_replicas(2, nbr_files)
+    def merge():
+        for path, versions in replicas[0].items():
+            bisync_lib.merge_histories(versions, replicas[1].get(path, bisync_lib.EMPTY_HISTORY))
+    elapsed, _ = measure(merge)
+    yield "merge", elapsed, {}
+
+class PlanningSynchronizer(bisync_lib.Synchronizer):
+    def execute(self, operations):
+        self.operations = operations
+
+def bench_plan(nbr_files, args):
+    sources = [generators.MemorySource("r%d" % i, x)
+        for i, x in enumerate(generators.generate_replicas(args.replicas, nbr_files))]
+    sync = PlanningSynchronizer()
+    elapsed, _ = measure(sync.sync_all, sources)
+    yield "plan", elapsed, {"replicas": args.replicas, "operations": len(sync.operations)}
+
+def bench_transfer(nbr_files, args):
+    root = tempfile.mkdtemp()
+    try:
+        nbr_files = min(nbr_files, args.transfer_files)
+        folders = [os.path.join(root, "f1"), os.path.join(root, "f2")]
+        os.makedirs(folders[1])
+        generators.generate_tree(folders[0], nbr_files, args.transfer_size * 1000)
+        sync = bisync_lib.Synchronizer(jobs=args.jobs)
+        elapsed, _ = measure(sync.synchronize_all, [bisync_lib.FileSystemSource(x) for x in folders])
+        size = nbr_files * args.transfer_size * 1000
+        yield "transfer", elapsed, {"transferred_files": nbr_files, "bytes_per_second": size / elapsed}
+    finally:
+        shutil.rmtree(root)
+
+BENCHMARKS = {
+    "scan": bench_scan,
+    "index": bench_index,
+    "merge": bench_merge,
+    "plan": bench_plan,
+    "transfer": bench_transfer,
+}
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(
+            __file__)), stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Numbers of files")
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS.keys()),
+        default=["scan", "index", "merge", "plan", "transfer"])
+    parser.add_argument("--replicas", type=int, default=5, help="Number of replicas planned")
+    parser.add_argument("--walk-workers", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=4, help="Number of transfers at the same time")
+    parser.add_argument("--transfer-files", type=int, default=1000, help="Maximum number of files transferred")
+    parser.add_argument("--transfer-size", type=int, default=256, help="Size of the transferred files in kB")
+    parser.add_argument("--output", help="JSON file receiving the results, standard output by default")
+    parser.add_argument("--compare", help="JSON file of previous results to compare with")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as file_:
+            for result in json.load(file_)["results"]:
+                previous[(result["name"], result["files"])] = result["seconds"]
+
+    results = []
+    for nbr_files in args.sizes:
+        for name in args.benchmarks:
+            for result_name, elapsed, extra in BENCHMARKS[name](nbr_files, args):
+                result = dict(extra, name=result_name, files=nbr_files, seconds=elapsed)
+                results.append(result)
+                line = "%s, %d files: %.3fs" % (result_name, nbr_files, elapsed)
+                if (result_name, nbr_files) in previous:
+                    line += " (%.2fx)" % (elapsed / previous[(result_name, nbr_files)])
+                print(line, file=sys.stderr)
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as file_:
+            json.dump(report, file_, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#! /usr/bin/python3
+
+"""
+Compares the scandir based walker of FileSystemSource with the os.walk based implementation it replaced.
+
+    python3 benchmarks/walk.py --files 100000 --workers 1 4 16 --ignore "d1/"
+
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bisync_lib
+import generators
+
+def legacy_walk(root):
+    for folder in os.walk(root):
+        for file_ in folder[2]:
+            path = os.path.relpath(os.path.join(str(folder[0]), str(file_)), root)
+            stat = os.stat(os.path.join(root, path))
+            yield [path, stat.st_size, int(stat.st_mtime)]
+
+def measure(walk):
+    start = time.perf_counter()
+    count = 0
+    for _ in walk:
+        count += 1
+    return time.perf_counter() - start, count
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the folder walkers.")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--root", help="Existing folder to walk instead of a generated tree")
+    parser.add_argument("--ignore", nargs="+", help="Lines of a .bisyncignore file, to measure the walk" +
+        " skipping the ignored folders and the filter applied after a walk")
+    args = parser.parse_args()
+
+    root = args.root
+    if root is None:
+        root = tempfile.mkdtemp()
+        print("Generating %d files in %s" % (args.files, root))
+        generators.generate_tree(root, args.files)
+    try:
+        elapsed, count = measure(legacy_walk(root))
+        print("os.walk + os.stat: %d files in %.3fs" % (count, elapsed))
+        for workers in args.workers:
+            source = bisync_lib.FileSystemSource(root, walk_workers=workers)
+            elapsed, count = measure(source.walk())
+            print("scandir, %d worker(s): %d files in %.3fs" % (workers, count, elapsed))
+        source = bisync_lib.FileSystemSource(root)
+        folders = {}
+        known = {}
+        for file_ in source.walk_incremental(folders, {}):
+            known.setdefault(os.path.dirname(file_[0]), []).append(file_)
+        elapsed, count = measure(source.walk_incremental(folders, known))
+        print("incremental, no modified folder: %d files in %.3fs" % (count, elapsed))
+        if args.ignore is not None:
+            rules = bisync_lib.IgnoreRules(args.ignore)
+            elapsed, count = measure(x for x in source.walk() if not rules.ignored(x[0]))
+            print("filtered after the walk: %d files in %.3fs" % (count, elapsed))
+            source.set_ignore(args.ignore)
+            elapsed, count = measure(source.walk())
+            print("ignored folders skipped: %d files in %.3fs" % (count, elapsed))
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -20,26 +20,737 @@
 
 TODO:
  - add lock ?
- - add ignore ?
 
 """
 
 import argparse
+import collections
+import stat as stat_module
 import os
 import os.path
 import re
+import io
 import json
+import shlex
 import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import datetime
+import errno
+import hashlib
+import math
+import mmap
+import multiprocessing
+import time
+import zlib
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+try:
+    import boto3
+except ImportError: # only needed by ObjectStoreSource
+    boto3 = None
 
 BISYNC_FOLDER = ".bisync"
-BISYNC_INDEX = os.path.join(BISYNC_FOLDER, "index")
+BISYNC_INDEX = os.path.join(BISYNC_FOLDER, "index") # single index file, before the sharded index
+BISYNC_MANIFEST = os.path.join(BISYNC_FOLDER, "manifest")
+BISYNC_FOLDERS = os.path.join(BISYNC_FOLDER, "folders")
+BISYNC_HASHES = os.path.join(BISYNC_FOLDER, "hashes")
+BISYNC_JOURNAL = os.path.join(BISYNC_FOLDER, "journal")
+BISYNC_OBJECTS = os.path.join(BISYNC_FOLDER, "objects") # manifest of the objects of an object store
 BISYNC_SUFFIX = "~bisync"
 BISYNC_TRASH = "bisync_trash"
+BISYNC_IGNORE = ".bisyncignore"
+
+# Modification times of folders more recent than this are not trusted by incremental walks, this is the
+# resolution of the coarsest filesystems (FAT)
+FOLDER_MTIME_RESOLUTION_NS = 2 * 10 ** 9
+
+# Number of attempts to create a file in a folder that may be removed concurrently
+FOLDER_RETRIES = 5
+
+# Maximum number of files deleted or renamed by a single call to a source
+BATCH_SIZE = 1000
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+THROTTLED_CHUNK_SIZE = 256 * 1024 # smaller chunks are copied when the bytes per second are limited
+HASH_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.5 # seconds between two displays of the progress
+WATCH_POLL_INTERVAL = 30 # seconds between two walks of the sources which can't be watched
+WATCH_DEBOUNCE = 1 # seconds without modification before synchronizing them in watch mode
+WATCH_MAX_DELAY = 10 # seconds after which modifications are synchronized even if they continue
+WATCH_SAVE_INTERVAL = 60 # seconds between two saves of the indexes in watch mode
+# Estimations of the durations of the operations, when not measured by a previous synchronization
+ESTIMATED_BYTES_PER_SECOND = 50 * 1000 * 1000
+ESTIMATED_OPERATION_SECONDS = 0.002
+RATE_LIMIT_BURST = 1 # seconds of transfers which can be done at once after an idle period, with a rate limit
+RATE_LIMIT_RECHECK = 0.5 # maximum seconds between two checks of a rate limit, which may be changed
+LIMITS_POLL_INTERVAL = 5 # seconds between two checks of the modification of a limits file
+# Object stores (S3 API)
+OBJECT_LIST_PAGE_SIZE = 1000 # maximum keys of a listing request
+OBJECT_DELETE_BATCH = 1000 # maximum keys of a bulk delete request
+OBJECT_COPY_MAX_SIZE = 5 * 1024 ** 3 # larger objects are copied by parts
+MULTIPART_THRESHOLD = 16 * 1024 * 1024 # larger files are uploaded by parts
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+OBJECT_STORE_WORKERS = 8 # parts uploaded or copied at the same time
+FICLONE = 0x40049409 # Linux ioctl creating a copy on write clone of a file (btrfs, xfs, ...)
 
 bisync_exclude_re = re.compile(r"""(^\.bisync\/.*$)|(^.*\~bisync$)|(^bisync_trash\/.*$)""")
 
+# Version of a file: its size (-1 if it was deleted, -2 for the mark of a truncated history) and its time
+# of last modification (time of the deletion for a deleted file, 0 if unknown)
+VERSION = struct.Struct("<qq")
+DELETED_VERSION = VERSION.pack(-1, 0)
+TRUNCATED_VERSION = VERSION.pack(-2, 0)
+_DELETED_SIZE = DELETED_VERSION[:8]
+_LAST_VERSION = slice(-VERSION.size, None)
+_bytes_getitem = bytes.__getitem__
+
+def make_version(size, mtime):
+    """ Returns the packed version of an existing file. """
+    return VERSION.pack(int(size), int(mtime))
+
+def make_deleted_version(time_):
+    """ Returns the packed version of a file deleted at the given time. """
+    return VERSION.pack(-1, int(time_))
+
+class History(bytes):
+    """ Immutable list of the versions of a file, packed as VERSION structures. Items read as (True, size,
+    mtime) for an existing file or (False,) for a deleted one. key() returns the packed version, which is
+    hashable and cheaper to compare, the time of deletions being ignored by keys. """
+    __slots__ = ()
+
+    @classmethod
+    def from_list(cls, versions):
+        """ Creates an history from a list in the JSON format: [[True, size, mtime], [False], ...]. The time
+        of a deletion can be given as a second item, [None] is the mark of a truncated history. """
+        packed = []
+        for version in versions:
+            if version[0] == True:
+                packed.append(make_version(version[1], version[2]))
+            elif version[0] is None:
+                packed.append(TRUNCATED_VERSION)
+            else:
+                packed.append(make_deleted_version(version[1] if len(version) > 1 else 0))
+        return cls(b"".join(packed))
+
+    def to_list(self):
+        versions = []
+        for size, mtime in VERSION.iter_unpack(self):
+            if size >= 0:
+                versions.append([True, size, mtime])
+            elif size == -2:
+                versions.append([None])
+            else:
+                versions.append([False, mtime] if mtime != 0 else [False])
+        return versions
+
+    def key(self, i):
+        if i == -1:
+            version = _bytes_getitem(self, _LAST_VERSION)
+        else:
+            start = i * VERSION.size
+            version = _bytes_getitem(self, slice(start, (start + VERSION.size) or None))
+        # the sign bit of the size, little endian
+        return DELETED_VERSION if version[7] & 0x80 and version.startswith(_DELETED_SIZE) else version
+
+    def same_last_version(self, other):
+        """ Same as self.key(-1) == other.key(-1), faster: the last versions are compared directly, their
+        time being ignored only for deletions. """
+        last = _bytes_getitem(other, _LAST_VERSION)
+        return self.endswith(last) or (_bytes_getitem(self, -9) & last[7] & 0x80 != 0 and
+            self.key(-1) == other.key(-1))
+
+    def keys(self):
+        return [self.key(i) for i in range(len(self))]
+
+    def packed(self):
+        """ Returns the list of the packed versions, including the time of deletions. """
+        return [bytes.__getitem__(self, slice(x, x + VERSION.size))
+            for x in range(0, bytes.__len__(self), VERSION.size)]
+
+    def deleted_at(self, i):
+        """ Returns the time of a deletion, 0 if it is unknown. """
+        return VERSION.unpack_from(self, (i % len(self)) * VERSION.size)[1]
+
+    def truncated(self):
+        """ Returns True if the oldest versions of the history were removed. """
+        return self.startswith(TRUNCATED_VERSION)
+
+    def append(self, version):
+        """ Returns a new history with an additional packed version. """
+        return History(bytes.__add__(self, version))
+
+    def __len__(self):
+        return bytes.__len__(self) // VERSION.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            packed = self.packed()
+            return History(b"".join(packed[x] for x in range(*i.indices(len(packed)))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("History index out of range")
+        size, mtime = VERSION.unpack_from(self, i * VERSION.size)
+        return (True, size, mtime) if size >= 0 else (False,)
+
+    def __iter__(self):
+        for size, mtime in VERSION.iter_unpack(self):
+            yield (True, size, mtime) if size >= 0 else (False,)
+
+    def __add__(self, other):
+        return History(bytes.__add__(self, other))
+
+    def __repr__(self):
+        return "History(%r)" % self.to_list()
+
+EMPTY_HISTORY = History()
+
+def compact_history(versions, keep_versions=None, forget_before=None, now=None):
+    """ Applies a compaction policy to an history. Only the last keep_versions versions are kept, the
+    others being replaced by the mark of a truncated history. If the file was deleted before the time
+    forget_before, returns None to indicate that the file should be forgotten. Deletions whose time is
+    unknown are given the time now. """
+    packed = versions.packed()
+    if keep_versions is not None:
+        start = 1 if versions.truncated() else 0
+        if len(packed) - start > keep_versions:
+            packed = [TRUNCATED_VERSION] + packed[-keep_versions:]
+    if forget_before is not None and versions[-1][0] == False:
+        deleted_at = versions.deleted_at(-1)
+        if deleted_at == 0:
+            packed[-1] = make_deleted_version(now if now is not None else time.time())
+        elif deleted_at < forget_before:
+            return None
+    return History(b"".join(packed))
+
+def last_common_version(versions1, versions2):
+    """ Finds the last version of versions2 also present in versions1. Returns a tuple (i, j) containing
+    the position of that version in both histories, the last occurrence being used in versions1.
+    If there is no version in common, returns (len(versions1) - 1, -1). """
+    positions = dict((key, i) for i, key in enumerate(versions1.keys()))
+    keys2 = versions2.keys()
+    for j in range(len(keys2) - 1, -1, -1):
+        i = positions.get(keys2[j])
+        if i is not None:
+            return i, j
+    return len(versions1) - 1, -1
+
+def merge_histories(versions1, versions2):
+    """ Merges two histories, keeping the order of the versions in each of them. Between two versions in
+    common, the versions of versions2 come first, so in case of conflict the versions of versions1 end on
+    top of the result. """
+    if versions1 == versions2: # the most common case, once folders are synchronized
+        return versions1
+    keys1 = versions1.keys()
+    keys2 = versions2.keys()
+    packed1 = versions1.packed()
+    packed2 = versions2.packed()
+    positions = {}
+    for i, key in enumerate(keys1):
+        positions.setdefault(key, []).append(i)
+    # each version of versions2 is matched with its first occurrence in versions1 after the last match,
+    # since matches only move forward the position reached in each list of occurrences is kept
+    cursors = {}
+    last_common_i = -1
+    last_common_j = -1
+    n_versions = []
+    for j, key in enumerate(keys2):
+        occurrences = positions.get(key)
+        if occurrences is None:
+            continue
+        cursor = cursors.get(key, 0)
+        while cursor < len(occurrences) and occurrences[cursor] <= last_common_i:
+            cursor += 1
+        cursors[key] = cursor
+        if cursor == len(occurrences):
+            continue
+        i = occurrences[cursor]
+        n_versions += packed2[last_common_j + 1:j]
+        n_versions += packed1[last_common_i + 1:i]
+        n_versions.append(packed1[i])
+        last_common_i = i
+        last_common_j = j
+    n_versions += packed2[last_common_j + 1:]
+    n_versions += packed1[last_common_i + 1:]
+    if TRUNCATED_VERSION in n_versions[1:]:
+        # the other history goes further back, the result is only truncated if both were
+        n_versions = n_versions[:1] + [x for x in n_versions[1:] if x != TRUNCATED_VERSION]
+    return History(b"".join(n_versions))
+
+# Index file format, version 2:
+# - INDEX_MAGIC followed by the version number (unsigned byte)
+# - for each file, sorted by path: a record header (INDEX_RECORD), the end of the path which is not
+#   shared with the previous one (UTF-8) and the history of the file
+# - an empty record header with a tag of 0
+# Legacy indexes are JSON dictionaries, they are still read and are replaced at the next save.
+INDEX_MAGIC = b"bisync-index\n"
+INDEX_FORMAT = 2
+INDEX_RECORD = struct.Struct("<BHHI") # tag (1), length of the shared prefix, length of the suffix, versions
+
+def read_index(stream):
+    """ Reads an index from a binary file object. Returns an iterator of (path, versions) tuples, the
+    entries are read one at a time. """
+    head = stream.read(len(INDEX_MAGIC))
+    if head != INDEX_MAGIC:
+        # legacy JSON index
+        index = json.loads((head + stream.read()).decode("utf8"))
+        for path in list(index.keys()):
+            yield path, History.from_list(index.pop(path))
+        return
+    format_ = stream.read(1)
+    if format_ != bytes([INDEX_FORMAT]):
+        raise ValueError("Unsupported index format: %r" % format_)
+    previous = b""
+    while True:
+        tag, shared, length, nbr_versions = _read_struct(stream, INDEX_RECORD)
+        if tag == 0:
+            return
+        path = previous[:shared] + _read_exactly(stream, length)
+        previous = path
+        yield path.decode("utf8", "surrogateescape"), History(_read_exactly(stream, VERSION.size * nbr_versions))
+
+def _read_struct(stream, struct_):
+    return struct_.unpack(_read_exactly(stream, struct_.size))
+
+def _read_exactly(stream, size):
+    content = stream.read(size)
+    if len(content) != size:
+        raise ValueError("Truncated index")
+    return content
+
+def write_index(stream, index):
+    """ Writes an index to a binary file object. Only the record being written is kept in memory. """
+    stream.write(INDEX_MAGIC + bytes([INDEX_FORMAT]))
+    previous = b""
+    for path in sorted(index.keys()):
+        versions = index[path]
+        encoded = path.encode("utf8", "surrogateescape") # like os.fsencode()
+        shared = _shared_prefix(encoded, previous)
+        stream.write(b"".join([INDEX_RECORD.pack(1, shared, len(encoded) - shared, len(versions)),
+            encoded[shared:], versions]))
+        previous = encoded
+    stream.write(INDEX_RECORD.pack(0, 0, 0, 0))
+
+INDEX_SHARD_FILES = 2048 # files per shard of an index, on average
+
+def index_shard_path(generation, shard):
+    return os.path.join(BISYNC_FOLDER, "index.%d.%d" % (generation, shard))
+
+def hashes_shard_path(generation, shard):
+    return os.path.join(BISYNC_FOLDER, "hashes.%d.%d" % (generation, shard))
+
+def temporary_path(source, path):
+    """ Returns the path where a file replacing path is written before being renamed to it, path itself if
+    the source writes files at once. """
+    return path if source.atomic_writes else path + BISYNC_SUFFIX
+
+def read_hashes(stream):
+    """ Reads a shard of the hashes of a source, a JSON dictionary. Returns an iterator of (path, entry)
+    tuples. """
+    return json.loads(stream.read().decode("utf8")).items()
+
+def write_hashes(stream, entries):
+    stream.write(json.dumps(entries).encode("utf8"))
+
+def index_size(folder):
+    """ Returns the size in bytes of the index files of a local folder. """
+    folder = os.path.join(folder, BISYNC_FOLDER)
+    if not os.path.isdir(folder):
+        return 0
+    return sum(os.path.getsize(os.path.join(folder, x)) for x in os.listdir(folder) if x.startswith("index"))
+
+class Index(dict):
+    """ Index of a source, mapping the paths of its files to their History. It is saved in shards, the
+    shard of a path being given by its CRC, and records the shards modified since it was loaded or saved.
+    generation is incremented each time the number of shards changes, 0 if the index was never saved in
+    shards. """
+
+    def __init__(self, shards=1, generation=0):
+        super(Index, self).__init__()
+        self.shards = shards
+        self.generation = generation
+        self.dirty = set()
+
+    def shard(self, path):
+        return zlib.crc32(path.encode("utf8", "surrogateescape")) % self.shards
+
+    def load(self, entries):
+        """ Adds (path, versions) tuples read from a shard, without marking it as modified. """
+        for path, versions in entries:
+            dict.__setitem__(self, path, versions)
+
+    def __setitem__(self, path, versions):
+        # the histories of files already up to date are assigned again by each synchronization
+        if self.get(path) != versions:
+            self.dirty.add(self.shard(path))
+            super(Index, self).__setitem__(path, versions)
+
+    def __delitem__(self, path):
+        super(Index, self).__delitem__(path)
+        self.dirty.add(self.shard(path))
+
+    def pop(self, path, *default):
+        if path in self:
+            self.dirty.add(self.shard(path))
+        return super(Index, self).pop(path, *default)
+
+    def update(self, *args, **kwargs):
+        for path, versions in dict(*args, **kwargs).items():
+            self[path] = versions
+
+    def clear(self):
+        super(Index, self).clear()
+        self.dirty.update(range(self.shards))
+
+def _shared_prefix(a, b):
+    """ Returns the length of the common prefix of two bytes objects. """
+    length = min(len(a), len(b), 0xffff)
+    diff = int.from_bytes(a[:length], "big") ^ int.from_bytes(b[:length], "big")
+    return length - (diff.bit_length() + 7) // 8
+
+def copy_file(src, dst, resume=False, throttle=None):
+    """ Copies the content, permissions and times of a file. The fastest method supported by the system is
+    used: a copy on write clone, an in-kernel copy or a copy through a large buffer. If resume, dst must
+    exist and contain the beginning of src written by an interrupted copy, which is kept. The bytes copied
+    are consumed from throttle, a RateLimiter, except for a clone which doesn't copy them. """
+    with open(src, "rb") as file_src:
+        stat = os.fstat(file_src.fileno())
+        with open(dst, "r+b" if resume else "wb") as file_dst:
+            fd_src = file_src.fileno()
+            fd_dst = file_dst.fileno()
+            if resume:
+                offset = _resume_offset(os.fstat(fd_dst).st_size, stat.st_size)
+                os.ftruncate(fd_dst, offset)
+            else:
+                offset = _copy_clone(fd_src, fd_dst, 0)
+            for method in [_copy_range, _copy_sendfile, _copy_buffered]:
+                if offset is None:
+                    break
+                offset = method(fd_src, fd_dst, offset, throttle)
+            if os.fstat(fd_dst).st_size < stat.st_size:
+                raise OSError("%s was truncated during its copy" % src)
+            if os.chmod in os.supports_fd:
+                os.chmod(fd_dst, stat.st_mode & 0o7777)
+    if os.chmod not in os.supports_fd:
+        os.chmod(dst, stat.st_mode & 0o7777)
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def _resume_offset(copied, size):
+    # the last chunk written by an interrupted copy may be incomplete
+    return max(0, min(copied, size) - COPY_CHUNK_SIZE)
+
+# Each copy method copies from the offset given to the end of the file. It returns None once the file is
+# copied, or the offset reached if the method is not supported, so the next one can continue the copy. The
+# in-kernel copies may also stop before the end of the file on some filesystems, the next method continues.
+
+def _chunk_size(throttle):
+    return COPY_CHUNK_SIZE if throttle is None else THROTTLED_CHUNK_SIZE
+
+def _copy_clone(fd_src, fd_dst, offset, throttle=None):
+    if fcntl is None:
+        return offset
+    try:
+        fcntl.ioctl(fd_dst, FICLONE, fd_src)
+        return None
+    except OSError:
+        return offset
+
+def _copy_range(fd_src, fd_dst, offset, throttle=None):
+    if not hasattr(os, "copy_file_range"):
+        return offset
+    size = os.fstat(fd_src).st_size
+    try:
+        while True:
+            copied = os.copy_file_range(fd_src, fd_dst, _chunk_size(throttle), offset, offset)
+            if copied == 0:
+                return None if offset >= size else offset
+            offset += copied
+            if throttle is not None:
+                throttle.consume_bytes(copied)
+    except OSError: # not supported by the kernel or between those filesystems
+        return offset
+
+def _copy_sendfile(fd_src, fd_dst, offset, throttle=None):
+    if not hasattr(os, "sendfile"):
+        return offset
+    size = os.fstat(fd_src).st_size
+    try:
+        os.lseek(fd_dst, offset, os.SEEK_SET)
+        while True:
+            copied = os.sendfile(fd_dst, fd_src, offset, _chunk_size(throttle))
+            if copied == 0:
+                return None if offset >= size else offset
+            offset += copied
+            if throttle is not None:
+                throttle.consume_bytes(copied)
+    except OSError:
+        return offset
+
+def _copy_buffered(fd_src, fd_dst, offset, throttle=None):
+    os.lseek(fd_src, offset, os.SEEK_SET)
+    os.lseek(fd_dst, offset, os.SEEK_SET)
+    buffer_ = bytearray(_chunk_size(throttle))
+    view = memoryview(buffer_)
+    while True:
+        read = os.readv(fd_src, [buffer_]) if hasattr(os, "readv") else _read_into(fd_src, view)
+        if read == 0:
+            return None
+        written = 0
+        while written < read:
+            written += os.write(fd_dst, view[written:read])
+        if throttle is not None:
+            throttle.consume_bytes(read)
+
+def _read_into(fd, view):
+    content = os.read(fd, len(view))
+    view[:len(content)] = content
+    return len(content)
+
+# Delta transfers, like rsync: the destination sends the signatures of the blocks of its copy of a file,
+# a weak rolling checksum (Adler-32) and a strong hash, and receives the blocks found at any position of
+# the new file and the data between them.
+DELTA_MIN_SIZE = 1024 * 1024 # smaller files are copied
+DELTA_MIN_BLOCK = 2048
+DELTA_MAX_BLOCK = 128 * 1024
+ADLER_MODULO = 65521
+SIGNATURE = struct.Struct("<I16s") # weak checksum, strong hash
+
+def delta_block_size(size):
+    """ Returns the size of the blocks used for a file, about the square root of its size. """
+    return min(DELTA_MAX_BLOCK, max(DELTA_MIN_BLOCK, int(math.sqrt(size)) & ~7))
+
+def _strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def compute_signatures(path, block_size):
+    """ Returns the signatures of the blocks of a file, as a list of (weak checksum, strong hash). """
+    signatures = []
+    with open(path, "rb") as file_:
+        while True:
+            block = file_.read(block_size)
+            if len(block) == 0:
+                return signatures
+            signatures.append((zlib.adler32(block), _strong_hash(block)))
+
+class Delta(object):
+    """ Differences between a file and the blocks of another one. items is an iterator of numbers of blocks,
+    which are read from the other file, and of bytes objects containing new data. checksum is the strong
+    hash of the whole file, which is checked once it is rebuilt. """
+    def __init__(self, block_size, items, checksum, mtime_ns, mode):
+        self.block_size = block_size
+        self.items = items
+        self.checksum = checksum
+        self.mtime_ns = mtime_ns
+        self.mode = mode
+
+def compute_delta(local_file, signatures, block_size):
+    """ Returns the Delta between a local file and the blocks whose signatures are given. """
+    with open(local_file, "rb") as file_:
+        stat = os.fstat(file_.fileno())
+        hash_ = hashlib.blake2b(digest_size=16)
+        for chunk in iter(lambda: file_.read(COPY_CHUNK_SIZE), b""):
+            hash_.update(chunk)
+    return Delta(block_size, _delta_items(local_file, signatures, block_size), hash_.digest(),
+        stat.st_mtime_ns, stat.st_mode & 0o7777)
+
+def _delta_items(local_file, signatures, block_size):
+    blocks = {}
+    for i, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, i)
+    with open(local_file, "rb") as file_:
+        size = os.fstat(file_.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0 # start of the data not found in blocks
+            position = 0
+            weak = None
+            while position < size:
+                length = min(block_size, size - position)
+                if weak is None:
+                    weak = zlib.adler32(data[position:position + length])
+                strongs = blocks.get(weak)
+                block = strongs.get(_strong_hash(data[position:position + length])) if strongs else None
+                if block is not None:
+                    if start < position:
+                        yield data[start:position]
+                    yield block
+                    position += length
+                    start = position
+                    weak = None
+                    continue
+                if position + length == size:
+                    break
+                # the window moves forward by one byte
+                out = data[position]
+                a = ((weak & 0xffff) - out + data[position + length]) % ADLER_MODULO
+                b = ((weak >> 16) - length * out + a - 1) % ADLER_MODULO
+                weak = (b << 16) | a
+                position += 1
+                if position - start >= COPY_CHUNK_SIZE:
+                    yield data[start:position]
+                    start = position
+            if start < size:
+                yield data[start:size]
+
+def patch_file(base, delta, dst, throttle=None):
+    """ Writes the file described by a Delta to dst, taking its blocks from the file base. The bytes written
+    are consumed from throttle, a RateLimiter. """
+    hash_ = hashlib.blake2b(digest_size=16)
+    with open(base, "rb") as file_base:
+        with open(dst, "wb") as file_dst:
+            for item in delta.items:
+                if isinstance(item, int):
+                    file_base.seek(item * delta.block_size)
+                    item = file_base.read(delta.block_size)
+                hash_.update(item)
+                file_dst.write(item)
+                if throttle is not None:
+                    throttle.consume_bytes(len(item))
+    if hash_.digest() != delta.checksum:
+        raise ValueError("%s was modified during a delta transfer" % base)
+    os.chmod(dst, delta.mode)
+    os.utime(dst, ns=(delta.mtime_ns, delta.mtime_ns))
+
+def hash_file(path):
+    """ Returns the hash of the content of a file (hexadecimal), or None if it can't be read. """
+    hash_ = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as file_:
+            for chunk in iter(lambda: file_.read(HASH_CHUNK_SIZE), b""):
+                hash_.update(chunk)
+    except OSError:
+        return None
+    return hash_.hexdigest()
+
+def _glob_to_regex(pattern):
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i): # any number of folders, including none
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern): # everything inside a folder
+            regex.append("/.+")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        else:
+            c = pattern[i]
+            i += 1
+            end = pattern.find("]", i + 1) if c == "[" else -1 # a "]" just after "[" is part of the class
+            if c == "*":
+                regex.append("[^/]*")
+            elif c == "?":
+                regex.append("[^/]")
+            elif c == "\\" and i < len(pattern):
+                regex.append(re.escape(pattern[i]))
+                i += 1
+            elif end != -1:
+                content = pattern[i:end]
+                if content[:1] in ("!", "^"):
+                    content = "^" + content[1:]
+                regex.append("(?!/)[%s]" % content.replace("\\", "\\\\"))
+                i = end + 1
+            else:
+                regex.append(re.escape(c))
+    return "".join(regex)
+
+class IgnoreRules(object):
+    """ Paths excluded from the synchronization by the lines of a .bisyncignore file, in the format of
+    .gitignore files: glob patterns with *, ? and [...], ** matching any number of folders, a pattern
+    containing a slash is relative to the root folder, one ending with a slash only matches folders, and
+    ! negates a pattern. The last matching pattern wins, and the content of an ignored folder is ignored. """
+
+    def __init__(self, lines=()):
+        self.lines = list(lines)
+        # the consecutive patterns of the same kind are combined in a single regex, the groups are
+        # tested from the last one
+        groups = []
+        for line in self.lines:
+            line = line.rstrip("\r\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip(" ")
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            folder_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if line == "" or line.startswith("#"):
+                continue
+            regex = ("" if anchored else "(?:.*/)?") + _glob_to_regex(line) + ("/" if folder_only else "/?")
+            if len(groups) != 0 and groups[-1][0] == negated:
+                groups[-1][1].append(regex)
+            else:
+                groups.append((negated, [regex]))
+        self._groups = [(x, re.compile(r"(?:%s)\Z" % "|".join(y), re.DOTALL)) for x, y in reversed(groups)]
+        self._folders = {} # cache of ignored()
+
+    def __bool__(self):
+        return len(self._groups) != 0
+
+    def match(self, path, folder=False):
+        """ Returns True if a path is ignored by the patterns, without considering its parent folders. """
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        if folder:
+            path += "/"
+        for negated, regex in self._groups:
+            if regex.match(path):
+                return not negated
+        return False
+
+    def ignored(self, path, folder=False):
+        """ Returns True if a path or one of its parent folders is ignored. """
+        parent = os.path.dirname(path)
+        if parent != "":
+            result = self._folders.get(parent)
+            if result is None:
+                result = self._folders[parent] = self.ignored(parent, True)
+            if result:
+                return True
+        return self.match(path, folder)
+
+class _MemoryWriter(io.BytesIO):
+    """ Binary file object calling Source.write_memory() with its content when it is closed. """
+    def __init__(self, source, path):
+        super(_MemoryWriter, self).__init__()
+        self.source = source
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.source.write_memory(self.path, self.getvalue())
+        super(_MemoryWriter, self).close()
+
 class Source(object):
+    remote = False # True if the files are accessed through a network, local sources are preferred to copy from
+    hashes = None # hashes of the content of the files, set by Synchronizer.build_index() if they are compared
+    # path -> [size, mtime, mtime in the index] of the files whose content changed without their size and
+    # mtime, also set by Synchronizer.build_index() if the contents are hashed
+    aliases = None
+    ignore = None # IgnoreRules given to set_ignore()
+    # True if the files written by copy_to() and the streams of write_stream() only replace the previous ones
+    # once complete, so that they are written without a temporary file renamed to them
+    atomic_writes = False
+    # RateLimiter of the source, None if it is not limited. Its operations are limited by the Synchronizer,
+    # and its bytes by the source itself, in the methods writing files or reading them from a remote host.
+    throttle = None
+
     def get_name(self):
         """ Returns the string used to construct the source. """
         pass
@@ -49,9 +760,40 @@ class Source(object):
         - Path of the file relative to the root folder of the source
         - Size of the file in bytes (integer)
         - Time of last modification in unix format (integer)
+        The files ignored by the rules given to set_ignore() may be skipped.
         """
         pass
 
+    def walk_incremental(self, folders, known):
+        """ Same as walk(), but may skip the content of the folders that did not change since the previous
+        call. folders is a dictionary containing the state returned by the previous call (empty if unknown),
+        it must be replaced by the new state once the iteration is complete. Its content is specific to the
+        source but must be serializable in JSON. known is a dictionary mapping each folder to the list of
+        files it contained during the previous call, in the format returned by walk().
+        The default implementation ignores those arguments and calls walk().
+        """
+        return self.walk()
+
+    def list_folder(self, folder):
+        """ Lists a folder given relative to the root folder. Returns the files it contains, in the format
+        returned by walk(), and the relative paths of its subfolders. Returns None if it is not supported,
+        which is the default. """
+        return None
+
+    def set_ignore(self, lines):
+        """ Sets the rules, given as the lines of a .bisyncignore file, of the paths which may be skipped by
+        walk(). """
+        self.ignore = IgnoreRules(lines)
+
+    def ignores(self, path, folder=False):
+        """ Returns True if a path is ignored by the rules given to set_ignore(). """
+        return self.ignore is not None and self.ignore.ignored(path, folder)
+
+    def get_watcher(self):
+        """ Returns a watcher reporting the folders modified in the source, see PollingWatcher. The default
+        implementation returns a PollingWatcher. """
+        return PollingWatcher()
+
     def exists(self, path):
         """ Returns True if the file exists. """
         pass
@@ -65,6 +807,17 @@ class Source(object):
         all those folders must be implicitly created. """
         pass
 
+    def read_stream(self, path):
+        """ Returns a binary file object to read the content of the file. The default implementation
+        uses read_memory(). """
+        return io.BytesIO(self.read_memory(path))
+
+    def write_stream(self, path):
+        """ Returns a binary file object to write the content of a file, which must be complete once the file
+        object is closed. Folders are created like in write_memory(). The default implementation calls
+        write_memory() when the file object is closed. """
+        return _MemoryWriter(self, path)
+
     def copy_to(self, local_file, dest_file):
         """ Copy a local file (can be accessed using the filesystem) to a file on the source.
         If the file is contained in a folder or subfolder, all those folders must be implicitly created.
@@ -73,6 +826,47 @@ class Source(object):
         """
         pass
 
+    def resume_copy_to(self, local_file, dest_file):
+        """ Same as copy_to(), but dest_file contains the beginning of local_file, written by an interrupted
+        copy_to(), which is kept. Returns False if that is not possible, for example if dest_file does not
+        exist anymore, which is the default. """
+        return False
+
+    def append_memory(self, path, content):
+        """ Appends content (as a bytes object) to a file, which is created if it does not exist. Returns
+        False if it is not supported, which is the default. """
+        return False
+
+    def link_to(self, local_file, dest_file):
+        """ Same as copy_to(), but creates a hard link to the local file instead of copying it. Returns False
+        if that is not possible, for example if the files are not on the same filesystem. The default
+        implementation returns False. """
+        return False
+
+    def hash_files(self, paths, cache):
+        """ Returns a dictionary mapping the given paths to the hashes of the content of the files, computed
+        by hash_file(). cache is a dictionary containing the state returned by the previous call (empty if
+        unknown), which allows to only hash the files modified since. It must be replaced by the new state,
+        mapping each of the paths hashed to a list ending by its hash, whose other items are specific to the
+        source but must be serializable in JSON. Returns None if hashes are not supported, which is the
+        default. """
+        return None
+
+    def set_mtime(self, path, mtime):
+        """ Sets the time of last modification of a file. Returns False if it is not supported, which is
+        the default. """
+        return False
+
+    def get_signatures(self, path, block_size):
+        """ Returns the signatures of the blocks of a file, computed by compute_signatures(), to receive it
+        with apply_delta(). Returns None if delta transfers are not supported, which is the default. """
+        return None
+
+    def apply_delta(self, base_file, delta, dest_file):
+        """ Same as copy_to(), but the file is created from a Delta of the file base_file of the source,
+        whose signatures were given by get_signatures(). """
+        pass
+
     def rename(self, from_, to):
         """ Rename a file. If the destination file exists, overwrite it. If the destination file is
         in a folder that does not exists, that folder must be implicitly created. After file has been deleted,
@@ -84,21 +878,151 @@ class Source(object):
         After file has been deleted, if the containing folder is empty, the folder should be removed."""
         pass
 
+    def make_dirs(self, folders):
+        """ Creates folders, given relative to the root folder, and their parents. Since the other methods
+        create the folders implicitly, this is only an optimization and the default implementation does
+        nothing. """
+        pass
+
+    def delete_many(self, paths):
+        """ Same as delete() for several files. The empty folders may only be removed once all the files
+        are deleted. The default implementation calls delete() for each file. """
+        for path in paths:
+            self.delete(path)
+
+    def rename_many(self, renames):
+        """ Same as rename() for each (from_, to) pair of renames, in that order. The empty folders may only
+        be removed once all the files are renamed. The default implementation calls rename() for each
+        pair. """
+        for from_, to in renames:
+            self.rename(from_, to)
+
+    def get_local_name(self, path):
+        """ Returns the name of a local file (can be accessed using the filesystem) with the content and
+        the last modification time of a file of the source. """
+        pass
+
+    def release_local_name(self, path, local_file):
+        """ Called once the file returned by get_local_name() is not used anymore. The default
+        implementation does nothing. """
+        pass
+
+    def wait(self):
+        """ Waits until the modifications requested by the current thread are complete, and raises the error
+        of the first one which failed. Sources executing them asynchronously must implement it, the default
+        implementation does nothing. """
+        pass
+
+    def save_state(self):
+        """ Saves the state the source keeps about its files, with its index. The default implementation
+        does nothing. """
+        pass
+
+    def close(self):
+        """ Releases the resources used by the source. The default implementation does nothing. """
+        pass
+
 
 
 class FileSystemSource(Source):
-    def __init__(self, path):
+    def __init__(self, path, walk_workers=1, hash_workers=None):
         self.path = path
+        self.walk_workers = walk_workers
+        self.hash_workers = hash_workers if hash_workers is not None else os.cpu_count()
+        self._device = None
 
     def get_name(self):
         return self.path
 
     def walk(self):
-        for folder in os.walk(self.path):
-            for file_ in folder[2]:
-                path = os.path.relpath(os.path.join(str(folder[0]), str(file_)), self.path)
-                stat = os.stat(os.path.join(self.path, path))
-                yield [path, stat.st_size, int(stat.st_mtime)]
+        return self._walk(self.list_folder)
+
+    def walk_incremental(self, folders, known):
+        # The state of each folder is [mtime in ns, inode, names of the subfolders]. The modification
+        # time of a folder changes when a file is added, removed or renamed in it, so the files of a folder
+        # with the same state are taken from the previous walk instead of being listed and stat-ed again.
+        # Files modified in place without being replaced are not detected in those folders.
+        previous = dict(folders)
+        current = {}
+        # folders modified just before the walk could be modified again without any visible change
+        # of their modification time, so they will be listed again during the next walk
+        limit = time.time_ns() - FOLDER_MTIME_RESOLUTION_NS
+        def scan(folder):
+            try:
+                stat = os.stat(os.path.join(self.path, folder))
+            except OSError:
+                return [], []
+            state = previous.get(folder)
+            if state is not None and state[0] == stat.st_mtime_ns and state[1] == stat.st_ino:
+                current[folder] = state
+                prefix = folder + os.sep if folder else ""
+                return known.get(folder, []), [prefix + x for x in state[2]
+                    if not (self.ignore and self.ignore.match(prefix + x, True))]
+            files, subfolders = self.list_folder(folder)
+            if stat.st_mtime_ns < limit:
+                current[folder] = [stat.st_mtime_ns, stat.st_ino, [os.path.basename(x) for x in subfolders]]
+            return files, subfolders
+        for file_ in self._walk(scan):
+            yield file_
+        folders.clear()
+        folders.update(current)
+
+    def _walk(self, scan):
+        if self.walk_workers <= 1:
+            folders = [""]
+            while len(folders) != 0:
+                files, subfolders = scan(folders.pop())
+                for file_ in files:
+                    yield file_
+                folders += subfolders
+        else:
+            # each folder is listed by a worker thread, this is mostly useful on network filesystems
+            # where each listing has a high latency
+            with concurrent.futures.ThreadPoolExecutor(self.walk_workers) as executor:
+                pending = set([executor.submit(scan, "")])
+                while len(pending) != 0:
+                    done, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        files, subfolders = future.result()
+                        for folder in subfolders:
+                            pending.add(executor.submit(scan, folder))
+                        for file_ in files:
+                            yield file_
+
+    def list_folder(self, folder):
+        # symbolic links to folders are not followed, the ignored files and the files of bisync (index, trash,
+        # temporary files) are skipped before being stat-ed
+        ignore = self.ignore
+        files = []
+        subfolders = []
+        prefix = folder + os.sep if folder else ""
+        try:
+            entries = os.scandir(os.path.join(self.path, folder))
+        except FileNotFoundError:
+            return files, subfolders # removed during the walk
+        with entries:
+            for entry in entries:
+                try:
+                    path = prefix + entry.name
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not bisync_exclude_re.match(path + os.sep) and \
+                                not (ignore and ignore.match(path, True)):
+                            subfolders.append(path)
+                        continue
+                    if bisync_exclude_re.match(path) or (ignore and ignore.match(path)):
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue # broken link or file removed during the walk
+                files.append([path, stat.st_size, int(stat.st_mtime)])
+        return files, subfolders
+
+    def get_watcher(self):
+        try:
+            return InotifyWatcher(self.path, self.ignore)
+        except (OSError, AttributeError): # not Linux, or too many folders for the inotify limits
+            return PollingWatcher()
 
     def exists(self, path):
         return os.path.exists(os.path.join(self.path, path))
@@ -108,129 +1032,1812 @@ class FileSystemSource(Source):
             return file_.read()
 
     def write_memory(self, path, content):
-        self._ensure_dir(os.path.join(self.path, path))
-        with open(os.path.join(self.path, path), "wb") as file_:
+        with self._in_dir(path, open, os.path.join(self.path, path), "wb") as file_:
             return file_.write(content)
 
-    def _ensure_dir(self, path):
-        dir_ = os.path.dirname(path)
-        if not os.path.exists(dir_):
-            os.makedirs(dir_)
+    def read_stream(self, path):
+        return open(os.path.join(self.path, path), "rb")
+
+    def write_stream(self, path):
+        return self._in_dir(path, open, os.path.join(self.path, path), "wb")
+
+    def append_memory(self, path, content):
+        with self._in_dir(path, open, os.path.join(self.path, path), "ab") as file_:
+            file_.write(content)
+        return True
+
+    def _in_dir(self, path, function, *args):
+        """ Calls function, creating the folder containing path if it does not exist. Since empty folders are
+        removed after a rename or a delete, possibly by another thread, the call is retried if the folder
+        disappeared in the meantime. """
+        dir_ = os.path.dirname(os.path.join(self.path, path))
+        for i in range(FOLDER_RETRIES):
+            try:
+                return function(*args)
+            except FileNotFoundError:
+                if i == FOLDER_RETRIES - 1 or os.path.exists(dir_):
+                    raise
+            os.makedirs(dir_, exist_ok=True)
 
     def copy_to(self, local_file, dest_file):
-        self._ensure_dir(os.path.join(self.path, dest_file))
-        shutil.copy(local_file, os.path.join(self.path, dest_file))
-        stat = os.stat(local_file)
-        os.utime(os.path.join(self.path, dest_file), (stat.st_atime, stat.st_mtime))
+        self._in_dir(dest_file, copy_file, local_file, os.path.join(self.path, dest_file), False, self.throttle)
+
+    def resume_copy_to(self, local_file, dest_file):
+        full_path = os.path.join(self.path, dest_file)
+        try:
+            info = os.lstat(full_path)
+            if stat_module.S_ISDIR(info.st_mode):
+                return False
+            if not stat_module.S_ISREG(info.st_mode) or info.st_nlink > 1:
+                # a hard link created by link_to() shares the content of another file, which must not be
+                # modified: it is replaced by a new file
+                os.remove(full_path)
+                return False
+            copy_file(local_file, full_path, True, self.throttle)
+        except FileNotFoundError:
+            if not os.path.exists(local_file):
+                raise
+            return False
+        return True
+
+    def link_to(self, local_file, dest_file):
+        if self._device is None:
+            self._device = os.stat(self.path).st_dev
+        try:
+            if os.stat(local_file).st_dev != self._device:
+                return False
+            self._in_dir(dest_file, self._link, local_file, os.path.join(self.path, dest_file))
+        except OSError:
+            return False
+        return True
+
+    def hash_files(self, paths, cache):
+        # The state of each file is [size, mtime in ns, inode, hash], the files with the same size,
+        # modification time and inode are not hashed again.
+        previous = dict(cache)
+        current = {}
+        hashes = {}
+        modified = []
+        for path in paths:
+            try:
+                stat = os.stat(os.path.join(self.path, path))
+            except OSError:
+                continue
+            state = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            if previous.get(path, [])[:3] == state:
+                current[path] = previous[path]
+                hashes[path] = current[path][3]
+            else:
+                modified.append((path, state))
+        names = [os.path.join(self.path, x[0]) for x in modified]
+        if self.hash_workers <= 1 or len(modified) <= 1:
+            results = map(hash_file, names)
+        else:
+            # hashing is limited by the processor when the files are in the page cache, so it is spread
+            # over several processes. They are not forked, which is unsafe from the threads indexing the
+            # other sources.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            with concurrent.futures.ProcessPoolExecutor(self.hash_workers,
+                    mp_context=multiprocessing.get_context(method)) as executor:
+                results = list(executor.map(hash_file, names, chunksize=16))
+        for (path, state), hash_ in zip(modified, results):
+            if hash_ is not None:
+                current[path] = state + [hash_]
+                hashes[path] = hash_
+        cache.clear()
+        cache.update(current)
+        return hashes
+
+    def set_mtime(self, path, mtime):
+        os.utime(os.path.join(self.path, path), (mtime, mtime))
+        return True
+
+    def get_signatures(self, path, block_size):
+        return compute_signatures(os.path.join(self.path, path), block_size)
+
+    def apply_delta(self, base_file, delta, dest_file):
+        self._in_dir(dest_file, patch_file, os.path.join(self.path, base_file), delta,
+            os.path.join(self.path, dest_file), self.throttle)
+
+    def _link(self, src, dst):
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            os.remove(dst)
+            os.link(src, dst)
 
     def rename(self, from_, to):
-        self.delete(to)
-        self._ensure_dir(os.path.join(self.path, to))
-        shutil.move(os.path.join(self.path, from_), os.path.join(self.path, to))
+        self._in_dir(to, self._move, os.path.join(self.path, from_), os.path.join(self.path, to))
+        self._prune_folders([os.path.dirname(from_)])
+
+    def _move(self, src, dst):
         try:
-            os.removedirs(os.path.dirname(os.path.join(self.path, from_)))
-        except:
-            pass # do nothing
+            os.replace(src, dst) # only changes metadata, and overwrites the destination atomically
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(src, dst)
 
     def delete(self, path):
-        if os.path.exists(os.path.join(self.path, path)):
-            os.remove(os.path.join(self.path, path))
-        try:
-            os.removedirs(os.path.dirname(os.path.join(self.path, path)))
-        except:
-            pass # do nothing
+        self.delete_many([path])
+
+    def make_dirs(self, folders):
+        for folder in folders:
+            os.makedirs(os.path.join(self.path, folder), exist_ok=True)
+
+    def delete_many(self, paths):
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.path, path))
+            except FileNotFoundError:
+                pass
+        self._prune_folders(set(os.path.dirname(x) for x in paths))
+
+    def rename_many(self, renames):
+        self.make_dirs(set(os.path.dirname(to) for from_, to in renames) - {""})
+        for from_, to in renames:
+            self._in_dir(to, self._move, os.path.join(self.path, from_), os.path.join(self.path, to))
+        self._prune_folders(set(os.path.dirname(from_) for from_, to in renames))
+
+    def _prune_folders(self, folders):
+        """ Removes the empty folders among folders and their parents, except the root folder. The deepest
+        folders are tried first, so the parents are only tried once their subfolders are removed. """
+        removed = set()
+        for folder in sorted(folders, key=lambda x: x.count(os.sep), reverse=True):
+            while folder != "" and folder not in removed:
+                try:
+                    os.rmdir(os.path.join(self.path, folder))
+                except OSError:
+                    break # not empty
+                removed.add(folder)
+                folder = os.path.dirname(folder)
 
     def get_local_name(self, path):
         return os.path.join(self.path, path)
 
 class FileSystemSimulationSource(FileSystemSource):
+    """ Folder which is never modified, used to plan a synchronization. """
     def write_memory(self, path, content):
         pass
 
+    write_stream = Source.write_stream
+
+    def link_to(self, local_file, dest_file):
+        return False
+
+    def append_memory(self, path, content):
+        return True
+
     def copy_to(self, local_file, dest_file):
-        print("Copy %s to %s" % (local_file,
-            os.path.join(self.path, dest_file[0:- len(BISYNC_SUFFIX)])))
+        pass
+
+    def apply_delta(self, base_file, delta, dest_file):
+        pass
 
     def rename(self, from_, to):
         pass
 
+    def set_mtime(self, path, mtime):
+        return True
+
     def delete(self, path):
-        print("Delete %s" % os.path.join(self.path, path))
+        pass
+
+    def make_dirs(self, folders):
+        pass
+
+    def delete_many(self, paths):
+        pass
+
+    def rename_many(self, renames):
+        pass
+
+class PollingWatcher(object):
+    """ Watcher of a source which can't report its modifications. A watcher is polled with changes(), which
+    returns None if nothing changed since the previous call, or else the set of the folders whose content
+    may have changed. None in that set means that any file may have changed, and an empty set that only
+    the folders modified according to an incremental walk changed. This one returns an empty set every
+    interval seconds. """
+
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+        self._polled = time.monotonic()
+
+    def changes(self):
+        if time.monotonic() - self._polled < self.interval:
+            return None
+        self._polled = time.monotonic()
+        return set()
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """ Watcher of a local folder using inotify, available on Linux only. A watch is added on each
+    folder, and on the new folders as they are created or moved in. """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII") # watch descriptor, mask, cookie, length of the name following it
+
+    def __init__(self, path, ignore=None):
+        self.path = path
+        self.ignore = ignore
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.folders = {} # watch descriptor -> folder relative to path
+        try:
+            self.add_folder("")
+        except:
+            os.close(self.fd)
+            raise
+
+    def add_folder(self, folder):
+        """ Watches a folder and its subfolders, except the ignored ones. """
+        if folder != "" and self._ignored(folder):
+            return
+        for top, subfolders, _ in os.walk(os.path.join(self.path, folder)):
+            relative = os.path.relpath(top, self.path)
+            relative = "" if relative == "." else relative
+            subfolders[:] = [x for x in subfolders if not self._ignored(os.path.join(relative, x))]
+            wd = self._add_watch(self.fd, os.fsencode(top), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR): # removed in the meantime
+                    continue
+                raise OSError(error, os.strerror(error), top)
+            self.folders[wd] = relative
+
+    def _ignored(self, folder):
+        return bisync_exclude_re.match(folder + os.sep) or (self.ignore and self.ignore.ignored(folder, True))
+
+    def changes(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.IN_Q_OVERFLOW: # events were lost
+                    changed.add(None)
+                folder = self.folders.get(wd)
+                if folder is None:
+                    continue
+                if mask & self.IN_IGNORED: # the folder was removed
+                    del self.folders[wd]
+                    continue
+                changed.add(folder)
+                # the watches of moved folders follow them, adding them again gives their new paths
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_folder(os.path.join(folder, name))
+        return changed if len(changed) != 0 else None
+
+    def close(self):
+        os.close(self.fd)
+
+# Protocol between RemoteSource and the agent. Each message is a JSON header followed by data frames
+# terminated by an empty frame, a frame being its length (FRAME) followed by its content. Requests have
+# a header {"op": name, "args": [...], "group": id, "reset": bool}, the agent answers each of them, in
+# order, with a message whose header is {"result": ...} or {"error": message, "errno": code}. The data of
+# a walk are JSON lists of files. Once a request fails, the agent cancels the following requests of its
+# group (the requests of a client thread) until one with reset, sent once the error was reported to that
+# thread, so nothing is modified after an error before the operation which caused it knows about it.
+# If the data of a message can't be produced, it is terminated by an abort frame (length FRAME_ABORT)
+# followed by a frame containing the error, {"error": message, "errno": code}, instead of the empty frame.
+FRAME = struct.Struct(">I")
+FRAME_ABORT = 0xffffffff
+WALK_BATCH = 1000 # files per data frame of a walk
+DELTA_BLOCK = struct.Struct("<Q") # number of a block in a data frame of a delta, after b"b" (b"d" for data)
+MAX_PENDING_REQUESTS = 256 # requests sent without reading their reply, before the pipes are full
+
+def _write_message(stream, header, chunks=()):
+    """ Writes a message. Returns the error raised by chunks, in which case the message is aborted, or None
+    once all the data are written. """
+    header = json.dumps(header).encode("utf8")
+    stream.write(FRAME.pack(len(header)) + header)
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            error = json.dumps(_error_header(e)).encode("utf8")
+            stream.write(FRAME.pack(FRAME_ABORT) + FRAME.pack(len(error)) + error)
+            return e
+        if len(chunk) != 0:
+            stream.write(FRAME.pack(len(chunk)))
+            stream.write(chunk)
+    stream.write(FRAME.pack(0))
+    return None
+
+def _error_header(error):
+    return {"error": str(error), "errno": getattr(error, "errno", None)}
+
+def _header_error(header):
+    """ Returns the OSError described by an error header. """
+    if header["errno"] is not None:
+        return OSError(header["errno"], header["error"])
+    return OSError(header["error"])
+
+def _read_frame(stream):
+    """ Returns the content of a frame, or None at the end of the stream. Raises the error of an aborted
+    message. """
+    head = stream.read(FRAME.size)
+    if len(head) == 0:
+        return None
+    if len(head) != FRAME.size:
+        raise ConnectionError("Truncated message")
+    if FRAME.unpack(head)[0] == FRAME_ABORT:
+        error = _read_frame(stream)
+        if error is None:
+            raise ConnectionError("Truncated message")
+        raise _header_error(json.loads(error.decode("utf8")))
+    content = stream.read(FRAME.unpack(head)[0])
+    if len(content) != FRAME.unpack(head)[0]:
+        raise ConnectionError("Truncated message")
+    return content
+
+def _read_chunks(stream):
+    """ Returns an iterator of the data frames of a message. """
+    while True:
+        chunk = _read_frame(stream)
+        if chunk is None:
+            raise ConnectionError("Truncated message")
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def _read_file(path, offset=0, throttle=None):
+    """ Returns an iterator of the content of a file from offset. The file is opened by this function, so
+    the errors to open it are raised before a message is sent. """
+    file_ = open(path, "rb")
+    try:
+        file_.seek(offset)
+    except:
+        file_.close()
+        raise
+    return _file_chunks(file_, throttle)
+
+def _file_chunks(file_, throttle):
+    with file_:
+        while True:
+            chunk = file_.read(_chunk_size(throttle))
+            if len(chunk) == 0:
+                return
+            if throttle is not None:
+                throttle.consume_bytes(len(chunk))
+            yield chunk
+
+class Agent(object):
+    """ Executes the requests of a RemoteSource on a local folder. """
+    def __init__(self, source, input_, output):
+        self.source = source
+        self.input = input_
+        self.output = output
+        self.failed = set() # groups of the requests which failed
+
+    def serve(self):
+        """ Answers the requests until the end of the input. """
+        while True:
+            header = _read_frame(self.input)
+            if header is None:
+                return
+            request = json.loads(header.decode("utf8"))
+            chunks = _read_chunks(self.input)
+            # a failed request cancels the following requests of its group, until its error is reported
+            group = request["group"]
+            if request["reset"]:
+                self.failed.discard(group)
+            try:
+                if group in self.failed:
+                    raise OSError("Cancelled after the failure of a previous request")
+                result, data = getattr(self, "do_" + request["op"])(chunks, *request["args"])
+                reply = {"result": result}
+            except Exception as e:
+                reply, data = _error_header(e), ()
+            if "error" in reply:
+                self.failed.add(group)
+                _write_message(self.output, reply)
+            elif _write_message(self.output, reply, data) is not None:
+                self.failed.add(group) # the data of the reply failed, the message was aborted
+            try:
+                for _ in chunks: # the data of the request, if not used
+                    pass
+            except OSError: # aborted by the client
+                pass
+            self.output.flush()
+
+    def do_walk(self, chunks):
+        def data():
+            batch = []
+            for file_ in self.source.walk():
+                batch.append(file_)
+                if len(batch) == WALK_BATCH:
+                    yield json.dumps(batch).encode("utf8")
+                    batch = []
+            yield json.dumps(batch).encode("utf8")
+        return None, data()
+
+    def do_size(self, chunks, path):
+        full_path = os.path.join(self.source.path, path)
+        try:
+            info = os.lstat(full_path)
+        except FileNotFoundError:
+            return None, ()
+        if stat_module.S_ISDIR(info.st_mode):
+            return None, ()
+        if not stat_module.S_ISREG(info.st_mode) or info.st_nlink > 1:
+            # like FileSystemSource.resume_copy_to(), the content of a hard link must not be modified
+            os.remove(full_path)
+            return None, ()
+        return info.st_size, ()
+
+    def do_append(self, chunks, path):
+        self.source.append_memory(path, b"".join(chunks))
+        return None, ()
+
+    def do_ignore(self, chunks, lines):
+        self.source.set_ignore(lines)
+        return None, ()
+
+    def do_exists(self, chunks, path):
+        return self.source.exists(path), ()
+
+    def do_read(self, chunks, path):
+        stat = os.stat(os.path.join(self.source.path, path))
+        return [stat.st_mtime_ns, stat.st_mode & 0o7777], _read_file(os.path.join(self.source.path, path))
+
+    def do_write(self, chunks, path, mtime_ns=None, mode=None, offset=None):
+        full_path = os.path.join(self.source.path, path)
+        # with an offset, the beginning of the file is kept from a previous write
+        with self.source.write_stream(path) if offset is None else open(full_path, "r+b") as stream:
+            if offset is not None:
+                stream.truncate(offset)
+                stream.seek(offset)
+            for chunk in chunks:
+                stream.write(chunk)
+        if mode is not None:
+            os.chmod(full_path, mode)
+        if mtime_ns is not None:
+            os.utime(full_path, ns=(mtime_ns, mtime_ns))
+        return None, ()
+
+    def do_signatures(self, chunks, path, block_size):
+        signatures = self.source.get_signatures(path, block_size)
+        return None, [b"".join(SIGNATURE.pack(*x) for x in signatures)]
+
+    def do_patch(self, chunks, base_file, dest_file, block_size, checksum, mtime_ns, mode):
+        def items():
+            for chunk in chunks:
+                yield DELTA_BLOCK.unpack(chunk[1:])[0] if chunk[:1] == b"b" else chunk[1:]
+        delta = Delta(block_size, items(), bytes.fromhex(checksum), mtime_ns, mode)
+        self.source.apply_delta(base_file, delta, dest_file)
+        return None, ()
+
+    def do_hash(self, chunks):
+        paths, cache = json.loads(b"".join(chunks).decode("utf8"))
+        hashes = self.source.hash_files(paths, cache)
+        return None, [json.dumps([hashes, cache]).encode("utf8")]
+
+    def do_set_mtime(self, chunks, path, mtime):
+        self.source.set_mtime(path, mtime)
+        return None, ()
+
+    def do_rename(self, chunks, from_, to):
+        self.source.rename(from_, to)
+        return None, ()
+
+    def do_delete(self, chunks, path):
+        self.source.delete(path)
+        return None, ()
+
+    def do_make_dirs(self, chunks, folders):
+        self.source.make_dirs(folders)
+        return None, ()
+
+    def do_delete_many(self, chunks, paths):
+        self.source.delete_many(paths)
+        return None, ()
+
+    def do_rename_many(self, chunks, renames):
+        self.source.rename_many(renames)
+        return None, ()
+
+class RemoteSource(Source):
+    """ Folder accessed through an agent (bisync --agent FOLDER) started by a command, usually ssh. The
+    requests whose result is not needed (writes, renames and deletes) are sent without waiting for their
+    reply. The requests of each thread form a group: after a failure, the agent cancels the following
+    requests of the group, and the error is raised in that thread by its next request waiting for a
+    reply, by wait() or by close(). """
+    remote = True
+
+    def __init__(self, command, name=None):
+        self.command = command
+        self.name = name if name is not None else " ".join(command)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lock = threading.Lock() # requests and replies of a thread must not be interleaved
+        self._pending = collections.deque() # group of each request whose reply was not read, in order
+        self._errors = {} # first error of each group, not raised yet
+        self._reset = set() # groups whose error was raised, their failure is cleared by their next request
+
+    def get_name(self):
+        return self.name
+
+    def _send(self, op, args, chunks=()):
+        group = threading.get_ident()
+        error = _write_message(self._process.stdin, {"op": op, "args": args, "group": group,
+            "reset": group in self._reset}, chunks)
+        self._reset.discard(group)
+        if error is not None:
+            # the request is aborted and fails in the agent, its error is raised now instead of its reply
+            self._pending.append(None)
+            self._reset.add(group)
+            raise error
+        self._pending.append(group)
+
+    def _read_reply(self):
+        """ Reads the reply of the oldest pending request. Returns its result and an iterator of its data,
+        or raises its error. """
+        header = _read_frame(self._process.stdout)
+        if header is None:
+            raise ConnectionError("Connection to the agent of %s lost" % self.name)
+        group = self._pending.popleft()
+        header = json.loads(header.decode("utf8"))
+        if "error" in header:
+            for _ in _read_chunks(self._process.stdout):
+                pass
+            raise _header_error(header)
+        return header["result"], self._reply_data(group)
+
+    def _reply_data(self, group):
+        try:
+            for chunk in _read_chunks(self._process.stdout):
+                yield chunk
+        except ConnectionError:
+            raise
+        except OSError:
+            # the reply was aborted by the agent, which failed the group: the error is reported now
+            self._reset.add(group)
+            raise
+
+    def _drain(self, keep=0, group=None):
+        """ Reads the replies of the requests sent, except the last keep ones, or until there is no pending
+        request of group. The errors are kept for their group. """
+        self._process.stdin.flush()
+        while len(self._pending) > keep and (group is None or group in self._pending):
+            request_group = self._pending[0]
+            try:
+                result, data = self._read_reply()
+                for _ in data:
+                    pass
+            except ConnectionError:
+                raise
+            except OSError as e:
+                if request_group is not None: # None for the aborted requests, whose error was raised
+                    self._errors.setdefault(request_group, e)
+
+    def _raise_error(self, group):
+        error = self._errors.pop(group, None)
+        if error is not None:
+            self._reset.add(group)
+            raise error
+
+    def _request(self, op, args, chunks=()):
+        """ Sends a request and returns its result and an iterator of its data, which must be consumed
+        while holding the lock. """
+        group = threading.get_ident()
+        self._send(op, args, chunks)
+        self._drain(1)
+        if group in self._errors:
+            self._drain() # the reply of this request, cancelled by the agent
+            self._raise_error(group)
+        try:
+            return self._read_reply()
+        except ConnectionError:
+            raise
+        except OSError:
+            self._reset.add(group) # the error of this request is reported now
+            raise
+
+    def _call(self, op, args):
+        """ Same as _request(), for requests without data in their reply. """
+        with self._lock:
+            result, data = self._request(op, args)
+            for _ in data:
+                pass
+            return result
+
+    def _post(self, op, args, chunks=()):
+        with self._lock:
+            self._send(op, args, chunks)
+            if len(self._pending) > MAX_PENDING_REQUESTS:
+                self._drain()
+
+    def wait(self):
+        with self._lock:
+            group = threading.get_ident()
+            self._drain(group=group)
+            self._raise_error(group)
+
+    def walk(self):
+        with self._lock:
+            result, data = self._request("walk", [])
+            for chunk in data:
+                for file_ in json.loads(chunk.decode("utf8")):
+                    yield file_
+
+    def set_ignore(self, lines):
+        super(RemoteSource, self).set_ignore(lines)
+        self._call("ignore", [lines])
+
+    def exists(self, path):
+        return self._call("exists", [path])
+
+    def read_memory(self, path):
+        with self._lock:
+            result, data = self._request("read", [path])
+            return b"".join(data)
+
+    def write_memory(self, path, content):
+        self._post("write", [path], [content])
+
+    def copy_to(self, local_file, dest_file):
+        stat = os.stat(local_file)
+        self._post("write", [dest_file, stat.st_mtime_ns, stat.st_mode & 0o7777], _read_file(local_file, 0,
+            self.throttle))
+
+    def resume_copy_to(self, local_file, dest_file):
+        copied = self._call("size", [dest_file])
+        if copied is None:
+            return False
+        stat = os.stat(local_file)
+        offset = _resume_offset(copied, stat.st_size)
+        self._post("write", [dest_file, stat.st_mtime_ns, stat.st_mode & 0o7777, offset],
+            _read_file(local_file, offset, self.throttle))
+        return True
+
+    def append_memory(self, path, content):
+        self._post("append", [path], [content])
+        return True
+
+    def hash_files(self, paths, cache):
+        with self._lock:
+            result, data = self._request("hash", [], [json.dumps([paths, cache]).encode("utf8")])
+            hashes, n_cache = json.loads(b"".join(data).decode("utf8"))
+        cache.clear()
+        cache.update(n_cache)
+        return hashes
+
+    def set_mtime(self, path, mtime):
+        self._post("set_mtime", [path, mtime])
+        return True
+
+    def get_signatures(self, path, block_size):
+        with self._lock:
+            result, data = self._request("signatures", [path, block_size])
+            return list(SIGNATURE.iter_unpack(b"".join(data)))
+
+    def apply_delta(self, base_file, delta, dest_file):
+        def chunks():
+            for item in delta.items:
+                chunk = b"b" + DELTA_BLOCK.pack(item) if isinstance(item, int) else b"d" + item
+                if self.throttle is not None:
+                    self.throttle.consume_bytes(len(chunk))
+                yield chunk
+        self._post("patch", [base_file, dest_file, delta.block_size, delta.checksum.hex(), delta.mtime_ns,
+            delta.mode], chunks())
+
+    def rename(self, from_, to):
+        self._post("rename", [from_, to])
+
+    def delete(self, path):
+        self._post("delete", [path])
+
+    def make_dirs(self, folders):
+        self._post("make_dirs", [list(folders)])
+
+    def delete_many(self, paths):
+        self._post("delete_many", [list(paths)])
+
+    def rename_many(self, renames):
+        self._post("rename_many", [list(renames)])
+
+    def get_local_name(self, path):
+        # the file is downloaded to a temporary file
+        fd, local_file = tempfile.mkstemp(prefix="bisync")
+        try:
+            with os.fdopen(fd, "wb") as file_:
+                with self._lock:
+                    (mtime_ns, mode), data = self._request("read", [path])
+                    for chunk in data:
+                        file_.write(chunk)
+                        if self.throttle is not None:
+                            self.throttle.consume_bytes(len(chunk))
+            os.chmod(local_file, mode)
+            os.utime(local_file, ns=(mtime_ns, mtime_ns))
+        except:
+            os.remove(local_file)
+            raise
+        return local_file
+
+    def release_local_name(self, path, local_file):
+        os.remove(local_file)
+
+    def close(self):
+        with self._lock:
+            if self._process.stdin.closed:
+                return
+            try:
+                self._drain()
+            finally:
+                self._process.stdin.close()
+                self._process.wait()
+            for group in list(self._errors):
+                self._raise_error(group)
+
+def agent_main(argv):
+    parser = argparse.ArgumentParser(prog="bisync --agent", description="Serve a folder to bisync through" +
+        " the standard input and output, this command is started by bisync on remote hosts.")
+    parser.add_argument('folder', type=str, help='Folder to serve')
+    args = parser.parse_args(argv)
+    input_ = sys.stdin.buffer
+    output = sys.stdout.buffer
+    sys.stdout = sys.stderr # nothing else can be written to the output
+    Agent(FileSystemSource(args.folder), input_, output).serve()
+
+def _not_found(error):
+    """ Returns True if an error of an object store client means that the object does not exist. """
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+class ObjectStoreSource(Source):
+    """ Objects of a bucket of an object store with the S3 API, whose keys start with prefix. client is an
+    S3 client, created with boto3 if it is not given. The objects are listed by pages, without any request
+    per object: the sizes come from the listings, and the times of last modification of the files uploaded
+    by bisync from a manifest (BISYNC_OBJECTS) mapping their paths to their ETag, size and time in ns. The
+    manifest is saved with the index, and by close(). The objects modified by other programs get the time
+    of their upload. Large files are uploaded by parts, in parallel, and renames are copies done by the
+    object store. """
+    remote = True
+    atomic_writes = True # objects are created by a single request, or a multipart upload completed at once
+
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None, workers=OBJECT_STORE_WORKERS):
+        if client is None:
+            if boto3 is None:
+                raise ImportError("boto3 is required to access object stores")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") != "" else ""
+        self.client = client
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._objects = None # path -> [ETag, size, mtime in ns], loaded from the manifest
+        self._modified = False
+
+    def get_name(self):
+        return "s3://%s/%s" % (self.bucket, self.prefix)
+
+    def _key(self, path):
+        return self.prefix + path.replace(os.sep, "/")
+
+    def _load_manifest(self):
+        if self._objects is None:
+            try:
+                content = self.read_memory(BISYNC_OBJECTS)
+                self._objects = json.loads(content.decode("utf8"))["objects"]
+            except FileNotFoundError:
+                self._objects = {}
+
+    def _set_object(self, path, etag, size, mtime_ns):
+        with self._lock:
+            self._load_manifest()
+            self._objects[path] = [etag, size, mtime_ns]
+            self._modified = True
+
+    def _forget_objects(self, paths):
+        with self._lock:
+            self._load_manifest()
+            for path in paths:
+                if self._objects.pop(path, None) is not None:
+                    self._modified = True
+
+    def walk(self):
+        with self._lock:
+            self._load_manifest()
+            known = self._objects
+        objects = {}
+        token = None
+        while True:
+            kwargs = {"ContinuationToken": token} if token is not None else {}
+            page = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix,
+                MaxKeys=OBJECT_LIST_PAGE_SIZE, **kwargs)
+            for item in page.get("Contents", []):
+                path = item["Key"][len(self.prefix):].replace("/", os.sep)
+                if item["Key"].endswith("/") or bisync_exclude_re.match(path):
+                    continue
+                entry = known.get(path)
+                if entry is None or entry[0] != item["ETag"] or entry[1] != item["Size"]:
+                    entry = [item["ETag"], item["Size"], int(item["LastModified"].timestamp()) * 10 ** 9]
+                # the ignored objects stay in the manifest, in case they are not ignored anymore
+                objects[path] = entry
+                if not self.ignores(path):
+                    yield [path, entry[1], entry[2] // 10 ** 9]
+            if not page.get("IsTruncated"):
+                break
+            token = page["NextContinuationToken"]
+        with self._lock:
+            if objects != self._objects:
+                self._objects = objects
+                self._modified = True
+
+    def exists(self, path):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(path))
+        except Exception as e:
+            if _not_found(e):
+                return False
+            raise
+        return True
+
+    def _get_object(self, path):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(path))
+        except Exception as e:
+            if _not_found(e):
+                raise FileNotFoundError(errno.ENOENT, "No such object", self._key(path))
+            raise
+
+    def read_memory(self, path):
+        return self._get_object(path)["Body"].read()
+
+    def write_memory(self, path, content):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(path), Body=content)
+
+    def copy_to(self, local_file, dest_file):
+        stat = os.stat(local_file)
+        metadata = {"mtime": str(stat.st_mtime_ns)}
+        key = self._key(dest_file)
+        if stat.st_size <= MULTIPART_THRESHOLD:
+            with open(local_file, "rb") as file_:
+                content = file_.read()
+            if self.throttle is not None:
+                self.throttle.consume_bytes(len(content))
+            etag = self.client.put_object(Bucket=self.bucket, Key=key, Body=content, Metadata=metadata)["ETag"]
+        else:
+            def upload_part(upload_id, number, offset, size):
+                with open(local_file, "rb") as file_:
+                    file_.seek(offset)
+                    content = file_.read(size)
+                if self.throttle is not None:
+                    self.throttle.consume_bytes(len(content))
+                return self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=content)["ETag"]
+            etag = self._multipart(key, metadata, stat.st_size, upload_part)
+        self._set_object(dest_file, etag, stat.st_size, stat.st_mtime_ns)
+
+    def _multipart(self, key, metadata, size, upload_part):
+        """ Creates an object by parts, calling upload_part(upload_id, number, offset, size) in up to
+        self.workers threads to upload each one and return its ETag. Returns the ETag of the object. """
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key,
+            Metadata=metadata)["UploadId"]
+        try:
+            part_size = max(MULTIPART_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+            offsets = range(0, size, part_size)
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                etags = list(executor.map(lambda x: upload_part(upload_id, x[0] + 1, x[1],
+                    min(part_size, size - x[1])), enumerate(offsets)))
+            return self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={"Parts": [{"ETag": x, "PartNumber": i + 1} for i, x in enumerate(etags)]})["ETag"]
+        except:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def _copy_object(self, from_, to):
+        """ Copies an object in the object store, with its metadata. Returns its ETag and size. """
+        with self._lock:
+            self._load_manifest()
+            entry = self._objects.get(from_)
+        source = {"Bucket": self.bucket, "Key": self._key(from_)}
+        if entry is None or entry[1] > OBJECT_COPY_MAX_SIZE:
+            head = self.client.head_object(**source)
+            size, metadata = head["ContentLength"], head.get("Metadata", {})
+        else:
+            size, metadata = entry[1], None
+        if size <= OBJECT_COPY_MAX_SIZE:
+            result = self.client.copy_object(Bucket=self.bucket, Key=self._key(to), CopySource=source,
+                MetadataDirective="COPY")
+            return result["CopyObjectResult"]["ETag"], size
+        def copy_part(upload_id, number, offset, part_size):
+            return self.client.upload_part_copy(Bucket=self.bucket, Key=self._key(to), UploadId=upload_id,
+                PartNumber=number, CopySource=source, CopySourceRange="bytes=%d-%d" % (offset,
+                offset + part_size - 1))["CopyPartResult"]["ETag"]
+        return self._multipart(self._key(to), metadata, size, copy_part), size
+
+    def set_mtime(self, path, mtime):
+        with self._lock:
+            self._load_manifest()
+            entry = self._objects.get(path)
+        if entry is None or entry[1] > OBJECT_COPY_MAX_SIZE:
+            return False
+        # the metadata of an object can only be replaced by copying it on itself
+        result = self.client.copy_object(Bucket=self.bucket, Key=self._key(path), CopySource={"Bucket":
+            self.bucket, "Key": self._key(path)}, Metadata={"mtime": str(int(mtime) * 10 ** 9)},
+            MetadataDirective="REPLACE")
+        self._set_object(path, result["CopyObjectResult"]["ETag"], entry[1], int(mtime) * 10 ** 9)
+        return True
+
+    def rename(self, from_, to):
+        self.rename_many([(from_, to)])
+
+    def delete(self, path):
+        self.delete_many([path])
+
+    def delete_many(self, paths):
+        paths = list(paths)
+        for i in range(0, len(paths), OBJECT_DELETE_BATCH):
+            batch = paths[i:i + OBJECT_DELETE_BATCH]
+            result = self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": self._key(x)}
+                for x in batch], "Quiet": True})
+            if len(result.get("Errors", [])) != 0:
+                error = result["Errors"][0]
+                raise OSError("Can't delete %s: %s" % (error["Key"], error.get("Message", error.get("Code"))))
+        self._forget_objects(paths)
+
+    def rename_many(self, renames):
+        renames = list(renames)
+        # the copies are independent unless a file is renamed to a file renamed afterwards
+        if len(renames) > 1 and len(set(x for x, _ in renames) & set(x for _, x in renames)) == 0:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                list(executor.map(lambda x: self._rename_object(*x), renames))
+            self.delete_many([x for x, _ in renames])
+        else:
+            for from_, to in renames:
+                self._rename_object(from_, to)
+                self.delete_many([from_])
+
+    def _rename_object(self, from_, to):
+        """ Copies an object for a rename, the original object must be deleted afterwards. """
+        etag, size = self._copy_object(from_, to)
+        with self._lock:
+            self._load_manifest()
+            entry = self._objects.get(from_)
+        if entry is not None:
+            self._set_object(to, etag, size, entry[2])
+
+    def get_local_name(self, path):
+        # the object is downloaded to a temporary file
+        fd, local_file = tempfile.mkstemp(prefix="bisync")
+        try:
+            with os.fdopen(fd, "wb") as file_:
+                response = self._get_object(path)
+                while True:
+                    chunk = response["Body"].read(_chunk_size(self.throttle))
+                    if len(chunk) == 0:
+                        break
+                    file_.write(chunk)
+                    if self.throttle is not None:
+                        self.throttle.consume_bytes(len(chunk))
+            mtime_ns = response.get("Metadata", {}).get("mtime")
+            mtime_ns = int(mtime_ns) if mtime_ns is not None else \
+                int(response["LastModified"].timestamp()) * 10 ** 9
+            os.utime(local_file, ns=(mtime_ns, mtime_ns))
+        except:
+            os.remove(local_file)
+            raise
+        return local_file
+
+    def release_local_name(self, path, local_file):
+        os.remove(local_file)
+
+    def save_state(self):
+        with self._lock:
+            if not self._modified:
+                return
+            objects = dict((x, y) for x, y in self._objects.items() if not bisync_exclude_re.match(x))
+            self._modified = False
+        self.write_memory(BISYNC_OBJECTS, json.dumps({"objects": objects}).encode("utf8"))
+
+    def close(self):
+        self.save_state()
+
+class Operation(object):
+    """ Operation on a file of source_to, to update it with its version in source_from. """
+    COPY = "copy" # the file does not exist in source_to
+    REPLACE = "replace"
+    DELETE = "delete"
+    TRASH = "trash" # delete by moving the file to the trash folder
+    MOVE = "move" # copy done by renaming the file deleted by from_operation
+    TOUCH = "touch" # replace of a file with the same content, only its modification time is copied
+
+    def __init__(self, kind, source_from, source_to, path, from_operation=None, group=None):
+        self.kind = kind
+        self.source_from = source_from
+        self.source_to = source_to
+        self.path = path
+        self.from_operation = from_operation
+        self.group = group # the sources sharing the versions of source_from
+        self.conflict = False # True if the versions of the file were in conflict
+        # bytes transferred, the whole file for a delta transfer
+        self.size = source_from.index[path][-1][1] if kind in (self.COPY, self.REPLACE) else 0
+
+    def __repr__(self):
+        return "Operation(%r, %r, %r, %r)" % (self.kind, self.source_from.get_name(),
+            self.source_to.get_name(), self.path)
+
+    def describe(self):
+        """ Returns a description of the operation, on one line. """
+        if self.kind == self.MOVE:
+            line = "move %s to %s in %s" % (self.from_operation.path, self.path, self.source_to.get_name())
+        elif self.kind in (self.DELETE, self.TRASH):
+            line = "%s %s in %s" % (self.kind, self.path, self.source_to.get_name())
+        else:
+            line = "%s %s from %s to %s" % (self.kind, self.path, self.source_from.get_name(),
+                self.source_to.get_name())
+        if self.size != 0:
+            line += " (%.1f kB)" % (self.size / 1000.)
+        return line + (", conflict" if self.conflict else "")
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "from": self.source_from.get_name(),
+            "to": self.source_to.get_name(),
+            "path": self.path,
+            "moved_from": self.from_operation.path if self.from_operation is not None else None,
+            "bytes": self.size,
+            "conflict": self.conflict,
+        }
+
+class Plan(object):
+    """ Operations returned by Synchronizer.plan(), with an estimation of their duration. Each operation
+    takes operation_seconds, depending on its kind, plus the time to transfer its bytes at
+    bytes_per_second. jobs operations are executed at the same time, sharing the bandwidth. """
+
+    def __init__(self, operations, jobs=1):
+        self.operations = operations
+        self.jobs = jobs
+        self.bytes_per_second = ESTIMATED_BYTES_PER_SECOND
+        self.operation_seconds = {}
+
+    def calibrate(self, stats):
+        """ Uses the throughput and the latencies measured during a previous synchronization, given in the
+        format of Stats.to_dict(), for the estimations. """
+        bytes_per_second = stats.get("throughput", {}).get("transferred_bytes_per_second", 0)
+        if bytes_per_second > 0:
+            self.bytes_per_second = bytes_per_second
+        for kind, latency in stats.get("latencies", {}).items():
+            # the latencies of the copies mostly depend on the size of the files
+            if kind not in (Operation.COPY, Operation.REPLACE) and latency["count"] != 0:
+                self.operation_seconds[kind] = latency["total"] / latency["count"]
+
+    def estimate(self, operation):
+        """ Returns the estimated duration of an operation executed alone, in seconds. """
+        return self.operation_seconds.get(operation.kind, ESTIMATED_OPERATION_SECONDS) + \
+            operation.size / self.bytes_per_second
+
+    def summary(self):
+        kinds = {}
+        for x in self.operations:
+            kind = kinds.setdefault(x.kind, {"count": 0, "bytes": 0})
+            kind["count"] += 1
+            kind["bytes"] += x.size
+        size = sum(x.size for x in self.operations)
+        overhead = sum(self.operation_seconds.get(x.kind, ESTIMATED_OPERATION_SECONDS) for x in self.operations)
+        return {
+            "operations": len(self.operations),
+            "kinds": kinds,
+            "conflicts": len(set(x.path for x in self.operations if x.conflict)),
+            "bytes": size,
+            "estimated_seconds": size / self.bytes_per_second + overhead / max(1, self.jobs),
+        }
+
+    def describe(self):
+        """ Returns a summary of the plan, on several lines. """
+        summary = self.summary()
+        lines = []
+        for kind, values in sorted(summary["kinds"].items()):
+            lines.append("%s: %d file(s), %.1f MB" % (kind, values["count"], values["bytes"] / 1e6))
+        if summary["conflicts"] != 0:
+            lines.append("conflicts: %d file(s)" % summary["conflicts"])
+        lines.append("total: %d operation(s), %.1f MB, estimated duration %s" % (summary["operations"],
+            summary["bytes"] / 1e6, datetime.timedelta(seconds=round(summary["estimated_seconds"]))))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "summary": self.summary(),
+            "operations": [dict(x.to_dict(), estimated_seconds=self.estimate(x)) for x in self.operations],
+        }
+
+class Scheduler(object):
+    """ Order in which the operations of a Plan are executed. The files matching the first of the priorities,
+    patterns in the format of .bisyncignore files, come first, then the ones matching the second pattern,
+    and so on. Otherwise the order is given by order, one of ORDERS, "plan" keeping the order in which the
+    files were found. """
+    ORDERS = ["plan", "small-first", "newest-first"]
+
+    def __init__(self, order="plan", priorities=()):
+        if order not in self.ORDERS:
+            raise ValueError("Unknown order: %s" % order)
+        self.order = order
+        self.priorities = [IgnoreRules([x]) for x in priorities]
+
+    def schedule(self, operations):
+        """ Returns the operations sorted in the order they must be executed. """
+        if self.order == "plan" and len(self.priorities) == 0:
+            return operations
+        return sorted(operations, key=self.key)
+
+    def key(self, operation):
+        priority = len(self.priorities)
+        for i, rules in enumerate(self.priorities):
+            if rules.ignored(operation.path):
+                priority = i
+                break
+        if self.order == "small-first":
+            return priority, operation.size
+        elif self.order == "newest-first":
+            versions = operation.source_from.index[operation.path]
+            return priority, -(versions[-1][2] if versions[-1][0] else versions.deleted_at(-1))
+        return priority
+
+class RateLimiter(object):
+    """ Limits of the bytes and of the operations per second of a source, see Source.throttle. Each limit is
+    a token bucket holding up to RATE_LIMIT_BURST seconds of transfers, the consumers wait while it is in
+    debt. The limits, None if unlimited, can be changed at any time by set_limits(), the waiting consumers
+    use the new limits within RATE_LIMIT_RECHECK seconds. clock and sleep are the functions used to measure
+    and wait for the time. """
+    def __init__(self, bytes_per_second=None, operations_per_second=None, clock=time.monotonic,
+            sleep=time.sleep):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {"bytes": [None, 0., clock()], "operations": [None, 0., clock()]}
+        self.set_limits(bytes_per_second, operations_per_second)
+
+    def set_limits(self, bytes_per_second=None, operations_per_second=None):
+        with self._lock:
+            for name, rate in [("bytes", bytes_per_second), ("operations", operations_per_second)]:
+                bucket = self._buckets[name]
+                self._refill(bucket)
+                if rate is None:
+                    bucket[1] = 0.
+                elif bucket[0] is None: # a new limit starts with a full bucket
+                    bucket[1] = rate * RATE_LIMIT_BURST
+                else:
+                    bucket[1] = min(bucket[1], rate * RATE_LIMIT_BURST)
+                bucket[0] = rate
+
+    @property
+    def limits(self):
+        """ Bytes and operations per second. """
+        with self._lock:
+            return self._buckets["bytes"][0], self._buckets["operations"][0]
+
+    def consume_bytes(self, size):
+        self._consume(self._buckets["bytes"], size)
+
+    def consume_operations(self, count=1):
+        self._consume(self._buckets["operations"], count)
+
+    def _refill(self, bucket):
+        now = self._clock()
+        rate, tokens, last = bucket
+        if rate is not None:
+            bucket[1] = min(rate * RATE_LIMIT_BURST, tokens + (now - last) * rate)
+        bucket[2] = now
+
+    def _consume(self, bucket, amount):
+        with self._lock:
+            if bucket[0] is None:
+                return
+            self._refill(bucket)
+            bucket[1] -= amount
+        while True:
+            with self._lock:
+                self._refill(bucket)
+                if bucket[0] is None or bucket[1] >= 0:
+                    return
+                delay = -bucket[1] / bucket[0]
+            self._sleep(min(delay, RATE_LIMIT_RECHECK))
+
+class LimitsFile(object):
+    """ JSON file giving the limits of the sources: {"folder": {"bytes_per_second": x,
+    "operations_per_second": y}, ...}, the folders being given by sources, a dictionary mapping them to
+    their source. "*" gives the limits of the folders which are not listed. The file is read again by a
+    thread when it is modified, so the limits can be changed while synchronizing. """
+    def __init__(self, path, sources, interval=LIMITS_POLL_INTERVAL):
+        self.path = path
+        self.sources = sources
+        self.interval = interval
+        self._mtime = None
+        for x in sources.values():
+            x.throttle = RateLimiter()
+        self.reload()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def reload(self):
+        """ Applies the limits of the file if it was modified. Returns True if it was. """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        with open(self.path) as file_:
+            limits = json.load(file_)
+        for folder, source in self.sources.items():
+            source_limits = limits.get(folder, limits.get("*", {}))
+            source.throttle.set_limits(source_limits.get("bytes_per_second"),
+                source_limits.get("operations_per_second"))
+        self._mtime = mtime
+        return True
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.reload()
+            except (OSError, ValueError, AttributeError) as e: # the previous limits are kept
+                sys.stderr.write("Limits not updated from %s: %s\n" % (self.path, e))
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+class Stats(object):
+    """ Durations of the phases of the synchronizations, counters and latency histograms of the operations.
+    If progress, a text file object, is given, the current state is written to it regularly on a single
+    line. The methods can be called by several threads, a phase in progress in several threads at the same
+    time lasts from the first start to the last end. """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.phases = {} # total duration of each phase, in seconds
+        self.counters = {}
+        self.latencies = {}
+        self.current_phase = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._running = [] # phases in progress, in the order they were started
+        self._running_start = {} # time at which each phase in progress started
+        self._shown = self._start # time of the last display of the progress
+        self._width = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self._lock:
+            if name not in self._running:
+                self._running_start[name] = time.perf_counter()
+            self._running.append(name)
+            self.current_phase = name
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._running[len(self._running) - 1 - self._running[::-1].index(name)]
+                if name not in self._running:
+                    self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - \
+                        self._running_start.pop(name)
+                self.current_phase = self._running[-1] if len(self._running) != 0 else None
+            self.show()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.show()
+
+    def record(self, name, duration):
+        """ Adds the duration of an operation, in seconds, to its latency histogram. The buckets of the
+        histogram are powers of two of milliseconds. """
+        bucket = "%dms" % 2 ** max(0, math.ceil(math.log2(max(duration * 1000, 1))))
+        with self._lock:
+            latency = self.latencies.setdefault(name, {"count": 0, "total": 0., "max": 0., "histogram": {}})
+            latency["count"] += 1
+            latency["total"] += duration
+            latency["max"] = max(latency["max"], duration)
+            latency["histogram"][bucket] = latency["histogram"].get(bucket, 0) + 1
+        self.show()
+
+    def throughput(self, counter, phase):
+        """ Returns the number of units of a counter per second of a phase, during all the times it was
+        in progress. """
+        with self._lock:
+            duration = self.phases.get(phase, 0.)
+            if phase in self._running_start:
+                duration += time.perf_counter() - self._running_start[phase]
+            return self.counters.get(counter, 0) / duration if duration > 0 else 0.
+
+    def describe(self):
+        """ Returns a summary of the current state, on one line. """
+        parts = [self.current_phase or "done", "%d files scanned" % self.counters.get("scanned_files", 0)]
+        if "planned_operations" in self.counters:
+            parts.append("%d/%d operations" % (self.counters.get("done_operations", 0),
+                self.counters["planned_operations"]))
+        if "transferred_bytes" in self.counters:
+            parts.append("%.1f MB transferred (%.1f MB/s)" % (self.counters["transferred_bytes"] / 1e6,
+                self.throughput("transferred_bytes", "transfer") / 1e6))
+        return ", ".join(parts)
+
+    def show(self, force=False):
+        if self.progress is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self._shown < PROGRESS_INTERVAL:
+            return
+        self._shown = now
+        line = "%.1fs: %s" % (now - self._start, self.describe())
+        with self._lock:
+            self.progress.write("\r" + line.ljust(self._width))
+            self.progress.flush()
+            self._width = len(line)
+
+    def close(self):
+        """ Ends the progress display. """
+        if self.progress is not None:
+            self.show(True)
+            self.progress.write("\n")
+
+    def to_dict(self):
+        with self._lock:
+            result = {
+                "elapsed": time.perf_counter() - self._start,
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                "latencies": json.loads(json.dumps(self.latencies)),
+            }
+        result["throughput"] = {
+            "scanned_files_per_second": self.throughput("scanned_files", "walk"),
+            "transferred_bytes_per_second": self.throughput("transferred_bytes", "transfer"),
+        }
+        return result
+
+class SyncError(Exception):
+    """ Errors raised by several sources. errors is a list of (source, exception) tuples. """
+    def __init__(self, errors):
+        super(SyncError, self).__init__("\n".join("%s: %s" % (x.get_name(), e) for x, e in errors))
+        self.errors = errors
+
+class _FolderTree(object):
+    """ Paths of the existing files and of the subfolders of each folder of an index. """
+
+    def __init__(self, index):
+        self.files = {}
+        self.subfolders = {}
+        for path, versions in index.items():
+            if versions[-1][0] == True:
+                self.add_file(path)
+
+    def add_file(self, path):
+        folder = os.path.dirname(path)
+        self.files.setdefault(folder, set()).add(path)
+        while folder != "":
+            parent = os.path.dirname(folder)
+            subfolders = self.subfolders.setdefault(parent, set())
+            if folder in subfolders:
+                break
+            subfolders.add(folder)
+            folder = parent
+
+    def remove_folder(self, folder):
+        """ Removes a folder and returns the paths of the files it contained, recursively. """
+        paths = list(self.files.pop(folder, ()))
+        for subfolder in self.subfolders.pop(folder, ()):
+            paths += self.remove_folder(subfolder)
+        return paths
 
 class Synchronizer(object):
-    def __init__(self, no_trash=False):
+    def __init__(self, no_trash=False, incremental=False, full_scan=False, keep_versions=None,
+            forget_deleted=None, jobs=1, hardlink=False, detect_moves=True, delta=False, hash_contents=False,
+            stats=None, scheduler=None):
         self.no_trash = no_trash
+        self.incremental = incremental
+        self.full_scan = full_scan
+        self.keep_versions = keep_versions
+        self.forget_deleted = forget_deleted # in seconds
+        self.jobs = jobs
+        self.hardlink = hardlink
+        self.detect_moves = detect_moves
+        self.delta = delta
+        self.hash_contents = hash_contents
+        self.stats = stats if stats is not None else Stats()
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.trees = {} # _FolderTree of each source, in watch mode
+        # (source, path) -> version of the file whose copy to path + BISYNC_SUFFIX was interrupted
+        self.resumable = {}
+        self._journal_lock = threading.Lock()
+        self._journal_buffer = {} # records of the journal of each source, not appended yet
 
     def synchronize_all(self, folders):
-        for x in folders:
-            self.build_index(x)
-        for i in range(len(folders)):
-            for j in range(i, len(folders)):
-                self.sync(folders[i], folders[j])
-        for x in folders:
-            self.save_index(x)
+        self.for_each_source(self.build_index, folders)
+        self.sync_all(folders)
+        for source in folders:
+            # interrupted copies which were not resumed
+            paths = [x[1] for x in self.resumable if x[0] is source]
+            if len(paths) != 0:
+                source.delete_many([x + BISYNC_SUFFIX for x in paths])
+            for path in paths:
+                del self.resumable[(source, path)]
+        if self.keep_versions is not None or self.forget_deleted is not None:
+            with self.stats.phase("compact"):
+                for x in folders:
+                    self.compact_index(x)
+        self.for_each_source(self.save_index, folders)
+
+    def for_each_source(self, function, folders):
+        """ Calls function with each source, in a thread per source since the sources are usually on
+        different devices or hosts. Once all the calls are complete, the error raised by a source is raised
+        again, or a SyncError if several sources failed. """
+        if len(folders) <= 1:
+            for x in folders:
+                function(x)
+            return
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(len(folders)) as executor:
+            futures = [executor.submit(function, x) for x in folders]
+            for source, future in zip(folders, futures):
+                if future.exception() is not None:
+                    errors.append((source, future.exception()))
+        if len(errors) == 1:
+            raise errors[0][1]
+        elif len(errors) != 0:
+            raise SyncError(errors)
 
     def sync(self, f1, f2):
-        for file_ in f1.index:
-            if file_ not in f2.index: # file unknown to f2
-                self.transfer(f1, f2, file_)
+        self.sync_all([f1, f2])
+
+    def plan_all(self, folders):
+        """ Same as synchronize_all(), but returns the Plan of the operations instead of executing them.
+        The indexes are only updated in memory. """
+        def load(source):
+            self.load_ignore(source)
+            self.update_index(source, self.load_index(source))
+        self.for_each_source(load, folders)
+        return self.plan(folders)
+
+    def sync_all(self, folders, paths=None):
+        """ Synchronizes all the folders in a single pass over the union of their indexes, or over the
+        given paths only. Each path is updated at most once in each folder, from one of the folders
+        holding its last version. """
+        plan = self.plan(folders, paths)
+        with self.stats.phase("transfer"):
+            self.execute(plan.operations)
+
+    def plan(self, folders, paths=None):
+        """ Returns the Plan of the operations synchronizing the folders, see sync_all(). The confirmations
+        are asked, and the conflicts resolved, while planning. """
+        if paths is None:
+            paths = {}
+            for x in folders:
+                paths.update(dict.fromkeys(x.index))
+        operations = []
+        with self.stats.phase("plan"):
+            for path in paths:
+                operations += self.plan_path(folders, path)
+            if self.detect_moves:
+                operations = self.replace_moves(operations)
+            operations = self.scheduler.schedule(operations)
+        self.stats.count("planned_operations", len(operations))
+        return Plan(operations, self.jobs)
+
+    def plan_path(self, folders, path):
+        """ Finds the last version of a file among folders and returns the operations updating the
+        folders which don't have it. The folders already having it share their versions at once. """
+        if any(x.ignore for x in folders): # the folders ignoring the path keep their own files
+            folders = [x for x in folders if not x.ignores(path)]
+        holders = [x for x in folders if path in x.index]
+        if len(holders) == 0:
+            return []
+        winner = holders[0]
+        conflict = False
+        # the merge of the histories of the holders seen so far, with the versions of winner on top
+        versions1 = winner.index[path]
+        for other in holders[1:]:
+            versions2 = other.index[path]
+            # identical histories are the most common case and are compared at once, then the last versions
+            # like same_last_version(), inlined (the byte -9 holds the sign of the last size, negative for
+            # deletions)
+            if versions1 == versions2 or versions1.endswith(_bytes_getitem(versions2, _LAST_VERSION)) or \
+                    (_bytes_getitem(versions1, -9) & _bytes_getitem(versions2, -9) & 0x80 and
+                    versions1.key(-1) == versions2.key(-1)):
+                versions1 = merge_histories(versions1, versions2)
+                continue
+            i, j = last_common_version(versions1, versions2)
+            if j == -1 and (versions1.truncated() or versions2.truncated()):
+                # the common versions may have been removed by a compaction, this can't be told apart
+                # from a conflict
+                i = -1
+            if i == len(versions1) - 1: # file in other is newer
+                winner = other
+            elif j != len(versions2) - 1: # conflict
+                conflict = True
+                if self.same_content(winner, other, path): # no need to ask which one to keep
+                    result = Synchronizer.resolve_conflict(self, winner, other, path)
+                else:
+                    result = self.resolve_conflict(winner, other, path)
+                if result != 1:
+                    winner = other
+            if winner is other:
+                versions1 = merge_histories(versions2, versions1)
             else:
-                versions1 = f1.index[file_]
-                versions2 = f2.index[file_]
+                versions1 = merge_histories(versions1, versions2)
 
-                if versions1[-1] == versions2[-1]: # files are the same, nothing to transfer
-                    self.merge_versions(f1, f2, file_) # but we merge versions anyway
-                    continue
+        last = winner.index[path]
+        group = [x for x in holders if x.index[path].same_last_version(last)]
+        n_versions = group[0].index[path]
+        for x in group[1:]:
+            n_versions = merge_histories(n_versions, x.index[path])
+        for x in group:
+            x.index[path] = n_versions
 
-                # need to find last revision in common
-                i = len(versions1) - 1
-                j = len(versions2) - 1
-                while j >= 0:
-                    if versions1[i] == versions2[j]:
-                        break
-                    i -= 1
-                    if i == -1:
-                        i = len(versions1) - 1
-                        j -= 1
-
-                if i == len(versions1) - 1: # file in f1 is older
-                    self.transfer(f2, f1, file_)
-                elif j == len(versions2) - 1: # file in f2 is older
-                    self.transfer(f1, f2, file_)
-                else: # conflict
-                    result = self.resolve_conflict(f1, f2, file_)
-                    if result == 1:
-                        self.transfer(f1, f2, file_)
-                    else:
-                        self.transfer(f2, f1, file_)
-
-        for file_ in f2.index:
-            if file_ not in f1.index: # file unknown to f1
-                self.transfer(f2, f1, file_)
+        operations = []
+        for x in folders:
+            if x in group:
+                continue
+            source_from = self.select_source(list(group), x, path)
+            operation = self.plan_transfer(source_from, x, path, group)
+            if operation is not None:
+                operation.conflict = conflict
+                operations.append(operation)
+        return operations
+
+    def select_source(self, candidates, source_to, path):
+        """ Chooses the folder to copy a file from among candidates, which all have its last version. Local
+        folders are preferred to remote ones. """
+        for x in candidates:
+            if not x.remote:
+                return x
+        return candidates[0]
 
     def transfer(self, source_from, source_to, path):
+        operation = self.plan_transfer(source_from, source_to, path)
+        if operation is not None:
+            self.execute([operation])
+
+    def plan_transfer(self, source_from, source_to, path, group=None):
+        """ Asks the confirmation to update a file in source_to with its version in source_from. Returns the
+        Operation to execute, or None if there is nothing to do on the files. In that case the versions
+        of the file are merged immediately if the transfer was confirmed. group is the list of sources
+        sharing the versions of source_from, see merge_versions. """
         versions1 = source_from.index[path]
-        versions2 = source_to.index.get(path, [])
+        versions2 = source_to.index.get(path, EMPTY_HISTORY)
         if versions1[-1][0] == False: # file to delete
             if len(versions2) != 0 and versions2[-1][0] == True:
                 if not self.confirm_delete(source_from, source_to, path):
-                    return
-                if self.no_trash:
-                    source_to.delete(path)
-                else:
-                    source_to.rename(path, os.path.join(BISYNC_TRASH, path))
+                    return None
+                kind = Operation.DELETE if self.no_trash else Operation.TRASH
+                return Operation(kind, source_from, source_to, path, group=group)
+            self.merge_versions(source_from, source_to, path, group)
+            return None
         else: # file to copy
-            if len(versions2) == 0 or versions2[-1] == [False]:
+            if len(versions2) == 0 or versions2[-1][0] == False:
                 if not self.confirm_copy(source_from, source_to, path):
-                    return
+                    return None
+                return Operation(Operation.COPY, source_from, source_to, path, group=group)
             else:
+                if self.same_content(source_from, source_to, path):
+                    return Operation(Operation.TOUCH, source_from, source_to, path, group=group)
                 if not self.confirm_replace(source_from, source_to, path):
-                    return
-            tmp = path + BISYNC_SUFFIX
-            source_to.copy_to(source_from.get_local_name(path), tmp)
-            source_to.rename(tmp, path)
+                    return None
+                return Operation(Operation.REPLACE, source_from, source_to, path, group=group)
+
+    def same_content(self, source1, source2, path):
+        """ Returns True if the hashes of a file are known and identical in both sources. """
+        if source1.hashes is None or source2.hashes is None:
+            return False
+        hash_ = source1.hashes.get(path)
+        return hash_ is not None and hash_ == source2.hashes.get(path)
+
+    def replace_moves(self, operations):
+        """ Finds the files copied to a source while a file with the same size and modification time is
+        deleted in that source, which usually means that the file was moved, and replaces both operations
+        by a rename. When several deleted files match, only one with the same name is used. Since the
+        histories of both files are then merged as usual, other sources will detect the same move when
+        synchronized with this one. """
+        deleted = {}
+        deleted_by_name = {}
+        for operation in operations:
+            if operation.kind in (Operation.DELETE, Operation.TRASH):
+                key = (operation.source_to, operation.source_to.index[operation.path].key(-1))
+                deleted.setdefault(key, []).append(operation)
+                deleted_by_name.setdefault(key + (os.path.basename(operation.path),), []).append(operation)
+        if len(deleted) == 0:
+            return operations
+        moves = {}
+        used = set()
+        for operation in operations:
+            if operation.kind != Operation.COPY:
+                continue
+            key = (operation.source_to, operation.source_from.index[operation.path].key(-1))
+            same_name = [x for x in deleted_by_name.get(key + (os.path.basename(operation.path),), [])
+                if x not in used]
+            if len(same_name) != 0:
+                candidate = same_name[0]
+            elif len(deleted.get(key, [])) == 1 and deleted[key][0] not in used:
+                candidate = deleted[key][0]
+            else:
+                continue
+            used.add(candidate)
+            moves[operation] = Operation(Operation.MOVE, operation.source_from, operation.source_to,
+                operation.path, candidate, operation.group)
+            moves[operation].conflict = operation.conflict
+        return [moves.get(x, x) for x in operations if x not in used]
+
+    def execute(self, operations):
+        """ Executes operations, using up to self.jobs threads. The versions of a file are merged once its
+        operation succeeded. If some operations failed, the first error is raised after all the other
+        operations are completed. The deletions and the renames are executed in batches, see
+        batch_operations(), a batch failing as a whole. """
+        self.create_folders(operations)
+        batches = self.batch_operations(operations)
+        errors = []
+        failed = 0
+        if self.jobs <= 1 or len(batches) <= 1:
+            for batch in batches:
+                try:
+                    self.timed_batch(batch)
+                except Exception as e:
+                    errors.append(e)
+                    failed += len(batch)
+                    continue
+                self.batch_done(batch)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+                futures = dict((executor.submit(self.timed_batch, x), x) for x in batches)
+                # the indexes are only modified by this thread
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                        failed += len(futures[future])
+                        continue
+                    self.batch_done(futures[future])
+        if len(errors) != 0:
+            self.stats.count("failed_operations", failed)
+            raise errors[0]
+
+    def batch_done(self, batch):
+        for operation in batch:
+            self.operation_done(operation)
+        # the records of the whole batch are appended at once
+        self.flush_journal(batch[0].source_to)
+
+    def create_folders(self, operations):
+        """ Creates the folders receiving copied files in each source with a single call, when there are
+        several copies. """
+        folders = {}
+        for operation in operations:
+            if operation.kind == Operation.COPY:
+                folders.setdefault(operation.source_to, []).append(os.path.dirname(operation.path))
+        for source, x in folders.items():
+            if len(x) > 1:
+                source.make_dirs(sorted(set(x) - {""}))
+
+    def batch_operations(self, operations):
+        """ Groups the deletions, and the renames (moves and trashed files), of each source in batches of up
+        to BATCH_SIZE operations, executed by a single call to delete_many() or rename_many(). Returns the
+        list of the batches, the other operations being alone in their batch. """
+        batches = []
+        current = {} # batch being filled for each source and kind of call
+        for operation in operations:
+            if operation.kind == Operation.DELETE:
+                key = (operation.source_to, Operation.DELETE)
+            elif operation.kind in (Operation.TRASH, Operation.MOVE):
+                key = (operation.source_to, Operation.MOVE)
+            else:
+                batches.append([operation])
+                continue
+            batch = current.get(key)
+            if batch is None or len(batch) == BATCH_SIZE:
+                batch = current[key] = []
+                batches.append(batch)
+            batch.append(operation)
+        return batches
+
+    def timed_batch(self, batch):
+        """ Executes a batch of operations returned by batch_operations(). The duration of a batch is
+        recorded as the same latency for each of its operations, including the time spent waiting for the
+        limit of operations per second of the source. """
+        start = time.perf_counter()
+        if batch[0].source_to.throttle is not None:
+            batch[0].source_to.throttle.consume_operations(len(batch))
+        if len(batch) == 1:
+            self.execute_operation(batch[0])
+        elif batch[0].kind == Operation.DELETE:
+            batch[0].source_to.delete_many([x.path for x in batch])
+        else:
+            batch[0].source_to.rename_many([self.rename_paths(x) for x in batch])
+        # the operations are only merged once they are complete
+        batch[0].source_to.wait()
+        duration = (time.perf_counter() - start) / len(batch)
+        for operation in batch:
+            self.stats.record(operation.kind, duration)
+
+    def rename_paths(self, operation):
+        """ Returns the paths renamed by a TRASH or MOVE operation. """
+        if operation.kind == Operation.TRASH:
+            return operation.path, os.path.join(BISYNC_TRASH, operation.path)
+        return operation.from_operation.path, operation.path
 
-        self.merge_versions(source_from, source_to, path)
+    def operation_done(self, operation):
+        self.stats.count("done_operations")
+        self.stats.count(operation.kind + "_operations")
+        if operation.size != 0:
+            self.stats.count("transferred_bytes", operation.size)
+        self.merge_operation(operation)
+
+    def merge_operation(self, operation):
+        self.merge_versions(operation.source_from, operation.source_to, operation.path, operation.group)
+        self.journal(operation.source_to, {"done": operation.path,
+            "versions": operation.source_to.index[operation.path].hex()})
+        if operation.from_operation is not None:
+            self.merge_operation(operation.from_operation)
+
+    def execute_operation(self, operation):
+        source_to = operation.source_to
+        path = operation.path
+        if operation.kind == Operation.DELETE:
+            source_to.delete(path)
+        elif operation.kind in (Operation.TRASH, Operation.MOVE):
+            source_to.rename(*self.rename_paths(operation))
+        elif operation.kind == Operation.TOUCH and source_to.set_mtime(path,
+                operation.source_from.index[path][-1][2]):
+            pass
+        else:
+            tmp = temporary_path(source_to, path)
+            version = operation.source_from.index[path].key(-1)
+            resume = self.resumable.pop((source_to, path), None) == version
+            if tmp != path:
+                self.journal(source_to, {"planned": path, "version": version.hex()}, True)
+            local_file = operation.source_from.get_local_name(path)
+            try:
+                # the time of the index differs from the one of the file if its content changed without it
+                mtime = operation.source_from.index[path][-1][2]
+                aliased = operation.source_from.aliases is not None and \
+                    operation.source_from.aliases.get(path, [None])[-1] == mtime
+                if self.hardlink and not aliased and source_to.link_to(local_file, tmp):
+                    pass
+                elif resume and source_to.resume_copy_to(local_file, tmp):
+                    pass
+                elif not (operation.kind in (Operation.REPLACE, Operation.TOUCH) and
+                        self.send_delta(operation, local_file, tmp)):
+                    source_to.copy_to(local_file, tmp)
+                if aliased:
+                    source_to.set_mtime(tmp, mtime)
+            finally:
+                operation.source_from.release_local_name(path, local_file)
+            if tmp != path:
+                source_to.rename(tmp, path)
+
+    def send_delta(self, operation, local_file, tmp):
+        """ Sends only the differences between local_file and the file replaced by operation, if delta
+        transfers are enabled. This is only done for remote folders, and large files. Returns False if the
+        file must be copied. """
+        source_to = operation.source_to
+        size = source_to.index[operation.path][-1][1]
+        if not self.delta or not source_to.remote or os.path.getsize(local_file) < DELTA_MIN_SIZE:
+            return False
+        block_size = delta_block_size(size)
+        signatures = source_to.get_signatures(operation.path, block_size)
+        if signatures is None:
+            return False
+        source_to.apply_delta(operation.path, compute_delta(local_file, signatures, block_size), tmp)
+        return True
 
     def confirm_copy(self, source_from, source_to, path):
         return True
@@ -241,34 +2848,36 @@ class Synchronizer(object):
     def confirm_replace(self, source_from, source_to, path):
         return True
 
-    def merge_versions(self, source_from, source_to, path):
+    def merge_versions(self, source_from, source_to, path, group=None):
         # in case of conflict, versions on top of source_from
         # will appear on top of the resulting list
-        versions1 = source_from.index[path]
-        versions2 = source_to.index.get(path, [])
-        last_common_i = -1
-        last_common_j = -1
-        i = 0
-        j = 0
-        n_versions = []
-        while i < len(versions1) and j < len(versions2):
-            if versions1[i] == versions2[j]:
-                n_versions += versions2[last_common_j + 1:j]
-                n_versions += versions1[last_common_i + 1:i]
-                n_versions.append(versions1[i])
-                last_common_i = i
-                last_common_j = j
-                i += 1
-                j += 1
-                continue
-            i += 1
-            if i == len(versions1):
-                i = last_common_i + 1
-                j += 1
-        n_versions += versions2[last_common_j + 1:]
-        n_versions += versions1[last_common_i + 1:]
-        source_from.index[path] = n_versions
-        source_to.index[path] = [] + n_versions
+        n_versions = merge_histories(source_from.index[path], source_to.index.get(path, EMPTY_HISTORY))
+        if group is None:
+            group = [source_from]
+        # all the sources already up to date get the new versions, and source_to joins them
+        for x in group:
+            x.index[path] = n_versions
+        source_to.index[path] = n_versions
+        group.append(source_to)
+
+    def compact_index(self, source):
+        """ Applies the compaction policy of the synchronizer to the index of a source. Returns the number
+        of versions removed and the number of deleted files forgotten. """
+        now = time.time()
+        forget_before = now - self.forget_deleted if self.forget_deleted is not None else None
+        removed = 0
+        forgotten = 0
+        for path in list(source.index.keys()):
+            versions = source.index[path]
+            n_versions = compact_history(versions, self.keep_versions, forget_before, now)
+            if n_versions is None:
+                del source.index[path]
+                forgotten += 1
+            elif n_versions != versions:
+                # the mark of a truncated history is not a version
+                removed += (len(versions) - versions.truncated()) - (len(n_versions) - n_versions.truncated())
+                source.index[path] = n_versions
+        return removed, forgotten
 
     def resolve_conflict(self, f1, f2, file_):
         # automatic conflict resolution, takes the last modified file
@@ -284,49 +2893,366 @@ class Synchronizer(object):
             return 2
 
     def build_index(self, source):
-        c_index = self.build_current_index(source)
-        p_index = {}
-        if source.exists(BISYNC_INDEX):
-            content = source.read_memory(BISYNC_INDEX)
-            p_index = json.loads(content.decode("utf8"))
-        
+        self.load_ignore(source)
+        self.update_index(source, self.load_index(source))
+        self.save_index(source)
+
+    def load_ignore(self, source):
+        lines = []
+        if source.exists(BISYNC_IGNORE):
+            lines = source.read_memory(BISYNC_IGNORE).decode("utf8").splitlines()
+        source.set_ignore(lines)
+
+    def update_index(self, source, p_index):
+        """ Updates an index with the current files of a source and sets it as the index of the source.
+        Returns the paths whose versions changed. """
+        changed = set()
+        with self.stats.phase("walk"):
+            c_index = self.build_current_index(source, p_index)
+        if source.ignore:
+            # the ignored files are forgotten, rather than deleted from the other folders
+            for index in (p_index, c_index):
+                for file_ in [x for x in index if source.ignores(x)]:
+                    del index[file_]
+        if self.hash_contents:
+            with self.stats.phase("hash"):
+                self.hash_current_index(source, p_index, c_index)
+        elif source.exists(BISYNC_HASHES): # would be outdated for the next synchronization with hashes
+            self.delete_shards(source, BISYNC_HASHES, hashes_shard_path)
+
         for file_ in list(p_index.keys()):
             if file_ not in c_index and p_index[file_][-1][0] == True: # file was deleted
-                p_index[file_].append([False])
+                p_index[file_] = p_index[file_].append(make_deleted_version(time.time()))
+                changed.add(file_)
 
         for file_ in list(c_index.keys()):
-            if file_ not in p_index: # new file
-                p_index[file_] = [[True] + c_index[file_]]
-            else:
-                last = p_index[file_][-1]
-                if last[1:] != c_index[file_]: # file was modified or re-created
-                    p_index[file_].append([True] + c_index[file_])
+            if self._update_version(p_index, file_, *c_index[file_]):
+                changed.add(file_)
 
         source.index = p_index
+        return changed
 
-        self.save_index(source)
+    def _update_version(self, index, path, size, mtime):
+        version = make_version(size, mtime)
+        if path not in index: # new file
+            index[path] = History(version)
+        elif index[path].key(-1) != version: # file was modified or re-created
+            index[path] = index[path].append(version)
+        else:
+            return False
+        return True
+
+    def rescan_folders(self, source, folders):
+        """ Updates the index of a source from new listings of the given folders, the new subfolders being
+        listed recursively, and returns the paths whose versions changed. The files and subfolders of each
+        folder are kept between the calls in a _FolderTree. """
+        tree = self.trees.get(source)
+        if tree is None:
+            tree = self.trees[source] = _FolderTree(source.index)
+        index = source.index
+        changed = set()
+        removed = []
+        pending = list(folders)
+        with self.stats.phase("walk"):
+            while len(pending) != 0:
+                folder = pending.pop()
+                files, subfolders = source.list_folder(folder)
+                files = dict((x[0], x[1:]) for x in files if not bisync_exclude_re.match(x[0]) and
+                    not source.ignores(x[0]))
+                subfolders = [x for x in subfolders if not source.ignores(x, True)]
+                removed += tree.files.get(folder, set()).difference(files)
+                known = tree.subfolders.get(folder, set())
+                for subfolder in known.difference(subfolders):
+                    removed += tree.remove_folder(subfolder)
+                pending += [x for x in subfolders if x not in known]
+                tree.files[folder] = set(files)
+                tree.subfolders[folder] = set(subfolders)
+                for path, (size, mtime) in files.items():
+                    alias = source.aliases.get(path) if source.aliases is not None else None
+                    if alias is not None and alias[:2] == [size, mtime]:
+                        mtime = alias[2]
+                    if self._update_version(index, path, size, mtime):
+                        changed.add(path)
+            for path in removed:
+                if path in index and index[path][-1][0] == True:
+                    index[path] = index[path].append(make_deleted_version(time.time()))
+                    changed.add(path)
+        if self.hash_contents and source.hashes is not None:
+            with self.stats.phase("hash"):
+                paths = [x for x in changed if index[x][-1][0] == True]
+                source.hashes.update(source.hash_files(paths, {}) or {})
+        return changed
+
+    def watch(self, folders, stop=None, debounce=WATCH_DEBOUNCE, save_interval=WATCH_SAVE_INTERVAL):
+        """ Synchronizes the folders, then keeps their indexes in memory and synchronizes the files as they
+        are modified, until stop (a threading.Event) is set. The modifications are synchronized once there
+        was none during debounce seconds, and the indexes are saved every save_interval seconds. The
+        .bisyncignore files are only read when starting. """
+        for x in folders:
+            self.load_ignore(x)
+        watchers = [x.get_watcher() for x in folders] # before the walks, to not miss any modification
+        try:
+            self.synchronize_all(folders)
+            self.trees = {}
+            changes = [None] * len(folders)
+            first = last = None # times of the first and last modifications not synchronized yet
+            saved = time.monotonic()
+            modified = False
+            while stop is None or not stop.is_set():
+                time.sleep(min(debounce, 0.2))
+                now = time.monotonic()
+                for i, watcher in enumerate(watchers):
+                    folder_changes = watcher.changes()
+                    if folder_changes is not None:
+                        changes[i] = folder_changes.union(changes[i] or ())
+                        first = first or now
+                        last = now
+                if last is not None and (now - last >= debounce or now - first >= WATCH_MAX_DELAY):
+                    modified = self.sync_changes(folders, changes) or modified
+                    changes = [None] * len(folders)
+                    first = last = None
+                if modified and now - saved >= save_interval:
+                    self.for_each_source(self.save_index, folders)
+                    saved = now
+                    modified = False
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for x in watchers:
+                x.close()
+        self.for_each_source(self.save_index, folders)
+
+    def sync_changes(self, folders, changes):
+        """ Updates the indexes of the folders from the changes reported by their watchers, and synchronizes
+        the modified files. Returns True if an index changed. """
+        changed = {}
+        def update(source):
+            folder_changes = changes[folders.index(source)]
+            if len(folder_changes) == 0 or None in folder_changes:
+                changed[source] = self.update_index(source, source.index)
+                self.trees.pop(source, None)
+            else:
+                changed[source] = self.rescan_folders(source, folder_changes)
+        self.for_each_source(update, [x for x, y in zip(folders, changes) if y is not None])
+        paths = set().union(*changed.values())
+        if len(paths) == 0:
+            return False
+        self.sync_all(folders, sorted(paths))
+        return True
+
+    def load_index(self, source):
+        """ Returns the Index of a source, with the operations completed since it was saved according to the
+        journal of the source. """
+        with self.stats.phase("load_index"):
+            index = self.load_shards(source, BISYNC_MANIFEST, index_shard_path, read_index)
+            if index is None:
+                index = Index()
+                if source.exists(BISYNC_INDEX): # converted to shards by the next save
+                    with source.read_stream(BISYNC_INDEX) as stream:
+                        index.load(read_index(stream))
+            if source.exists(BISYNC_JOURNAL):
+                self.replay_journal(source, index)
+        return index
+
+    def load_shards(self, source, manifest_path, shard_path, read):
+        """ Returns the Index saved in shards by save_shards(), None if there is none. read(stream) returns
+        the (path, entry) tuples of a shard. """
+        if not source.exists(manifest_path):
+            return None
+        manifest = json.loads(source.read_memory(manifest_path).decode("utf8"))
+        if "generation" not in manifest: # legacy file, replaced by the next save
+            return None
+        index = Index(manifest["shards"], manifest["generation"])
+        for shard in range(index.shards):
+            with source.read_stream(shard_path(index.generation, shard)) as stream:
+                index.load(read(stream))
+        return index
+
+    def save_shards(self, source, index, manifest_path, shard_path, write):
+        """ Writes the shards of an Index modified since it was loaded or saved, with write(stream,
+        entries). The number of shards is adjusted to the size of the index, in that case all the shards
+        are written with a new generation, and the manifest giving it replaces the previous one. Returns
+        True in that case. """
+        shards = 1
+        while shards * INDEX_SHARD_FILES < len(index):
+            shards *= 2
+        previous = None
+        if index.generation == 0 or shards >= index.shards * 4 or shards * 4 <= index.shards:
+            previous = (index.generation, index.shards)
+            index.generation += 1
+            index.shards = shards
+            index.dirty = set(range(shards))
+        if len(index.dirty) != 0:
+            entries = dict((x, {}) for x in index.dirty)
+            for path, entry in index.items():
+                shard = entries.get(index.shard(path))
+                if shard is not None:
+                    shard[path] = entry
+            for shard, shard_entries in entries.items():
+                path = shard_path(index.generation, shard)
+                tmp = temporary_path(source, path)
+                with source.write_stream(tmp) as stream:
+                    write(stream, shard_entries)
+                if tmp != path:
+                    source.rename(tmp, path)
+            index.dirty.clear()
+        if previous is None:
+            return False
+        tmp = temporary_path(source, manifest_path)
+        source.write_memory(tmp, json.dumps({"generation": index.generation, "shards": index.shards}).encode(
+            "utf8"))
+        if tmp != manifest_path:
+            source.rename(tmp, manifest_path)
+        if previous[0] != 0:
+            source.delete_many([shard_path(previous[0], x) for x in range(previous[1])])
+        return True
+
+    def delete_shards(self, source, manifest_path, shard_path):
+        """ Deletes an Index saved by save_shards(). """
+        manifest = json.loads(source.read_memory(manifest_path).decode("utf8"))
+        if "generation" in manifest:
+            source.delete_many([shard_path(manifest["generation"], x) for x in range(manifest["shards"])])
+        source.delete(manifest_path)
 
     def save_index(self, source):
-        json_ = json.dumps(source.index)
-        json_ = str(json_)
-        json_ = json_.encode("utf8")
-        source.write_memory(BISYNC_INDEX + BISYNC_SUFFIX, json_)
-        source.rename(BISYNC_INDEX + BISYNC_SUFFIX, BISYNC_INDEX)
+        """ Writes the shards of the index of a source modified since it was loaded or saved, see
+        save_shards(). """
+        with self.stats.phase("save_index"):
+            # the times of the files in the index may come from the state of the source
+            source.save_state()
+            index = source.index
+            if not isinstance(index, Index):
+                index = Index()
+                index.update(source.index)
+                source.index = index
+            if self.save_shards(source, index, BISYNC_MANIFEST, index_shard_path, write_index) and \
+                    index.generation == 1 and source.exists(BISYNC_INDEX):
+                source.delete(BISYNC_INDEX)
+            # the journal only has to keep the interrupted copies which may still be resumed
+            with self._journal_lock:
+                self._journal_buffer.pop(source, None)
+            planned = [{"planned": path, "version": version.hex()} for (x, path), version in
+                self.resumable.items() if x is source]
+            if len(planned) != 0:
+                tmp = temporary_path(source, BISYNC_JOURNAL)
+                source.write_memory(tmp, "".join(json.dumps(x) + "\n" for x in planned).encode("utf8"))
+                if tmp != BISYNC_JOURNAL:
+                    source.rename(tmp, BISYNC_JOURNAL)
+            elif source.exists(BISYNC_JOURNAL):
+                source.delete(BISYNC_JOURNAL)
+
+    # The journal of a source records the operations executed on its files since its index was saved, one
+    # JSON object per line: {"planned": path, "version": hex} before a file is copied to path + BISYNC_SUFFIX,
+    # and {"done": path, "versions": hex} with the merged versions of the file once an operation is complete.
+    # It is not synced to the disk, it allows to resume after the interruption of bisync, not of the system.
+
+    def journal(self, source, record, flush=False):
+        """ Adds a record to the journal of a source, if it supports it. The records are buffered until
+        flush_journal() is called, by this method if flush. """
+        with self._journal_lock:
+            self._journal_buffer.setdefault(source, []).append(json.dumps(record) + "\n")
+        if flush:
+            self.flush_journal(source)
+
+    def flush_journal(self, source):
+        """ Appends the buffered records to the journal of a source. """
+        with self._journal_lock:
+            records = self._journal_buffer.pop(source, None)
+            if records is not None:
+                source.append_memory(BISYNC_JOURNAL, "".join(records).encode("utf8"))
+
+    def replay_journal(self, source, index):
+        """ Applies the operations completed according to the journal of a source to its index, and keeps
+        the interrupted copies in self.resumable. """
+        for line in source.read_memory(BISYNC_JOURNAL).decode("utf8").splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError: # the last record may be incomplete
+                break
+            if "done" in record:
+                index[record["done"]] = History(bytes.fromhex(record["versions"]))
+                self.resumable.pop((source, record["done"]), None)
+            else:
+                self.resumable[(source, record["planned"])] = bytes.fromhex(record["version"])
+
+    def build_current_index(self, source, p_index):
+        if not self.incremental:
+            if source.exists(BISYNC_FOLDERS): # would be outdated for the next incremental walk
+                source.delete(BISYNC_FOLDERS)
+            return self._read_walk(source.walk())
 
-    def build_current_index(self, source):
+        # the folders skipped because they were ignored must be listed if the rules changed
+        ignore = source.ignore.lines if source.ignore else []
+        folders = {}
+        if not self.full_scan and source.exists(BISYNC_FOLDERS):
+            state = json.loads(source.read_memory(BISYNC_FOLDERS).decode("utf8"))
+            if isinstance(state.get("folders"), dict) and state.get("ignore") == ignore:
+                folders = state["folders"]
+        known = {}
+        for file_, versions in p_index.items():
+            last = versions[-1]
+            if last[0] == True:
+                known.setdefault(os.path.dirname(file_), []).append([file_, last[1], last[2]])
+        index = self._read_walk(source.walk_incremental(folders, known))
+        tmp = temporary_path(source, BISYNC_FOLDERS)
+        source.write_memory(tmp, json.dumps({"ignore": ignore, "folders": folders}).encode("utf8"))
+        if tmp != BISYNC_FOLDERS:
+            source.rename(tmp, BISYNC_FOLDERS)
+        return index
+
+    def hash_current_index(self, source, p_index, c_index):
+        """ Sets the hashes of the files of a source, only the files modified since the previous
+        synchronization are hashed unless full_scan is set. A file whose content changed while its size and
+        modification time were preserved is given a new modification time in the index, so it is seen as
+        modified. The file itself is not modified, its time is mapped to the one of the index until it
+        changes. The state of each file, [size, mtime, mtime in the index, entry of the cache of
+        Source.hash_files()], is saved in shards like the index. """
+        states = self.load_shards(source, BISYNC_HASHES, hashes_shard_path, read_hashes) or Index()
+        cache = {} if self.full_scan else dict((x, y[3]) for x, y in states.items())
+        hashes = source.hash_files(list(c_index.keys()), cache)
+        if hashes is None:
+            return
+        for path in [x for x in states if x not in hashes]:
+            del states[path]
+        aliases = {}
+        for path, hash_ in hashes.items():
+            size, mtime = c_index[path]
+            index_mtime = mtime
+            previous = states.get(path)
+            # the hashes are compared with the ones of the files having the same size and time when hashed
+            if previous is not None and previous[:2] == [size, mtime]:
+                index_mtime = previous[2]
+                if previous[3][-1] != hash_ and path in p_index and \
+                        p_index[path].key(-1) == make_version(size, index_mtime):
+                    index_mtime += 1
+            if index_mtime != mtime:
+                aliases[path] = [size, mtime, index_mtime]
+                c_index[path] = [size, index_mtime]
+            states[path] = [size, mtime, index_mtime, cache[path]]
+        source.hashes = hashes
+        source.aliases = aliases
+        self.save_shards(source, states, BISYNC_HASHES, hashes_shard_path, write_hashes)
+
+    def _read_walk(self, walk):
         index = {}
-        for i in source.walk():
+        size = 0
+        for i in walk:
             if not bisync_exclude_re.match(i[0]):
                 index[i[0]] = i[1:]
+                size += int(i[1])
+                if len(index) % 1000 == 0: # counted by batches, for the progress display
+                    self.stats.count("scanned_files", 1000)
+        self.stats.count("scanned_files", len(index) % 1000)
+        self.stats.count("scanned_bytes", size)
         return index
-        
+
 class CmdSynchronizer(Synchronizer):
     def __init__(self, cmd_args, **kwargs):
         super(CmdSynchronizer, self).__init__(**kwargs)
         self.args = cmd_args
 
     def get_file_desc(self, source, path):
-        last = source.index.get(path, [[False]])[-1]
+        last = source.index.get(path, History(DELETED_VERSION))[-1]
         if last[0] == True:
             return "%s %s (%.1f kb, last modif: %s)" % (source.get_name(), path,
                 last[1] / 1000., str(datetime.datetime.fromtimestamp(last[2])))
@@ -385,28 +3311,179 @@ class CmdSynchronizer(Synchronizer):
                 ans = 1
         return ans
 
+def add_compaction_arguments(parser):
+    parser.add_argument("--keep-versions", help="Only keep the last N versions of each file in the" +
+        " indexes, must be more than the number of modifications of a file between two synchronizations" +
+        " or conflicts will be reported", type=int, metavar="N")
+    parser.add_argument("--forget-deleted", help="Remove the files deleted more than DAYS days ago from" +
+        " the indexes, folders not synchronized since could copy them back", type=float, metavar="DAYS")
+
+def get_compaction_kwargs(parser, args):
+    if args.keep_versions is not None and args.keep_versions < 1:
+        parser.error("--keep-versions must be at least 1")
+    return {
+        "keep_versions": args.keep_versions,
+        "forget_deleted": args.forget_deleted * 86400 if args.forget_deleted is not None else None,
+    }
+
+def compact_main(argv):
+    parser = argparse.ArgumentParser(prog="bisync --compact", description="Compact the indexes of folders.")
+    parser.add_argument('folders', metavar='folders', type=str, nargs='+',
+                       help='Folders whose index must be compacted')
+    add_compaction_arguments(parser)
+    args = parser.parse_args(argv)
+    sync = Synchronizer(**get_compaction_kwargs(parser, args))
+
+    for folder in args.folders:
+        source = FileSystemSource(folder)
+        if not source.exists(BISYNC_MANIFEST) and not source.exists(BISYNC_INDEX):
+            print("%s: no index" % folder)
+            continue
+        size = index_size(folder)
+        start = time.perf_counter()
+        source.index = sync.load_index(source)
+        load_time = time.perf_counter() - start
+        removed, forgotten = sync.compact_index(source)
+        sync.save_index(source)
+        n_size = index_size(folder)
+        start = time.perf_counter()
+        sync.load_index(source)
+        n_load_time = time.perf_counter() - start
+        print("%s: %d versions removed, %d deleted files forgotten, index size %.1f kb -> %.1f kb," \
+            " load time %.3fs -> %.3fs" % (folder, removed, forgotten, size / 1000., n_size / 1000.,
+            load_time, n_load_time))
+
+def make_source(parser, args, folder):
+    """ Returns the source of a folder given on the command line, [user@]host:path for a remote folder, or
+    s3://bucket/prefix for an object store. """
+    if folder.startswith("s3://") and not os.path.exists(folder):
+        if args.simulation:
+            parser.error("object stores can't be simulated")
+        bucket, _, prefix = folder[len("s3://"):].partition("/")
+        try:
+            return ObjectStoreSource(bucket, prefix, endpoint_url=args.s3_endpoint_url)
+        except ImportError as e:
+            parser.error(str(e))
+    match = re.match(r"^([\w.-]+@)?([\w.-]{2,}):(.*)$", folder)
+    if match is None or os.path.exists(folder):
+        if args.simulation:
+            return FileSystemSimulationSource(folder, walk_workers=args.walk_workers)
+        return FileSystemSource(folder, walk_workers=args.walk_workers)
+    if args.simulation:
+        parser.error("remote folders can't be simulated")
+    command = shlex.split(args.rsh) + [(match.group(1) or "") + match.group(2),
+        "%s --agent %s" % (args.remote_bisync, shlex.quote(match.group(3) or "."))]
+    return RemoteSource(command, folder)
+
 def main():
-    parser = argparse.ArgumentParser(description='Synchronize two folders.')
+    # flags rather than subcommands, which could be the names of folders
+    if sys.argv[1:2] == ["--compact"]:
+        return compact_main(sys.argv[2:])
+    if sys.argv[1:2] == ["--agent"]:
+        return agent_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Synchronize two folders.',
+        epilog='Folders can be on remote hosts, given as [user@]host:path, bisync must be installed on' +
+        ' those hosts. Folders can also be in object stores, given as s3://bucket/prefix, which requires' +
+        ' boto3. Use "bisync --compact --help" to compact the indexes without synchronizing.')
     parser.add_argument('folders', metavar='folders', type=str, nargs='+',
                        help='Folders to synchronize')
-    parser.add_argument("-s", "--simulation", help="Only output operations", action="store_true")
+    parser.add_argument("-s", "--simulation", help="Only output the operations, the bytes to transfer and" +
+        " an estimation of the duration, without modifying the folders. Conflicts are resolved" +
+        " automatically", action="store_true")
+    parser.add_argument("--plan-json", help="With --simulation, write the operations to a JSON file",
+        metavar="FILE")
+    parser.add_argument("--estimate-from", help="With --simulation, estimate the duration from the" +
+        " statistics of a previous synchronization written by --stats-json", metavar="FILE")
     parser.add_argument("-a", "--auto", help="Does not confirm file transfers", action="store_true")
     parser.add_argument("-f", "--full-auto", help="Does not confirm file transfers" +
         " and resolve conflicts automatically", action="store_true")
     parser.add_argument("-t", "--no-trash", help="Deletes files instead of sending them to a trash" +
         " folder", action="store_true")
+    parser.add_argument("-i", "--incremental", help="Only list the folders modified since the last" +
+        " synchronization, files modified in place in other folders are not detected", action="store_true")
+    parser.add_argument("--full-scan", help="With --incremental, list all the folders again. With --hash," +
+        " hash all the files again", action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of files transferred at the same time", type=int,
+        default=1)
+    parser.add_argument("--hardlink", help="Create hard links instead of copying files between folders" +
+        " of the same filesystem. Linked files share their content: modifying one of them in place" +
+        " modifies it in all the folders", action="store_true")
+    parser.add_argument("-w", "--walk-workers", help="Number of threads used to list folders, useful" +
+        " on network filesystems", type=int, default=1)
+    parser.add_argument("--hash", help="Compare the content of the files, files with the same content" +
+        " are not transferred. Only the files modified since the previous synchronization are hashed",
+        action="store_true")
+    parser.add_argument("--delta", help="Only send the modified parts of large files replaced in remote" +
+        " folders", action="store_true")
+    parser.add_argument("--watch", help="Keep running after the synchronization, and synchronize the files" +
+        " as they are modified. Local folders are watched with inotify on Linux, other folders are walked" +
+        " every %d seconds" % WATCH_POLL_INTERVAL, action="store_true")
+    parser.add_argument("--order", help="Order of the transfers: in the order the files are found (plan)," +
+        " smallest files first or most recently modified files first (default: plan)",
+        choices=Scheduler.ORDERS, default="plan")
+    parser.add_argument("--priority", help="Transfer the files matching a pattern, in the format of" +
+        " .bisyncignore files, before the other ones. Can be repeated, the first patterns coming first",
+        action="append", default=[], metavar="PATTERN")
+    parser.add_argument("--limits", help="JSON file giving the maximum bytes and operations per second of" +
+        ' folders, like {"FOLDER": {"bytes_per_second": 1000000, "operations_per_second": 100}}, "*" for' +
+        " all the other folders. It is read again when modified, to change the limits while synchronizing",
+        metavar="FILE")
+    parser.add_argument("--progress", help="Show the progress on the standard error", action="store_true")
+    parser.add_argument("--stats-json", help="Write the durations of the phases, counters and latencies of" +
+        " the synchronization to a JSON file", metavar="FILE")
+    parser.add_argument("-e", "--rsh", help="Command used to connect to the hosts of remote folders" +
+        " (default: ssh)", default="ssh")
+    parser.add_argument("--remote-bisync", help="Command starting bisync on remote hosts (default: bisync)",
+        default="bisync")
+    parser.add_argument("--s3-endpoint-url", help="URL of the object store of the s3://bucket/prefix" +
+        " folders, for object stores compatible with S3 (default: AWS S3)", metavar="URL")
+    add_compaction_arguments(parser)
 
     args = parser.parse_args()
     if args.full_auto:
         args.auto = True
     if args.simulation:
-        args.no_trash = True
+        args.auto = args.full_auto = True
+        if args.watch:
+            parser.error("--watch can't be used with --simulation")
 
-    sync = CmdSynchronizer(args, no_trash=args.no_trash)
+    stats = Stats(sys.stderr if args.progress else None)
+    sync = CmdSynchronizer(args, no_trash=args.no_trash, incremental=args.incremental,
+        full_scan=args.full_scan, jobs=args.jobs, hardlink=args.hardlink, delta=args.delta,
+        hash_contents=args.hash, stats=stats, scheduler=Scheduler(args.order, args.priority),
+        **get_compaction_kwargs(parser, args))
 
-    if not args.simulation:
-        sources = [FileSystemSource(str(x)) for x in args.folders]
-    else:
-        sources = [FileSystemSimulationSource(x) for x in args.folders]
-    sync.synchronize_all(sources)
+    sources = [make_source(parser, args, str(x)) for x in args.folders]
+    limits = None
+    try:
+        if args.limits is not None:
+            try:
+                limits = LimitsFile(args.limits, dict(zip(args.folders, sources)))
+            except (OSError, ValueError, AttributeError) as e:
+                parser.error("invalid limits file: %s" % e)
+        if args.simulation:
+            plan = sync.plan_all(sources)
+            if args.estimate_from is not None:
+                with open(args.estimate_from) as file_:
+                    plan.calibrate(json.load(file_))
+            for x in plan.operations:
+                print(x.describe())
+            print(plan.describe())
+            if args.plan_json is not None:
+                with open(args.plan_json, "w") as file_:
+                    json.dump(plan.to_dict(), file_, indent=2, sort_keys=True)
+        elif args.watch:
+            sync.watch(sources)
+        else:
+            sync.synchronize_all(sources)
+    finally:
+        if limits is not None:
+            limits.close()
+        for x in sources:
+            x.close()
+        stats.close()
+        if args.stats_json is not None:
+            with open(args.stats_json, "w") as file_:
+                json.dump(stats.to_dict(), file_, indent=2, sort_keys=True)
 
@@ -1,5 +1,17 @@
 import bisync_lib as bisync
+import datetime
+import errno
+import hashlib
+import io
 import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 class TestSource(bisync.Source):
@@ -7,6 +19,7 @@ class TestSource(bisync.Source):
         self.test_index = index
         self.nbr_copy = 0
         self.nbr_delete = 0
+        self.renames = []
 
     def walk(self):
         for file_ in list(self.test_index.keys()):
@@ -17,7 +30,7 @@ class TestSource(bisync.Source):
     def exists(self, path):
         if path == bisync.BISYNC_INDEX:
             return True
-        elif path in self.text_index:
+        elif path in self.test_index:
             return True
         else:
             return False
@@ -32,14 +45,19 @@ class TestSource(bisync.Source):
         self.nbr_copy += 1
 
     def rename(self, from_, to):
-        pass
+        if not from_.endswith(bisync.BISYNC_SUFFIX):
+            self.renames.append((from_, to))
 
     def delete(self, path):
-        self.nbr_delete += 1
+        if not path.startswith(bisync.BISYNC_FOLDER):
+            self.nbr_delete += 1
 
     def get_local_name(self, path):
         return path
 
+def histories(index):
+    return dict((k, bisync.History.from_list(v)) for k, v in index.items())
+
 class TestSequenceFunctions(unittest.TestCase):
 
     def test_first_sync(self):
@@ -53,7 +71,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 1)
         self.assertEqual(s1.nbr_delete, 0)
@@ -71,7 +89,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [True, "1", "2"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 1)
         self.assertEqual(s1.nbr_delete, 0)
@@ -89,7 +107,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [False]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 0)
         self.assertEqual(s1.nbr_delete, 0)
@@ -107,7 +125,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [False], [True, "1", "4"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 1)
         self.assertEqual(s2.nbr_copy, 0)
         self.assertEqual(s1.nbr_delete, 0)
@@ -127,7 +145,29 @@ class TestSequenceFunctions(unittest.TestCase):
             "file1": [[True, "1", "1"], [False]],
             "file2": [[True, "1", "1"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
+        self.assertEqual(s2.index, histories(result))
+        self.assertEqual(s1.nbr_copy, 0)
+        self.assertEqual(s2.nbr_copy, 0)
+        self.assertEqual(s1.nbr_delete, 0)
+        self.assertEqual(s2.nbr_delete, 0)
+        self.assertEqual(s2.renames, [("file1", "file2")])
+
+    def test_moved_file_without_detection(self):
+        s1 = TestSource({
+            "file1": [[True, "1", "1"], [False]],
+            "file2": [[True, "1", "1"]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"]],
+        })
+        sync = bisync.Synchronizer(no_trash=True, detect_moves=False)
+        sync.synchronize_all([s1, s2])
+        result = {
+            "file1": [[True, "1", "1"], [False]],
+            "file2": [[True, "1", "1"]],
+        }
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 1)
         self.assertEqual(s1.nbr_delete, 0)
@@ -145,7 +185,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 1)
         self.assertEqual(s1.nbr_delete, 0)
@@ -163,7 +203,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [True, "1", "3"], [False], [True, "1", "2"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 1)
         self.assertEqual(s2.nbr_copy, 0)
         self.assertEqual(s1.nbr_delete, 0)
@@ -181,7 +221,7 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"], [False]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 0)
         self.assertEqual(s1.nbr_delete, 0)
@@ -199,11 +239,1516 @@ class TestSequenceFunctions(unittest.TestCase):
         result = {
             "file1": [[True, "1", "1"], [True, "1", "2"]],
         }
-        self.assertEqual(s1.index, result)
+        self.assertEqual(s1.index, histories(result))
         self.assertEqual(s1.nbr_copy, 0)
         self.assertEqual(s2.nbr_copy, 0)
         self.assertEqual(s1.nbr_delete, 0)
         self.assertEqual(s2.nbr_delete, 0)
 
+    def test_truncated_history(self):
+        s1 = TestSource({
+            "file1": [[None], [True, "1", "3"]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"]],
+        })
+        sync = bisync.Synchronizer(no_trash=True)
+        sync.synchronize_all([s1, s2])
+        result = {
+            "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
+        }
+        self.assertEqual(s1.index, histories(result))
+        self.assertEqual(s1.nbr_copy, 0)
+        self.assertEqual(s2.nbr_copy, 1)
+        self.assertEqual(s1.nbr_delete, 0)
+        self.assertEqual(s2.nbr_delete, 0)
+
+    def test_compaction(self):
+        s1 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
+            "file2": [[True, "1", "1"], [False, 1000]],
+            "file3": [[True, "1", "1"], [False, 3000]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"]],
+            "file2": [[True, "1", "1"], [False, 1000]],
+            "file3": [[True, "1", "1"], [False, 3000]],
+        })
+        sync = bisync.Synchronizer(no_trash=True, keep_versions=2)
+        sync.synchronize_all([s1, s2])
+        sync.keep_versions = None
+        sync.forget_deleted = bisync.time.time() - 2000
+        self.assertEqual(sync.compact_index(s1), (0, 1))
+        result = {
+            "file1": [[None], [True, "1", "2"], [True, "1", "3"]],
+            "file3": [[True, "1", "1"], [False, 3000]],
+        }
+        self.assertEqual(s1.index, histories(result))
+        self.assertEqual(s2.nbr_copy, 1)
+
+    def test_failed_transfer(self):
+        class FailingSource(TestSource):
+            def copy_to(self, local_file, dest_file):
+                if local_file == "file2":
+                    raise IOError("disk full")
+                super(FailingSource, self).copy_to(local_file, dest_file)
+        s1 = TestSource({
+            "file1": [[True, "1", "1"]],
+            "file2": [[True, "1", "1"]],
+        })
+        s2 = FailingSource({
+        })
+        sync = bisync.Synchronizer(no_trash=True, jobs=4)
+        with self.assertRaises(IOError):
+            sync.synchronize_all([s1, s2])
+        result = {
+            "file1": [[True, "1", "1"]],
+        }
+        self.assertEqual(s2.index, histories(result))
+        self.assertEqual(s2.nbr_copy, 1)
+
+    def test_n_way(self):
+        # each folder has a newer version than the previous one, the last one is copied once to the others
+        s1 = TestSource({
+            "file1": [[True, "1", "1"]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"]],
+        })
+        s3 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
+        })
+        s4 = TestSource({
+        })
+        sync = bisync.Synchronizer(no_trash=True)
+        sync.synchronize_all([s1, s2, s3, s4])
+        result = {
+            "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
+        }
+        for x in [s1, s2, s3, s4]:
+            self.assertEqual(x.index, histories(result))
+        self.assertEqual([x.nbr_copy for x in [s1, s2, s3, s4]], [1, 1, 0, 1])
+
+    def test_n_way_conflict(self):
+        s1 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "3"]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"]],
+        })
+        s3 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "3"]],
+        })
+        sync = bisync.Synchronizer(no_trash=True)
+        sync.synchronize_all([s1, s2, s3])
+        result = {
+            "file1": [[True, "1", "1"], [True, "1", "2"], [True, "1", "3"]],
+        }
+        for x in [s1, s2, s3]:
+            self.assertEqual(x.index, histories(result))
+        self.assertEqual([x.nbr_copy for x in [s1, s2, s3]], [0, 1, 0])
+
+    def test_plan(self):
+        s1 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1000", "3"]],
+            "file2": [[True, "2000", "1"]],
+            "file3": [[True, "1", "1"], [False]],
+        })
+        s2 = TestSource({
+            "file1": [[True, "1", "1"], [True, "1", "2"]],
+            "file3": [[True, "1", "1"]],
+        })
+        sync = bisync.Synchronizer()
+        plan = sync.plan_all([s1, s2])
+        self.assertEqual(sorted((x.kind, x.path, x.size, x.conflict) for x in plan.operations), [
+            ("copy", "file2", 2000, False), ("replace", "file1", 1000, True), ("trash", "file3", 0, False)])
+        summary = plan.summary()
+        self.assertEqual((summary["operations"], summary["bytes"], summary["conflicts"]), (3, 3000, 1))
+        self.assertEqual(summary["kinds"]["copy"], {"count": 1, "bytes": 2000})
+        self.assertAlmostEqual(summary["estimated_seconds"],
+            3000 / bisync.ESTIMATED_BYTES_PER_SECOND + 3 * bisync.ESTIMATED_OPERATION_SECONDS)
+        plan.calibrate({"throughput": {"transferred_bytes_per_second": 1000},
+            "latencies": {"trash": {"count": 2, "total": 1.}, "copy": {"count": 1, "total": 10.}}})
+        self.assertAlmostEqual(plan.summary()["estimated_seconds"], 3 + 0.5 + 2 * bisync.ESTIMATED_OPERATION_SECONDS)
+        self.assertEqual(json.loads(json.dumps(plan.to_dict()))["operations"][0]["kind"], plan.operations[0].kind)
+        self.assertEqual([x.nbr_copy for x in [s1, s2]], [0, 0])
+        # the plan is executed like any synchronization
+        sync.execute(plan.operations)
+        self.assertEqual(s2.nbr_copy, 2)
+        self.assertEqual(s1.index, s2.index)
+
+    def test_concurrent_indexing(self):
+        # each walk waits for the other ones, which would fail if they were listed one after the other
+        barrier = threading.Barrier(4, timeout=10)
+        class WaitingSource(TestSource):
+            def walk(self):
+                barrier.wait()
+                return super(WaitingSource, self).walk()
+        sources = [WaitingSource({"file%d" % i: [[True, "1", "1"]]}) for i in range(4)]
+        bisync.Synchronizer().synchronize_all(sources)
+        self.assertEqual([x.nbr_copy for x in sources], [3, 3, 3, 3])
+
+    def test_scheduler(self):
+        s1 = TestSource({
+            "file1": [[True, 300, 1]],
+            "file2": [[True, 100, 3]],
+            os.path.join("docs", "file3"): [[True, 200, 2]],
+            "file4": [[True, 1, 1], [False, 4]],
+        })
+        s2 = TestSource({
+            "file4": [[True, 1, 1]],
+        })
+        orders = [
+            (bisync.Scheduler(), ["file1", "file2", os.path.join("docs", "file3"), "file4"]),
+            (bisync.Scheduler("small-first"), ["file4", "file2", os.path.join("docs", "file3"), "file1"]),
+            (bisync.Scheduler("newest-first"), ["file4", "file2", os.path.join("docs", "file3"), "file1"]),
+            (bisync.Scheduler("small-first", ["docs/", "file1"]), [os.path.join("docs", "file3"), "file1",
+                "file4", "file2"]),
+        ]
+        for scheduler, paths in orders:
+            plan = bisync.Synchronizer(no_trash=True, scheduler=scheduler).plan_all([s1, s2])
+            self.assertEqual([x.path for x in plan.operations], paths)
+        with self.assertRaises(ValueError):
+            bisync.Scheduler("random")
+
+    def test_batched_operations(self):
+        class BatchSource(TestSource):
+            def delete_many(self, paths):
+                self.batches.append(sorted(paths))
+                super(BatchSource, self).delete_many(paths)
+        s1 = TestSource(dict(("file%d" % i, [[True, "1", "1"], [False]]) for i in range(5)))
+        s2 = BatchSource(dict(("file%d" % i, [[True, "1", "1"]]) for i in range(5)))
+        s2.batches = []
+        batch_size = bisync.BATCH_SIZE
+        bisync.BATCH_SIZE = 3
+        try:
+            bisync.Synchronizer(no_trash=True).synchronize_all([s1, s2])
+        finally:
+            bisync.BATCH_SIZE = batch_size
+        self.assertEqual(s2.batches, [["file0", "file1", "file2"], ["file3", "file4"]])
+        # the default implementation deletes the files one by one
+        self.assertEqual(s2.nbr_delete, 5)
+        self.assertEqual(s1.index, s2.index)
+
+    def test_n_way_declined(self):
+        class DecliningSynchronizer(bisync.Synchronizer):
+            def confirm_copy(self, source_from, source_to, path):
+                return source_to is not s2
+        s1 = TestSource({
+            "file1": [[True, "1", "1"]],
+        })
+        s2 = TestSource({
+        })
+        s3 = TestSource({
+        })
+        sync = DecliningSynchronizer(no_trash=True)
+        sync.synchronize_all([s1, s2, s3])
+        self.assertEqual(s1.index, histories({"file1": [[True, "1", "1"]]}))
+        self.assertEqual(s3.index, s1.index)
+        self.assertEqual(s2.index, {})
+        self.assertEqual([x.nbr_copy for x in [s1, s2, s3]], [0, 0, 1])
+
+class FakeClock(object):
+    """ Clock and sleep function of a RateLimiter, the time only advances when sleeping. The durations of
+    the sleeps are kept in sleeps, and on_sleep is called after each of them. """
+    def __init__(self, on_sleep=None):
+        self.now = 0.
+        self.sleeps = []
+        self.on_sleep = on_sleep
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += duration
+        self.sleeps.append(duration)
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_limits(self):
+        clock = FakeClock()
+        throttle = bisync.RateLimiter(bytes_per_second=1000, operations_per_second=10, clock=clock,
+            sleep=clock.sleep)
+        throttle.consume_bytes(1000) # the bucket starts full
+        throttle.consume_operations(10)
+        self.assertEqual(clock.sleeps, [])
+        throttle.consume_bytes(200)
+        self.assertEqual(clock.sleeps, [0.2])
+        # the operations bucket was refilled while waiting for the bytes
+        throttle.consume_operations(3)
+        self.assertEqual(len(clock.sleeps), 2)
+        self.assertAlmostEqual(clock.sleeps[1], 0.1)
+        # long delays are split to use the new limits
+        throttle.consume_bytes(1200)
+        self.assertEqual(clock.sleeps[2:], [bisync.RATE_LIMIT_RECHECK] * 2 + [0.1])
+
+    def test_runtime_change(self):
+        clock = FakeClock(lambda: throttle.set_limits())
+        throttle = bisync.RateLimiter(bytes_per_second=1000, clock=clock, sleep=clock.sleep)
+        throttle.consume_bytes(1000)
+        throttle.consume_bytes(100000) # 100 seconds with the initial limit
+        self.assertEqual(clock.sleeps, [bisync.RATE_LIMIT_RECHECK])
+        self.assertEqual(throttle.limits, (None, None))
+
+    def test_limits_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, "limits.json")
+            with open(path, "w") as file_:
+                json.dump({"f1": {"bytes_per_second": 1000}, "*": {"operations_per_second": 10}}, file_)
+            sources = {"f1": TestSource({}), "f2": TestSource({})}
+            limits = bisync.LimitsFile(path, sources, 0.01)
+            try:
+                self.assertEqual(sources["f1"].throttle.limits, (1000, None))
+                self.assertEqual(sources["f2"].throttle.limits, (None, 10))
+                with open(path, "w") as file_:
+                    json.dump({"*": {"bytes_per_second": 2000}}, file_)
+                os.utime(path, ns=(1, 1))
+                for i in range(100):
+                    if sources["f1"].throttle.limits == (2000, None):
+                        break
+                    time.sleep(0.01)
+                self.assertEqual(sources["f1"].throttle.limits, (2000, None))
+                self.assertEqual(sources["f2"].throttle.limits, (2000, None))
+            finally:
+                limits.close()
+        finally:
+            shutil.rmtree(root)
+
+class TestStats(unittest.TestCase):
+
+    def test_stats(self):
+        s1 = TestSource({
+            "file1": [[True, "10", "1"]],
+            "file2": [[True, "20", "1"]],
+        })
+        s2 = TestSource({
+            "file2": [[True, "20", "1"], [False]],
+        })
+        progress = io.StringIO()
+        stats = bisync.Stats(progress)
+        bisync.Synchronizer(no_trash=True, stats=stats).synchronize_all([s1, s2])
+        stats.close()
+        result = stats.to_dict()
+        self.assertEqual(result["counters"], {"scanned_files": 2, "scanned_bytes": 30, "planned_operations": 2,
+            "done_operations": 2, "copy_operations": 1, "delete_operations": 1, "transferred_bytes": 10})
+        self.assertEqual(set(result["phases"].keys()), set(["load_index", "walk", "save_index", "plan", "transfer"]))
+        self.assertEqual(result["latencies"]["copy"]["count"], 1)
+        self.assertIn("done, 2 files scanned, 2/2 operations", progress.getvalue())
+        self.assertTrue(progress.getvalue().endswith("\n"))
+        json.dumps(result)
+
+    def test_concurrent_phases(self):
+        stats = bisync.Stats()
+        barrier = threading.Barrier(4)
+        def walk():
+            with stats.phase("walk"):
+                barrier.wait()
+                time.sleep(0.1)
+        threads = [threading.Thread(target=walk) for i in range(3)]
+        for x in threads:
+            x.start()
+        barrier.wait() # all the walks are in progress
+        self.assertEqual(stats.current_phase, "walk")
+        for x in threads:
+            x.join()
+        self.assertEqual(stats.current_phase, None)
+        self.assertLess(stats.phases["walk"], 0.25)
+
+    def test_throughput(self):
+        stats = bisync.Stats()
+        with stats.phase("transfer"):
+            stats.count("transferred_bytes", 100)
+        stats.phases["transfer"] = 1. # as if the first transfer lasted one second
+        self.assertEqual(stats.throughput("transferred_bytes", "transfer"), 100.)
+        # the time between the phases is not counted
+        with stats.phase("transfer"):
+            self.assertGreater(stats.throughput("transferred_bytes", "transfer"), 90.)
+            self.assertLessEqual(stats.throughput("transferred_bytes", "transfer"), 100.)
+
+    def test_histogram(self):
+        stats = bisync.Stats()
+        for duration in [0.0001, 0.001, 0.0015, 0.003, 1]:
+            stats.record("copy", duration)
+        self.assertEqual(stats.latencies["copy"]["histogram"], {"1ms": 2, "2ms": 1, "4ms": 1, "1024ms": 1})
+        self.assertEqual(stats.latencies["copy"]["max"], 1)
+
+class TestIndexFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        index = {
+            "file1": [[True, 1, 1], [False]],
+            os.path.join("a", "file2"): [[True, 0, 1356786605]],
+            os.path.join("a", "file3"): [[False], [True, 2 ** 40, -1]],
+            "\u00e9t\u00e9": [[True, 3, 4]],
+            os.fsdecode(b"caf\xe9.mp3"): [[True, 5, 6]], # not UTF-8, as returned by os.scandir()
+        }
+        stream = io.BytesIO()
+        bisync.write_index(stream, histories(index))
+        stream.seek(0)
+        self.assertEqual(dict(bisync.read_index(stream)), histories(index))
+
+    def test_legacy_json(self):
+        index = {"file1": [[True, 1, 1], [False]]}
+        stream = io.BytesIO(json.dumps(index).encode("utf8"))
+        self.assertEqual(dict(bisync.read_index(stream)), histories(index))
+
+    def test_truncated(self):
+        stream = io.BytesIO()
+        bisync.write_index(stream, histories({"file1": [[True, 1, 1]]}))
+        stream = io.BytesIO(stream.getvalue()[:-3])
+        with self.assertRaises(ValueError):
+            dict(bisync.read_index(stream))
+
+    def test_sharded_index(self):
+        class CountingSource(bisync.FileSystemSource):
+            written = []
+            def write_stream(self, path):
+                self.written.append(path)
+                return super(CountingSource, self).write_stream(path)
+        root = tempfile.mkdtemp()
+        try:
+            source = CountingSource(root)
+            sync = bisync.Synchronizer()
+            index = dict(("file%d" % i, bisync.History.from_list([[True, 1, i]])) for i in range(10000))
+            with source.write_stream(bisync.BISYNC_INDEX) as stream:
+                bisync.write_index(stream, index)
+            # a single index is converted to shards
+            source.index = sync.load_index(source)
+            self.assertEqual(source.index, index)
+            sync.save_index(source)
+            self.assertFalse(os.path.exists(os.path.join(root, bisync.BISYNC_INDEX)))
+            self.assertEqual((source.index.generation, source.index.shards), (1, 8))
+            self.assertEqual(sync.load_index(source), index)
+            # only the modified shards are written
+            source.index = sync.load_index(source)
+            source.index["file1"] = bisync.History.from_list([[True, 1, 1]])
+            del CountingSource.written[:]
+            sync.save_index(source)
+            self.assertEqual(CountingSource.written, [])
+            source.index["file1"] = bisync.History.from_list([[True, 1, 1], [False]])
+            del source.index["file2"]
+            sync.save_index(source)
+            self.assertEqual(len(CountingSource.written), len(set([source.index.shard("file1"), source.index.shard("file2")])))
+            index["file1"] = source.index["file1"]
+            del index["file2"]
+            self.assertEqual(sync.load_index(source), index)
+            # the number of shards follows the size of the index
+            source.index.update(("new%d" % i, bisync.History.from_list([[True, 1, i]])) for i in range(30000))
+            sync.save_index(source)
+            self.assertEqual((source.index.generation, source.index.shards), (2, 32))
+            self.assertEqual(len(sync.load_index(source)), 39999)
+            self.assertEqual(len([x for x in os.listdir(os.path.join(root, bisync.BISYNC_FOLDER))
+                if x.startswith("index.")]), 32)
+        finally:
+            shutil.rmtree(root)
+
+class TestHistory(unittest.TestCase):
+
+    def test_history(self):
+        history = bisync.History.from_list([[True, 1, 2], [False], [True, 3, 4]])
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history[0], (True, 1, 2))
+        self.assertEqual(history[-2], (False,))
+        self.assertEqual(list(history), [(True, 1, 2), (False,), (True, 3, 4)])
+        self.assertEqual(history[1:], bisync.History.from_list([[False], [True, 3, 4]]))
+        self.assertEqual(history.key(-1), bisync.make_version(3, 4))
+        self.assertEqual(history.append(bisync.DELETED_VERSION).to_list(),
+            [[True, 1, 2], [False], [True, 3, 4], [False]])
+        with self.assertRaises(IndexError):
+            history[3]
+
+def quadratic_last_common_version(versions1, versions2):
+    # previous implementation of the search done in Synchronizer.sync
+    i = len(versions1) - 1
+    j = len(versions2) - 1
+    while j >= 0:
+        if versions1[i] == versions2[j]:
+            break
+        i -= 1
+        if i == -1:
+            i = len(versions1) - 1
+            j -= 1
+    return i, j
+
+def quadratic_merge_histories(versions1, versions2):
+    # previous implementation of Synchronizer.merge_versions
+    last_common_i = -1
+    last_common_j = -1
+    i = 0
+    j = 0
+    n_versions = []
+    while i < len(versions1) and j < len(versions2):
+        if versions1[i] == versions2[j]:
+            n_versions += versions2[last_common_j + 1:j]
+            n_versions += versions1[last_common_i + 1:i]
+            n_versions.append(versions1[i])
+            last_common_i = i
+            last_common_j = j
+            i += 1
+            j += 1
+            continue
+        i += 1
+        if i == len(versions1):
+            i = last_common_i + 1
+            j += 1
+    n_versions += versions2[last_common_j + 1:]
+    n_versions += versions1[last_common_i + 1:]
+    return n_versions
+
+class TestHistoryAlgorithms(unittest.TestCase):
+
+    def random_histories(self, seed, count=3000):
+        random_ = random.Random(seed)
+        for _ in range(count):
+            # few distinct versions so histories share versions, sometimes several times
+            alphabet = [[False]] + [[True, random_.randint(0, 2), x] for x in range(random_.randint(1, 5))]
+            common = [random_.choice(alphabet) for _ in range(random_.randint(0, 4))]
+            versions1 = common + [random_.choice(alphabet) for _ in range(random_.randint(0, 6))]
+            versions2 = common + [random_.choice(alphabet) for _ in range(random_.randint(0, 6))]
+            random_.shuffle(random_.choice([versions1, versions2, []]))
+            yield versions1, versions2
+
+    def test_last_common_version(self):
+        for versions1, versions2 in self.random_histories(1):
+            if len(versions1) == 0:
+                continue
+            self.assertEqual(bisync.last_common_version(bisync.History.from_list(versions1),
+                bisync.History.from_list(versions2)), quadratic_last_common_version(versions1, versions2),
+                (versions1, versions2))
+
+    def test_merge_histories(self):
+        for versions1, versions2 in self.random_histories(2):
+            self.assertEqual(bisync.merge_histories(bisync.History.from_list(versions1),
+                bisync.History.from_list(versions2)).to_list(), quadratic_merge_histories(versions1, versions2),
+                (versions1, versions2))
+
+class TestCompaction(unittest.TestCase):
+
+    def test_compact_history(self):
+        versions = bisync.History.from_list([[True, 1, 1], [True, 1, 2], [True, 1, 3], [False]])
+        self.assertEqual(bisync.compact_history(versions, 2).to_list(), [[None], [True, 1, 3], [False]])
+        self.assertEqual(bisync.compact_history(versions, 4), versions)
+        self.assertEqual(bisync.compact_history(versions, forget_before=100, now=50).to_list(),
+            [[True, 1, 1], [True, 1, 2], [True, 1, 3], [False, 50]])
+        versions = bisync.History.from_list([[None], [True, 1, 2], [False, 50]])
+        self.assertEqual(bisync.compact_history(versions, 2), versions)
+        self.assertEqual(bisync.compact_history(versions, 1).to_list(), [[None], [False, 50]])
+        self.assertEqual(bisync.compact_history(versions, forget_before=100), None)
+        self.assertEqual(bisync.compact_history(versions, forget_before=10), versions)
+
+    def test_deletion_time(self):
+        versions1 = bisync.History.from_list([[True, 1, 1], [False, 10]])
+        versions2 = bisync.History.from_list([[True, 1, 1], [False, 20]])
+        self.assertEqual(versions1.key(-1), versions2.key(-1))
+        self.assertEqual(bisync.merge_histories(versions1, versions2), versions1)
+
+class TestIgnoreRules(unittest.TestCase):
+
+    def test_patterns(self):
+        rules = bisync.IgnoreRules(["# comment", "", "*.o", "build/", "/top", "docs/**/*.md", "a/**",
+            "file[0-9]", "\\!x"])
+        for path, folder in [("b.o", False), ("c/b.o", False), ("build", True), ("c/build", True),
+                ("top", False), ("docs/x/y.md", False), ("docs/y.md", False), ("a/b/c", False),
+                ("file1", False), ("!x", False)]:
+            self.assertTrue(rules.match(path, folder), path)
+        for path, folder in [("b.oo", False), ("build", False), ("c/top", False), ("docs/y.txt", False),
+                ("a", False), ("filex", False), ("x", False), ("comment", False)]:
+            self.assertFalse(rules.match(path, folder), path)
+
+    def test_negation(self):
+        rules = bisync.IgnoreRules(["*.tmp", "!keep.tmp", "cache/", "!cache/keep.tmp"])
+        self.assertTrue(rules.ignored("a/b.tmp"))
+        self.assertFalse(rules.ignored("a/keep.tmp"))
+        # the files of an ignored folder can't be included again
+        self.assertTrue(rules.ignored("a/cache/keep.tmp"))
+        self.assertFalse(bisync.IgnoreRules(["# comment"]))
+
+def write_file(path, content, mtime):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as file_:
+        file_.write(content)
+    os.utime(path, (mtime, mtime))
+
+class TestFileSystemSource(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, path, content=b"x", mtime=1000):
+        write_file(os.path.join(self.root, path), content, mtime)
+
+    def test_walk(self):
+        self.make_file("file1", b"abc", 1001)
+        self.make_file(os.path.join("a", "file2"), b"", 1002)
+        self.make_file(os.path.join("a", "b", "file3"), b"abcdef", 1003)
+        os.makedirs(os.path.join(self.root, "empty"))
+        os.symlink(os.path.join(self.root, "a"), os.path.join(self.root, "link"))
+        result = sorted([
+            ["file1", 3, 1001],
+            [os.path.join("a", "file2"), 0, 1002],
+            [os.path.join("a", "b", "file3"), 6, 1003],
+        ])
+        self.assertEqual(sorted(bisync.FileSystemSource(self.root).walk()), result)
+        self.assertEqual(sorted(bisync.FileSystemSource(self.root, walk_workers=4).walk()), result)
+
+    def test_rename(self):
+        self.make_file(os.path.join("a", "file1"), b"new")
+        self.make_file(os.path.join("b", "file2"), b"old")
+        source = bisync.FileSystemSource(self.root)
+        source.rename(os.path.join("a", "file1"), os.path.join("b", "file2"))
+        source.rename(os.path.join("b", "file2"), os.path.join("c", "d", "file3"))
+        self.assertEqual(sorted(source.walk()), [[os.path.join("c", "d", "file3"), 3, 1000]])
+
+    def test_batches(self):
+        for name in ["file1", "file2", "file3"]:
+            self.make_file(os.path.join("a", "b", name))
+        self.make_file(os.path.join("a", "file4"))
+        source = bisync.FileSystemSource(self.root)
+        source.make_dirs([os.path.join("c", "d"), "e"])
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "c", "d")))
+        source.rename_many([(os.path.join("a", "b", "file1"), os.path.join("c", "d", "file1")),
+            (os.path.join("a", "b", "file2"), os.path.join("f", "file2"))])
+        source.delete_many([os.path.join("a", "b", "file3"), os.path.join("a", "file4"), "missing"])
+        # the emptied folders are removed, the other ones are kept
+        self.assertEqual(sorted(os.listdir(self.root)), ["c", "e", "f"])
+        self.assertEqual(sorted(source.walk()), [[os.path.join("c", "d", "file1"), 1, 1000],
+            [os.path.join("f", "file2"), 1, 1000]])
+
+    def test_walk_incremental(self):
+        self.make_file("file1", b"abc", 1001)
+        self.make_file(os.path.join("a", "file2"), b"", 1002)
+        self.make_file(os.path.join("b", "file3"), b"abcdef", 1003)
+        for folder in ["", "a", "b"]:
+            os.utime(os.path.join(self.root, folder), (2000, 2000))
+        source = bisync.FileSystemSource(self.root)
+        folders = {}
+        first = sorted(source.walk_incremental(folders, {}))
+        self.assertEqual(first, sorted(source.walk()))
+        self.assertEqual(sorted(folders.keys()), ["", "a", "b"])
+
+        known = {}
+        for file_ in first:
+            known.setdefault(os.path.dirname(file_[0]), []).append(file_)
+        self.make_file(os.path.join("a", "file2"), b"modified in place", 1002)
+        self.make_file(os.path.join("b", "file4"), b"new", 1004)
+        os.utime(os.path.join(self.root, "a"), (2000, 2000))
+        os.utime(os.path.join(self.root, "b"), (3000, 3000))
+        result = sorted([
+            ["file1", 3, 1001],
+            [os.path.join("a", "file2"), 0, 1002],
+            [os.path.join("b", "file3"), 6, 1003],
+            [os.path.join("b", "file4"), 3, 1004],
+        ])
+        self.assertEqual(sorted(source.walk_incremental(folders, known)), result)
+        self.assertEqual(folders["b"][0], 3000 * 10 ** 9)
+
+    def test_resume_hard_link(self):
+        # the temporary file of an interrupted copy of link_to() shares the content of another file
+        self.make_file("file1", b"user content")
+        self.make_file("new", b"new content")
+        os.link(os.path.join(self.root, "file1"), os.path.join(self.root, "file2" + bisync.BISYNC_SUFFIX))
+        source = bisync.FileSystemSource(self.root)
+        self.assertFalse(source.resume_copy_to(os.path.join(self.root, "new"), "file2" + bisync.BISYNC_SUFFIX))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "file2" + bisync.BISYNC_SUFFIX)))
+        with open(os.path.join(self.root, "file1"), "rb") as file_:
+            self.assertEqual(file_.read(), b"user content")
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, "src")
+        self.dst = os.path.join(self.root, "dst")
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        write_file(self.src, self.content, 1000)
+        os.chmod(self.src, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_copy_file(self):
+        bisync.copy_file(self.src, self.dst)
+        with open(self.dst, "rb") as file_:
+            self.assertEqual(file_.read(), self.content)
+        self.assertEqual(os.stat(self.dst).st_mtime_ns, os.stat(self.src).st_mtime_ns)
+        self.assertEqual(os.stat(self.dst).st_mode & 0o777, 0o640)
+
+    def test_copy_methods(self):
+        # each method must be able to continue a copy started by another one
+        methods = [bisync._copy_range, bisync._copy_sendfile, bisync._copy_buffered]
+        for method in methods:
+            with open(self.src, "rb") as file_src, open(self.dst, "wb") as file_dst:
+                file_dst.write(self.content[:1000])
+                file_dst.flush()
+                offset = method(file_src.fileno(), file_dst.fileno(), 1000)
+                if offset is not None: # not supported on this system
+                    self.assertEqual(offset, 1000)
+                    continue
+            with open(self.dst, "rb") as file_:
+                self.assertEqual(file_.read(), self.content, method.__name__)
+
+    def test_short_copy(self):
+        # some filesystems stop the in-kernel copies before the end of the file
+        originals = (bisync._copy_clone, getattr(os, "copy_file_range", None), getattr(os, "sendfile", None),
+            bisync._copy_buffered)
+        def copy_file_range(fd_src, fd_dst, count, offset_src, offset_dst):
+            return 0
+        def sendfile(fd_dst, fd_src, offset, count):
+            return 0 if offset >= 1024 * 1024 else originals[2](fd_dst, fd_src, offset, min(count, 1024 * 1024))
+        bisync._copy_clone = lambda fd_src, fd_dst, offset, throttle=None: offset
+        os.copy_file_range = copy_file_range
+        os.sendfile = sendfile
+        try:
+            bisync.copy_file(self.src, self.dst)
+            with open(self.dst, "rb") as file_:
+                self.assertEqual(file_.read(), self.content)
+            # a copy which still stops before the end is an error
+            bisync._copy_buffered = lambda fd_src, fd_dst, offset, throttle=None: None
+            with self.assertRaises(OSError):
+                bisync.copy_file(self.src, self.dst)
+        finally:
+            bisync._copy_clone = originals[0]
+            os.copy_file_range = originals[1]
+            os.sendfile = originals[2]
+            bisync._copy_buffered = originals[3]
+
+class TestFileSystemSync(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.folders = [os.path.join(self.root, x) for x in ["f1", "f2"]]
+        for folder in self.folders:
+            os.makedirs(folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, path, content=b"x", mtime=1000):
+        write_file(os.path.join(self.root, path), content, mtime)
+
+    def read_file(self, path):
+        with open(os.path.join(self.root, path), "rb") as file_:
+            return file_.read()
+
+    def synchronize(self, **kwargs):
+        sources = [bisync.FileSystemSource(x) for x in self.folders]
+        bisync.Synchronizer(**kwargs).synchronize_all(sources)
+        return sources
+
+    def test_parallel_transfers(self):
+        for i in range(50):
+            self.make_file(os.path.join("f1", "d%d" % (i % 5), "file%d" % i), b"content %d" % i, 1000 + i)
+            self.make_file(os.path.join("f2", "e%d" % (i % 5), "file%d" % i), b"other %d" % i, 2000 + i)
+        self.synchronize(jobs=8)
+        for i in range(50):
+            path = os.path.join("d%d" % (i % 5), "file%d" % i)
+            self.assertEqual(self.read_file(os.path.join("f2", path)), b"content %d" % i)
+            self.assertEqual(os.stat(os.path.join(self.root, "f2", path)).st_mtime, 1000 + i)
+        for i in range(50):
+            os.remove(os.path.join(self.root, "f2", "d%d" % (i % 5), "file%d" % i))
+        self.synchronize(jobs=8, no_trash=True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "f1"))), [".bisync"] + ["e%d" % i for i in range(5)])
+
+    def test_hardlink(self):
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 1000)
+        self.synchronize(hardlink=True)
+        stat1 = os.stat(os.path.join(self.root, "f1", "a", "file1"))
+        stat2 = os.stat(os.path.join(self.root, "f2", "a", "file1"))
+        self.assertEqual((stat1.st_dev, stat1.st_ino), (stat2.st_dev, stat2.st_ino))
+        self.make_file(os.path.join("f2", "a", "file2"), b"content", 1000)
+        self.synchronize()
+        stat1 = os.stat(os.path.join(self.root, "f1", "a", "file2"))
+        stat2 = os.stat(os.path.join(self.root, "f2", "a", "file2"))
+        self.assertNotEqual(stat1.st_ino, stat2.st_ino)
+
+    def test_moved_file(self):
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 1000)
+        self.synchronize()
+        inode = os.stat(os.path.join(self.root, "f2", "a", "file1")).st_ino
+        os.renames(os.path.join(self.root, "f1", "a", "file1"), os.path.join(self.root, "f1", "b", "file1"))
+        self.synchronize()
+        self.assertEqual(os.stat(os.path.join(self.root, "f2", "b", "file1")).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "f2"))), [".bisync", "b"])
+
+    def test_trash(self):
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 1000)
+        self.synchronize()
+        os.remove(os.path.join(self.root, "f1", "a", "file1"))
+        self.synchronize()
+        self.assertFalse(os.path.exists(os.path.join(self.root, "f2", "a")))
+        self.assertEqual(self.read_file(os.path.join("f2", bisync.BISYNC_TRASH, "a", "file1")), b"content")
+
+    def test_undecodable_names(self):
+        name = os.fsdecode(b"caf\xe9.mp3")
+        self.make_file(os.path.join("f1", name), b"content", 1000)
+        self.synchronize()
+        self.assertEqual(self.read_file(os.path.join("f2", name)), b"content")
+        self.synchronize()
+        self.assertEqual(sorted(os.listdir(self.folders[1])), sorted([".bisync", name]))
+
+    def test_hash_touched(self):
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 1000)
+        self.synchronize(hash_contents=True)
+        inode = os.stat(os.path.join(self.root, "f2", "a", "file1")).st_ino
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 2000)
+        self.synchronize(hash_contents=True)
+        stat = os.stat(os.path.join(self.root, "f2", "a", "file1"))
+        self.assertEqual((stat.st_ino, stat.st_mtime), (inode, 2000))
+
+    def test_hash_conflict(self):
+        class ConflictSynchronizer(bisync.Synchronizer):
+            def resolve_conflict(self, f1, f2, path):
+                raise AssertionError("Files with the same content are not in conflict")
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.synchronize(hash_contents=True)
+        self.make_file(os.path.join("f1", "file1"), b"modified", 2000)
+        self.make_file(os.path.join("f2", "file1"), b"modified", 3000)
+        sources = [bisync.FileSystemSource(x) for x in self.folders]
+        ConflictSynchronizer(hash_contents=True).synchronize_all(sources)
+        self.assertEqual(os.stat(os.path.join(self.root, "f1", "file1")).st_mtime, 3000)
+
+    def test_hash_preserved_mtime(self):
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.synchronize(hash_contents=True)
+        # the file is replaced by another one with the same size and modification time
+        self.make_file(os.path.join("f1", "file2"), b"CONTENT", 1000)
+        os.rename(os.path.join(self.root, "f1", "file2"), os.path.join(self.root, "f1", "file1"))
+        self.synchronize(hash_contents=True)
+        self.assertEqual(self.read_file(os.path.join("f2", "file1")), b"CONTENT")
+        # the modified file keeps its time, the copy gets the time of the index
+        self.assertEqual(os.stat(os.path.join(self.root, "f1", "file1")).st_mtime, 1000)
+        self.assertEqual(os.stat(os.path.join(self.root, "f2", "file1")).st_mtime, 1001)
+        sources = self.synchronize(hash_contents=True)
+        self.assertEqual(sources[0].index["file1"], sources[1].index["file1"])
+        self.assertEqual(len(sources[0].index["file1"]), 2)
+        self.assertEqual(os.stat(os.path.join(self.root, "f1", "file1")).st_mtime, 1000)
+
+    def test_hash_shards(self):
+        class CountingSource(bisync.FileSystemSource):
+            written = []
+            def write_stream(self, path):
+                self.written.append(path)
+                return super(CountingSource, self).write_stream(path)
+        for i in range(10):
+            self.make_file(os.path.join("f1", "file%d" % i), b"content %d" % i, 1000)
+        def synchronize():
+            sources = [CountingSource(x) for x in self.folders]
+            bisync.Synchronizer(hash_contents=True).synchronize_all(sources)
+            return sources
+        synchronize()
+        with open(os.path.join(self.folders[0], bisync.hashes_shard_path(1, 0)), "rb") as file_:
+            states = dict(bisync.read_hashes(file_))
+        # each hash is only stored once, in the state of the file
+        self.assertEqual(states["file1"][:3], [9, 1000, 1000])
+        self.assertEqual(states["file1"][3][-1], bisync.hash_file(os.path.join(self.folders[0], "file1")))
+        synchronize() # hashes the files copied to f2
+        # the unmodified shards are not written again
+        del CountingSource.written[:]
+        synchronize()
+        self.assertEqual([x for x in CountingSource.written if "hashes" in x], [])
+        # the state of a source which is not hashed anymore is deleted
+        self.synchronize()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folders[0], bisync.BISYNC_FOLDER))),
+            sorted(os.listdir(os.path.join(self.folders[1], bisync.BISYNC_FOLDER))))
+        self.assertFalse([x for x in os.listdir(os.path.join(self.folders[0], bisync.BISYNC_FOLDER))
+            if x.startswith("hashes")])
+
+    def test_hash_files(self):
+        for i in range(10):
+            self.make_file(os.path.join("f1", "file%d" % i), b"content %d" % i, 1000)
+        source = bisync.FileSystemSource(self.folders[0], hash_workers=2)
+        cache = {}
+        paths = ["file%d" % i for i in range(10)] + ["missing"]
+        hashes = source.hash_files(paths, cache)
+        self.assertEqual(sorted(hashes.keys()), sorted(cache.keys()))
+        self.assertEqual(hashes["file1"], bisync.hash_file(os.path.join(self.folders[0], "file1")))
+        # unmodified files are not hashed again
+        cache["file1"][3] = "cached"
+        self.assertEqual(source.hash_files(paths, cache)["file1"], "cached")
+        self.make_file(os.path.join("f1", "file1"), b"content 1", 2000)
+        self.assertEqual(source.hash_files(paths, cache)["file1"], hashes["file1"])
+
+    def test_ignore(self):
+        self.make_file(os.path.join("f1", bisync.BISYNC_IGNORE), b"build/\n*.tmp\n", 1000)
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.make_file(os.path.join("f1", "file2.tmp"), b"content", 1000)
+        self.make_file(os.path.join("f1", "a", "build", "file3"), b"content", 1000)
+        self.make_file(os.path.join("f2", "build", "file4"), b"content", 1000)
+        self.synchronize(incremental=True)
+        self.assertEqual(sorted(os.listdir(self.folders[1])), [".bisync", bisync.BISYNC_IGNORE, "build", "file1"])
+        source = bisync.FileSystemSource(self.folders[0])
+        source.set_ignore(["build/", "*.tmp"])
+        self.assertEqual(sorted(x[0] for x in source.walk()), [bisync.BISYNC_IGNORE, "file1"])
+        # files ignored after being synchronized are forgotten without being deleted
+        self.make_file(os.path.join("f1", bisync.BISYNC_IGNORE), b"build/\n*.tmp\nfile1\n", 2000)
+        self.synchronize(incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.folders[1], "file1")))
+        os.remove(os.path.join(self.folders[1], "file1"))
+        self.synchronize(incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.folders[0], "file1")))
+        # the folders ignored before are listed once they are not ignored anymore, the rules of f2 are
+        # those it received during the previous synchronization
+        self.make_file(os.path.join("f1", bisync.BISYNC_IGNORE), b"", 3000)
+        self.synchronize(incremental=True)
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], "a")))
+        self.synchronize(incremental=True)
+        self.assertEqual(self.read_file(os.path.join("f2", "a", "build", "file3")), b"content")
+        self.assertEqual(self.read_file(os.path.join("f1", "build", "file4")), b"content")
+
+    def interrupted_sync(self):
+        # the copy of "large" fails after writing half of it, like an interrupted copy
+        class InterruptedSource(bisync.FileSystemSource):
+            def copy_to(self, local_file, dest_file):
+                if dest_file.startswith("large"):
+                    with open(local_file, "rb") as file_:
+                        self.write_memory(dest_file, file_.read(os.path.getsize(local_file) // 2))
+                    raise OSError("Connection lost")
+                super(InterruptedSource, self).copy_to(local_file, dest_file)
+        sources = [bisync.FileSystemSource(self.folders[0]), InterruptedSource(self.folders[1])]
+        with self.assertRaises(OSError):
+            bisync.Synchronizer().synchronize_all(sources)
+        self.assertTrue(os.path.exists(os.path.join(self.folders[1], "large" + bisync.BISYNC_SUFFIX)))
+        return sources
+
+    def test_journal(self):
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.make_file(os.path.join("f1", "large"), b"large content" * 1000, 1000)
+        sources = self.interrupted_sync()
+        # the versions merged before the interruption are kept
+        sync = bisync.Synchronizer()
+        self.assertEqual(sync.load_index(bisync.FileSystemSource(self.folders[1]))["file1"], sources[0].index["file1"])
+        class ResumingSource(bisync.FileSystemSource):
+            resumed = []
+            def copy_to(self, local_file, dest_file):
+                raise AssertionError("The interrupted copy is resumed")
+            def resume_copy_to(self, local_file, dest_file):
+                self.resumed.append(dest_file)
+                return super(ResumingSource, self).resume_copy_to(local_file, dest_file)
+        original = bisync.COPY_CHUNK_SIZE
+        bisync.COPY_CHUNK_SIZE = 1000
+        try:
+            sync.synchronize_all([bisync.FileSystemSource(self.folders[0]), ResumingSource(self.folders[1])])
+        finally:
+            bisync.COPY_CHUNK_SIZE = original
+        self.assertEqual(ResumingSource.resumed, ["large" + bisync.BISYNC_SUFFIX])
+        self.assertEqual(self.read_file(os.path.join("f2", "large")), b"large content" * 1000)
+        self.assertEqual(os.stat(os.path.join(self.folders[1], "large")).st_mtime, 1000)
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], bisync.BISYNC_JOURNAL)))
+
+    def test_journal_batches(self):
+        for i in range(20):
+            self.make_file(os.path.join("f1", "file%d" % i), b"content", 1000)
+        self.synchronize()
+        for i in range(20):
+            os.remove(os.path.join(self.folders[0], "file%d" % i))
+        class CountingSource(bisync.FileSystemSource):
+            appended = []
+            def append_memory(self, path, content):
+                self.appended.append(content)
+                super(CountingSource, self).append_memory(path, content)
+        bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(self.folders[0]),
+            CountingSource(self.folders[1])])
+        # the records of the deletes are appended at once
+        self.assertEqual(len(CountingSource.appended), 1)
+        self.assertEqual(CountingSource.appended[0].count(b"\n"), 20)
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], "file0")))
+
+    def test_journal_cleanup(self):
+        self.make_file(os.path.join("f1", "large"), b"large content" * 1000, 1000)
+        self.interrupted_sync()
+        os.remove(os.path.join(self.folders[0], "large"))
+        self.synchronize()
+        self.assertEqual(os.listdir(self.folders[1]), [".bisync"])
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], bisync.BISYNC_JOURNAL)))
+
+    def test_source_errors(self):
+        class FailingSource(bisync.FileSystemSource):
+            def walk(self):
+                raise OSError("Disk error in %s" % self.path)
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        folders = self.folders + [os.path.join(self.root, "f3")]
+        with self.assertRaises(OSError):
+            bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(folders[0]),
+                FailingSource(folders[1])])
+        # the index of the other source is saved
+        self.assertTrue(os.path.exists(os.path.join(self.folders[0], bisync.BISYNC_MANIFEST)))
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], bisync.BISYNC_FOLDER)))
+        with self.assertRaises(bisync.SyncError) as context:
+            bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(folders[0]),
+                FailingSource(folders[1]), FailingSource(folders[2])])
+        self.assertEqual([x.path for x, _ in context.exception.errors], folders[1:])
+        self.assertIn("Disk error in %s" % folders[2], str(context.exception))
+
+    def test_simulation(self):
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.make_file(os.path.join("f2", "file2"), b"content", 1000)
+        script = os.path.join(os.path.dirname(os.path.abspath(bisync.__file__)), "bisync")
+        plan_file = os.path.join(self.root, "plan.json")
+        output = subprocess.check_output([sys.executable, script, "-s", "--plan-json", plan_file] + self.folders)
+        self.assertIn(b"total: 2 operation(s)", output)
+        with open(plan_file) as file_:
+            plan = json.load(file_)
+        self.assertEqual(sorted((x["kind"], x["path"], x["bytes"]) for x in plan["operations"]),
+            [("copy", "file1", 7), ("copy", "file2", 7)])
+        self.assertEqual(sorted(os.listdir(self.folders[0])), ["file1"])
+
+    def test_command_folders(self):
+        # folders can have the names of the other commands
+        os.rename(self.folders[0], os.path.join(self.root, "compact"))
+        self.make_file(os.path.join("compact", "file1"), b"content", 1000)
+        script = os.path.join(os.path.dirname(os.path.abspath(bisync.__file__)), "bisync")
+        subprocess.check_output([sys.executable, script, "compact", "f2", "-a"], cwd=self.root)
+        self.assertEqual(self.read_file(os.path.join("f2", "file1")), b"content")
+
+    def test_rescan_folders(self):
+        self.make_file(os.path.join("f1", "a", "file1"), b"content", 1000)
+        self.make_file(os.path.join("f1", "b", "c", "file2"), b"content", 1000)
+        self.make_file(os.path.join("f1", "g", "file3"), b"content", 1000)
+        source = bisync.FileSystemSource(self.folders[0])
+        sync = bisync.Synchronizer()
+        sync.build_index(source)
+        self.make_file(os.path.join("f1", "a", "file1"), b"modified", 2000)
+        shutil.rmtree(os.path.join(self.root, "f1", "b"))
+        self.make_file(os.path.join("f1", "d", "e", "file4"), b"content", 1000)
+        self.make_file(os.path.join("f1", "g", "file3"), b"modified", 2000) # not in a rescanned folder
+        self.assertEqual(sync.rescan_folders(source, ["a", ""]),
+            set([os.path.join("a", "file1"), os.path.join("b", "c", "file2"), os.path.join("d", "e", "file4")]))
+        self.assertEqual(source.index[os.path.join("a", "file1")].key(-1), bisync.make_version(8, 2000))
+        self.assertEqual(source.index[os.path.join("b", "c", "file2")][-1][0], False)
+        self.assertEqual(source.index[os.path.join("g", "file3")].key(-1), bisync.make_version(7, 1000))
+        self.assertEqual(sync.rescan_folders(source, ["g"]), set([os.path.join("g", "file3")]))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+    def test_inotify_watcher(self):
+        watcher = bisync.InotifyWatcher(self.folders[0])
+        try:
+            self.assertEqual(watcher.changes(), None)
+            os.makedirs(os.path.join(self.folders[0], "a"))
+            self.assertEqual(watcher.changes(), set([""]))
+            self.make_file(os.path.join("f1", "a", "file1"))
+            os.rename(os.path.join(self.folders[0], "a"), os.path.join(self.folders[0], "b"))
+            self.make_file(os.path.join("f1", "b", "file2"))
+            self.make_file(os.path.join("f1", ".bisync", "index"))
+            self.assertEqual(watcher.changes(), set(["", "a", "b"]))
+        finally:
+            watcher.close()
+
+    def watch(self, check, **kwargs):
+        sources = [bisync.FileSystemSource(x) for x in self.folders]
+        sync = bisync.Synchronizer(**kwargs)
+        stop = threading.Event()
+        thread = threading.Thread(target=sync.watch, args=(sources, stop), kwargs={"debounce": 0.1})
+        thread.start()
+        try:
+            deadline = time.monotonic() + 10
+            while not check() and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertTrue(check())
+
+    def test_watch(self):
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.watch(lambda: os.path.exists(os.path.join(self.folders[1], "file1")))
+        path = os.path.join(self.folders[1], "file1")
+        def modify():
+            time.sleep(0.5)
+            self.make_file(os.path.join("f2", "a", "file2"), b"content", 1000)
+            self.make_file(os.path.join("f2", "file1"), b"modified", 2000)
+        threading.Thread(target=modify).start()
+        self.watch(lambda: os.path.exists(os.path.join(self.folders[0], "a", "file2")) and
+            self.read_file(os.path.join("f1", "file1")) == b"modified")
+        index = bisync.Synchronizer().load_index(bisync.FileSystemSource(self.folders[0]))
+        self.assertEqual(index["file1"].key(-1), bisync.make_version(8, 2000))
+
+    def test_watch_polling(self):
+        self.make_file(os.path.join("f1", "file1"), b"content", 1000)
+        self.synchronize()
+        original = bisync.FileSystemSource.get_watcher
+        bisync.FileSystemSource.get_watcher = lambda self: bisync.PollingWatcher(0.1)
+        try:
+            os.remove(os.path.join(self.folders[0], "file1"))
+            self.watch(lambda: not os.path.exists(os.path.join(self.folders[1], "file1")), no_trash=True)
+        finally:
+            bisync.FileSystemSource.get_watcher = original
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_delta(self):
+        random_ = random.Random(0)
+        base = bytes(random_.getrandbits(8) for _ in range(100000))
+        modifications = [
+            base,
+            b"",
+            base[:1000] + b"inserted" + base[1000:],
+            base[:5000] + base[7000:],
+            base[:50000] + b"x" * 100 + base[50100:],
+            base + b"appended",
+            b"new" + base[:20000],
+        ]
+        for new in modifications:
+            write_file(os.path.join(self.root, "base"), base, 1000)
+            write_file(os.path.join(self.root, "new"), new, 2000)
+            signatures = bisync.compute_signatures(os.path.join(self.root, "base"), 2048)
+            delta = bisync.compute_delta(os.path.join(self.root, "new"), signatures, 2048)
+            items = list(delta.items)
+            # only the modified blocks are sent
+            self.assertLessEqual(sum(len(x) for x in items if not isinstance(x, int)),
+                max(0, len(new) - len(base)) + 2 * 2048)
+            delta.items = iter(items)
+            bisync.patch_file(os.path.join(self.root, "base"), delta, os.path.join(self.root, "result"))
+            with open(os.path.join(self.root, "result"), "rb") as file_:
+                self.assertEqual(file_.read(), new)
+            self.assertEqual(os.stat(os.path.join(self.root, "result")).st_mtime, 2000)
+
+    def test_modified_base(self):
+        write_file(os.path.join(self.root, "base"), b"a" * 10000, 1000)
+        write_file(os.path.join(self.root, "new"), b"a" * 10000 + b"b", 2000)
+        signatures = bisync.compute_signatures(os.path.join(self.root, "base"), 2048)
+        delta = bisync.compute_delta(os.path.join(self.root, "new"), signatures, 2048)
+        write_file(os.path.join(self.root, "base"), b"c" * 10000, 1000)
+        with self.assertRaises(ValueError):
+            bisync.patch_file(os.path.join(self.root, "base"), delta, os.path.join(self.root, "result"))
+
+    def test_sync(self):
+        class SlowSource(bisync.FileSystemSource):
+            remote = True
+            def copy_to(self, local_file, dest_file):
+                raise AssertionError("The file should be sent as a delta")
+        folders = [os.path.join(self.root, x) for x in ["f1", "f2"]]
+        content = os.urandom(2 * bisync.DELTA_MIN_SIZE)
+        for folder in folders:
+            write_file(os.path.join(folder, "file1"), content, 1000)
+        bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(x) for x in folders])
+        content = content[:1000] + b"modified" + content[1000:]
+        write_file(os.path.join(folders[0], "file1"), content, 2000)
+        bisync.Synchronizer(delta=True).synchronize_all([bisync.FileSystemSource(folders[0]), SlowSource(folders[1])])
+        with open(os.path.join(folders[1], "file1"), "rb") as file_:
+            self.assertEqual(file_.read(), content)
+
+class TestRemoteSource(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.folders = [os.path.join(self.root, x) for x in ["f1", "f2"]]
+        for folder in self.folders:
+            os.makedirs(folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_remote(self, folder):
+        # the agent is started through a pipe instead of ssh
+        script = os.path.join(os.path.dirname(os.path.abspath(bisync.__file__)), "bisync")
+        return bisync.RemoteSource([sys.executable, script, "--agent", folder])
+
+    def test_operations(self):
+        write_file(os.path.join(self.folders[1], "a", "file1"), b"content", 1000)
+        source = self.make_remote(self.folders[1])
+        try:
+            self.assertEqual(list(source.walk()), [[os.path.join("a", "file1"), 7, 1000]])
+            self.assertTrue(source.exists(os.path.join("a", "file1")))
+            self.assertFalse(source.exists("file2"))
+            source.write_memory(os.path.join("b", "file2"), b"memory")
+            self.assertEqual(source.read_memory(os.path.join("b", "file2")), b"memory")
+            source.rename(os.path.join("b", "file2"), os.path.join("c", "file3"))
+            source.delete(os.path.join("a", "file1"))
+            self.assertEqual(list(source.walk()), [[os.path.join("c", "file3"), 6, int(os.stat(
+                os.path.join(self.folders[1], "c", "file3")).st_mtime)]])
+            local_file = source.get_local_name(os.path.join("c", "file3"))
+            with open(local_file, "rb") as file_:
+                self.assertEqual(file_.read(), b"memory")
+            source.release_local_name(os.path.join("c", "file3"), local_file)
+            self.assertFalse(os.path.exists(local_file))
+            with self.assertRaises(FileNotFoundError):
+                source.read_memory("file4")
+            source.set_ignore(["c/"])
+            self.assertEqual(list(source.walk()), [])
+            write_file(os.path.join(self.root, "file5"), b"resumed content", 1000)
+            self.assertFalse(source.resume_copy_to(os.path.join(self.root, "file5"), "file5"))
+            source.write_memory("file5", b"resumed")
+            self.assertTrue(source.resume_copy_to(os.path.join(self.root, "file5"), "file5"))
+            self.assertEqual(source.read_memory("file5"), b"resumed content")
+            source.append_memory("file6", b"a")
+            source.append_memory("file6", b"b")
+            self.assertEqual(source.read_memory("file6"), b"ab")
+            source.make_dirs(["d"])
+            source.rename_many([("file5", os.path.join("d", "file5"))])
+            source.delete_many([os.path.join("d", "file5"), "file6"])
+        finally:
+            source.close()
+        self.assertEqual(sorted(os.listdir(self.folders[1])), ["c"])
+
+    def test_delta(self):
+        content = os.urandom(2 * bisync.DELTA_MIN_SIZE)
+        for folder in self.folders:
+            write_file(os.path.join(folder, "file1"), content, 1000)
+        source = self.make_remote(self.folders[1])
+        try:
+            signatures = source.get_signatures("file1", 4096)
+            self.assertEqual(signatures, bisync.compute_signatures(os.path.join(self.folders[1], "file1"), 4096))
+            content = content[:1000] + b"modified" + content[1000:]
+            write_file(os.path.join(self.folders[0], "file1"), content, 2000)
+            delta = bisync.compute_delta(os.path.join(self.folders[0], "file1"), signatures, 4096)
+            source.apply_delta("file1", delta, "file2")
+        finally:
+            source.close()
+        with open(os.path.join(self.folders[1], "file2"), "rb") as file_:
+            self.assertEqual(file_.read(), content)
+        self.assertEqual(os.stat(os.path.join(self.folders[1], "file2")).st_mtime, 2000)
+
+    def test_throttle(self):
+        write_file(os.path.join(self.folders[0], "file1"), b"x" * 15000, 1000)
+        source = self.make_remote(self.folders[1])
+        clock = FakeClock()
+        source.throttle = bisync.RateLimiter(bytes_per_second=20000, clock=clock, sleep=clock.sleep)
+        try:
+            source.copy_to(os.path.join(self.folders[0], "file1"), "file1")
+            local_file = source.get_local_name("file1")
+            source.release_local_name("file1", local_file)
+        finally:
+            source.close()
+        # 30 kB transferred, 20 kB of which can be sent at once
+        self.assertAlmostEqual(sum(clock.sleeps), 0.5)
+
+    def test_pipelined_error(self):
+        source = self.make_remote(self.folders[1])
+        try:
+            source.rename("missing", "file1")
+            # the following requests are cancelled until the error is reported
+            source.write_memory("file2", b"content")
+            with self.assertRaises(FileNotFoundError):
+                source.exists("file2")
+            self.assertFalse(source.exists("file2"))
+            source.write_memory("file2", b"content")
+        finally:
+            source.close()
+        self.assertEqual(os.listdir(self.folders[1]), ["file2"])
+
+    def test_failed_upload(self):
+        os.makedirs(os.path.join(self.folders[0], "folder"))
+        source = self.make_remote(self.folders[1])
+        try:
+            with self.assertRaises(IsADirectoryError):
+                source.copy_to(os.path.join(self.folders[0], "folder"), "file1")
+            self.assertFalse(source.exists("file1"))
+            # a stream failing partway is aborted
+            def items():
+                yield b"data"
+                raise OSError(errno.EIO, "Read error")
+            delta = bisync.Delta(4096, items(), b"", 0, 0o644)
+            with self.assertRaises(OSError):
+                source.apply_delta("file1", delta, "file2")
+            self.assertFalse(source.exists("file2"))
+            source.write_memory("file3", b"content")
+            source.wait()
+            self.assertEqual(source.read_memory("file3"), b"content")
+        finally:
+            source.close()
+        self.assertEqual(os.listdir(self.folders[1]), ["file3"])
+
+    def test_failed_download(self):
+        os.makedirs(os.path.join(self.folders[1], "folder"))
+        source = self.make_remote(self.folders[1])
+        try:
+            with self.assertRaises(IsADirectoryError):
+                source.read_memory("folder")
+            self.assertTrue(source.exists("folder"))
+        finally:
+            source.close()
+        # the data of a reply failing partway are aborted, and the agent keeps serving
+        class FailingAgent(bisync.Agent):
+            def do_read(self, chunks, path):
+                def data():
+                    yield b"data"
+                    raise OSError(errno.EIO, "Read error")
+                return [0, 0o644], data()
+        input_ = io.BytesIO()
+        bisync._write_message(input_, {"op": "read", "args": ["file1"], "group": 1, "reset": False})
+        bisync._write_message(input_, {"op": "exists", "args": ["folder"], "group": 2, "reset": False})
+        input_.seek(0)
+        output = io.BytesIO()
+        FailingAgent(bisync.FileSystemSource(self.folders[1]), input_, output).serve()
+        output.seek(0)
+        self.assertEqual(json.loads(bisync._read_frame(output).decode("utf8")), {"result": [0, 0o644]})
+        with self.assertRaises(OSError) as context:
+            list(bisync._read_chunks(output))
+        self.assertEqual(context.exception.errno, errno.EIO)
+        self.assertEqual(json.loads(bisync._read_frame(output).decode("utf8")), {"result": True})
+
+    def test_failed_copy(self):
+        for i in range(10):
+            write_file(os.path.join(self.folders[0], "file%d" % i), b"content %d" % i, 1000)
+        # the temporary file of file3 can't be written
+        write_file(os.path.join(self.folders[1], "file3" + bisync.BISYNC_SUFFIX, "file"), b"", 1000)
+        sources = [bisync.FileSystemSource(self.folders[0]), self.make_remote(self.folders[1])]
+        try:
+            with self.assertRaises(IsADirectoryError):
+                bisync.Synchronizer(jobs=4).synchronize_all(sources)
+        finally:
+            sources[1].close()
+        # the copy was not committed, neither by a rename nor in the journal
+        self.assertFalse(os.path.exists(os.path.join(self.folders[1], "file3")))
+        self.assertEqual(sorted(x for x in os.listdir(self.folders[1]) if x.startswith("file")),
+            sorted(["file%d" % i for i in range(10) if i != 3] + ["file3" + bisync.BISYNC_SUFFIX]))
+        with open(os.path.join(self.folders[1], bisync.BISYNC_JOURNAL)) as file_:
+            done = [json.loads(x).get("done") for x in file_]
+        self.assertEqual(sorted(x for x in done if x is not None), ["file%d" % i for i in range(10) if i != 3])
+
+    def test_sync(self):
+        for i in range(20):
+            write_file(os.path.join(self.folders[0], "a", "file%d" % i), b"local %d" % i, 1000 + i)
+            write_file(os.path.join(self.folders[1], "b", "file%d" % i), b"remote %d" % i, 2000 + i)
+        for jobs in [1, 4]:
+            sources = [bisync.FileSystemSource(self.folders[0]), self.make_remote(self.folders[1])]
+            try:
+                bisync.Synchronizer(no_trash=True, jobs=jobs).synchronize_all(sources)
+            finally:
+                sources[1].close()
+            for i in range(20):
+                for folder in self.folders:
+                    path = os.path.join(folder, "a", "file%d" % i)
+                    with open(path, "rb") as file_:
+                        self.assertEqual(file_.read(), b"local %d" % i)
+                    self.assertEqual(os.stat(path).st_mtime, 1000 + i)
+                    self.assertEqual(os.path.exists(os.path.join(folder, "b", "file%d" % i)), i != 0 or jobs == 1)
+            if jobs == 1:
+                # the deletion is sent to the remote folder by the second synchronization
+                os.remove(os.path.join(self.folders[0], "b", "file0"))
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super(FakeClientError, self).__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+class FakeS3Client(object):
+    """ In-process stand-in for the S3 client of boto3, implementing the part of its API used by
+    ObjectStoreSource. The bucket is ignored, calls counts the requests of each kind. """
+    def __init__(self):
+        self.objects = {} # key -> [content, metadata, ETag, time of last modification]
+        self.uploads = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _object(self, key):
+        if key not in self.objects:
+            raise FakeClientError("NoSuchKey")
+        return self.objects[key]
+
+    def _store(self, key, content, metadata, etag=None):
+        etag = etag or '"%s"' % hashlib.md5(content).hexdigest()
+        with self._lock:
+            self.objects[key] = [content, dict(metadata or {}), etag, datetime.datetime.now(datetime.timezone.utc)]
+        return etag
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000, ContinuationToken=None):
+        self._call("list_objects_v2")
+        keys = sorted(x for x in self.objects if x.startswith(Prefix) and
+            (ContinuationToken is None or x > ContinuationToken))
+        page = {"Contents": [{"Key": x, "Size": len(self.objects[x][0]), "ETag": self.objects[x][2],
+            "LastModified": self.objects[x][3]} for x in keys[:MaxKeys]], "IsTruncated": len(keys) > MaxKeys}
+        if page["IsTruncated"]:
+            page["NextContinuationToken"] = keys[MaxKeys - 1]
+        return page
+
+    def head_object(self, Bucket, Key):
+        self._call("head_object")
+        if Key not in self.objects:
+            raise FakeClientError("404")
+        content, metadata, etag, modified = self.objects[Key]
+        return {"ContentLength": len(content), "Metadata": dict(metadata), "ETag": etag, "LastModified": modified}
+
+    def get_object(self, Bucket, Key):
+        self._call("get_object")
+        content, metadata, etag, modified = self._object(Key)
+        return {"Body": io.BytesIO(content), "Metadata": dict(metadata), "ETag": etag, "LastModified": modified}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self._call("put_object")
+        return {"ETag": self._store(Key, Body, Metadata)}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY", Metadata=None):
+        self._call("copy_object")
+        content, metadata = self._object(CopySource["Key"])[:2]
+        etag = self._store(Key, content, metadata if MetadataDirective == "COPY" else Metadata)
+        return {"CopyObjectResult": {"ETag": etag}}
+
+    def delete_object(self, Bucket, Key):
+        self._call("delete_object")
+        self.objects.pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._call("delete_objects")
+        for x in Delete["Objects"]:
+            self.objects.pop(x["Key"], None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None):
+        self._call("create_multipart_upload")
+        upload_id = "upload%d" % len(self.uploads)
+        self.uploads[upload_id] = [{}, Metadata]
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call("upload_part")
+        self.uploads[UploadId][0][PartNumber] = Body
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange):
+        self._call("upload_part_copy")
+        start, end = [int(x) for x in CopySourceRange[len("bytes="):].split("-")]
+        content = self._object(CopySource["Key"])[0][start:end + 1]
+        self.uploads[UploadId][0][PartNumber] = content
+        return {"CopyPartResult": {"ETag": '"%s"' % hashlib.md5(content).hexdigest()}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call("complete_multipart_upload")
+        parts, metadata = self.uploads.pop(UploadId)
+        content = b"".join(parts[x["PartNumber"]] for x in MultipartUpload["Parts"])
+        etag = self._store(Key, content, metadata, '"multipart-%d"' % len(MultipartUpload["Parts"]))
+        return {"ETag": etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call("abort_multipart_upload")
+        self.uploads.pop(UploadId, None)
+        return {}
+
+class TestObjectStoreSource(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.client = FakeS3Client()
+        self.constants = dict((x, getattr(bisync, x)) for x in ["OBJECT_LIST_PAGE_SIZE", "MULTIPART_THRESHOLD",
+            "MULTIPART_PART_SIZE", "OBJECT_COPY_MAX_SIZE"])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        for name, value in self.constants.items():
+            setattr(bisync, name, value)
+
+    def make_source(self):
+        return bisync.ObjectStoreSource("bucket", "backup/", client=self.client)
+
+    def test_operations(self):
+        bisync.OBJECT_LIST_PAGE_SIZE = 2
+        for i in range(5):
+            write_file(os.path.join(self.root, "file%d" % i), b"content%d" % i, 1000 + i)
+        source = self.make_source()
+        for i in range(5):
+            source.copy_to(os.path.join(self.root, "file%d" % i), os.path.join("a", "file%d" % i))
+        self.client.put_object("bucket", "other/file", b"outside of the prefix")
+        source.rename(os.path.join("a", "file4"), os.path.join("b", "file4"))
+        source.delete(os.path.join("a", "file3"))
+        result = [[os.path.join("a", "file%d" % i), 8, 1000 + i] for i in range(3)] + [
+            [os.path.join("b", "file4"), 8, 1004]]
+        self.assertEqual(sorted(source.walk()), result)
+        self.assertEqual(self.client.calls["list_objects_v2"], 2)
+        self.assertTrue(source.exists(os.path.join("a", "file0")))
+        self.assertFalse(source.exists(os.path.join("a", "file3")))
+        with self.assertRaises(FileNotFoundError):
+            source.read_memory("missing")
+        local_file = source.get_local_name(os.path.join("b", "file4"))
+        with open(local_file, "rb") as file_:
+            self.assertEqual(file_.read(), b"content4")
+        self.assertEqual(os.stat(local_file).st_mtime, 1004)
+        source.release_local_name(os.path.join("b", "file4"), local_file)
+        self.assertTrue(source.set_mtime(os.path.join("a", "file0"), 2000))
+        source.close()
+
+        # the times of last modification are read from the manifest, without a request per object
+        calls = dict(self.client.calls)
+        source = self.make_source()
+        result[0][2] = 2000
+        self.assertEqual(sorted(source.walk()), result)
+        self.assertEqual(self.client.calls.get("head_object"), calls.get("head_object"))
+        # an object modified by another program gets the time of its upload
+        self.client.put_object("bucket", "backup/a/file1", b"modified")
+        self.assertEqual([x for x in source.walk() if x[0] == os.path.join("a", "file1")],
+            [[os.path.join("a", "file1"), 8, int(self.client.objects["backup/a/file1"][3].timestamp())]])
+
+    def test_multipart(self):
+        bisync.MULTIPART_THRESHOLD = 1000
+        bisync.MULTIPART_PART_SIZE = 300
+        bisync.OBJECT_COPY_MAX_SIZE = 1000
+        content = os.urandom(2500)
+        write_file(os.path.join(self.root, "file1"), content, 1000)
+        source = self.make_source()
+        source.copy_to(os.path.join(self.root, "file1"), "file1")
+        self.assertEqual(self.client.calls["upload_part"], 9)
+        self.assertEqual(self.client.objects["backup/file1"][0], content)
+        # large objects are copied by parts by the object store
+        source.rename("file1", "file2")
+        self.assertEqual(self.client.calls["upload_part_copy"], 9)
+        self.assertEqual(sorted(self.client.objects), ["backup/file2"])
+        self.assertEqual(self.client.objects["backup/file2"][0], content)
+        self.assertEqual(list(source.walk()), [["file2", 2500, 1000]])
+        self.assertFalse(source.set_mtime("file2", 2000))
+        self.assertEqual(self.client.uploads, {})
+
+    def test_sync(self):
+        folder = os.path.join(self.root, "f1")
+        write_file(os.path.join(folder, "file1"), b"content1", 1000)
+        write_file(os.path.join(folder, "a", "file2"), b"content2", 1000)
+        write_file(os.path.join(folder, "a", "file3"), b"content3", 1000)
+        sync = bisync.Synchronizer()
+        def synchronize():
+            source = self.make_source()
+            try:
+                sync.synchronize_all([bisync.FileSystemSource(folder), source])
+            finally:
+                source.close()
+        synchronize()
+        self.assertEqual(self.client.objects["backup/a/file2"][0], b"content2")
+        self.assertIn("backup/.bisync/objects", self.client.objects)
+        # the objects are uploaded to their final key, without any copy
+        self.assertEqual(self.client.calls.get("copy_object", 0), 0)
+        self.assertEqual(self.client.calls.get("delete_object", 0) + self.client.calls.get("delete_objects", 0), 0)
+        self.assertEqual([x for x in self.client.objects if x.endswith(bisync.BISYNC_SUFFIX)], [])
+        os.remove(os.path.join(folder, "a", "file2"))
+        os.rename(os.path.join(folder, "a", "file3"), os.path.join(folder, "file3"))
+        self.client.put_object("bucket", "backup/file1", b"modified")
+        synchronize()
+        self.assertEqual(self.client.objects["backup/bisync_trash/a/file2"][0], b"content2")
+        self.assertEqual(self.client.objects["backup/file3"][0], b"content3")
+        self.assertNotIn("backup/a/file3", self.client.objects)
+        with open(os.path.join(folder, "file1"), "rb") as file_:
+            self.assertEqual(file_.read(), b"modified")
+        calls = dict(self.client.calls)
+        synchronize()
+        self.assertEqual(self.client.calls.get("put_object", 0) - calls.get("put_object", 0), 0)
+        self.assertEqual(self.client.calls.get("copy_object", 0) - calls.get("copy_object", 0), 0)
+
+    def test_sync_without_close(self):
+        folder = os.path.join(self.root, "f1")
+        write_file(os.path.join(folder, "file1"), b"content1", 1000)
+        write_file(os.path.join(folder, "a", "file2"), b"content2", 1000)
+        # the source is not closed, like when the process is killed
+        bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(folder), self.make_source()])
+        self.assertIn("backup/.bisync/objects", self.client.objects)
+        calls = dict(self.client.calls)
+        bisync.Synchronizer().synchronize_all([bisync.FileSystemSource(folder), self.make_source()])
+        self.assertEqual(self.client.calls.get("put_object", 0) - calls.get("put_object", 0), 0)
+        self.assertEqual(self.client.calls.get("copy_object", 0) - calls.get("copy_object", 0), 0)
+        self.assertEqual(os.stat(os.path.join(folder, "file1")).st_mtime, 1000)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file